@@ -0,0 +1,457 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from common import (
+    encode_json,
+    FrameCompressor,
+    FrameReader,
+    CODECS,
+    CODEC_JSON,
+    COMPRESSION_DEFLATE,
+    PRESENCE_DELTA,
+    MSG_LOGIN,
+    MSG_ERROR,
+    MSG_GROUP,
+    MSG_PRIVATE,
+    MSG_CONVERSATIONS,
+)
+
+# Marks benchmark messages: "<MARK><send time in ns>|<padding>"
+MARK = "bench|"
+
+READ_CHUNK = 65536
+
+
+# =========================
+# Measurements
+# =========================
+
+class Results:
+    """
+    Raw samples collected by every simulated client.
+    """
+
+    def __init__(self):
+        self.latencies = []         # delivery latencies in seconds
+        self.logins = []            # connect -> login history received
+        self.sent = 0
+        self.delivered = 0
+        self.login_failures = 0
+        self.disconnects = 0
+        self.rss_samples = []       # (seconds since start, KB)
+        self.measuring = False
+
+
+def percentile(samples, q):
+    if not samples:
+        return None
+    return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+
+def summarize(samples):
+    samples = sorted(samples)
+    return {
+        "count": len(samples),
+        "mean_ms": round(sum(samples) / len(samples) * 1000, 3) if samples else None,
+        "p50_ms": _ms(percentile(samples, 0.50)),
+        "p99_ms": _ms(percentile(samples, 0.99)),
+        "p999_ms": _ms(percentile(samples, 0.999)),
+        "max_ms": _ms(samples[-1] if samples else None),
+    }
+
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 3)
+
+
+def process_rss_kb(pid):
+    """
+    Resident memory of a process and all its descendants, from /proc.
+    Returns None where /proc is not available.
+    """
+    total = 0
+    pending = [pid]
+    try:
+        while pending:
+            current = pending.pop()
+            with open(f"/proc/{current}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1])
+                        break
+            for task in os.listdir(f"/proc/{current}/task"):
+                with open(f"/proc/{current}/task/{task}/children") as f:
+                    pending.extend(int(c) for c in f.read().split())
+    except OSError:
+        return None if current == pid else total
+    return total
+
+
+# =========================
+# Simulated client
+# =========================
+
+class BenchClient:
+    """
+    One simulated user speaking the real protocol over asyncio streams.
+    """
+
+    def __init__(self, bench, username):
+        self.bench = bench
+        self.username = username
+        self.reader = None
+        self.writer = None
+        self.frames = FrameReader(max_frame=16 * 1024 * 1024)
+        self.codec = CODECS[CODEC_JSON]
+        self.compressor = None
+        self.online = False
+        self._task = None
+
+    async def login(self):
+        """
+        Connects and logs in. Returns once the login history arrived.
+        """
+        bench = self.bench
+        started = time.perf_counter()
+
+        self.reader, self.writer = await asyncio.open_connection(
+            bench.args.host, bench.args.port
+        )
+        request = {
+            "type": MSG_LOGIN,
+            "username": self.username,
+            "codec": bench.args.codec,
+            "ts": int(time.time())
+        }
+        if bench.args.compress:
+            request["compress"] = COMPRESSION_DEFLATE
+        if not bench.args.full_userlists:
+            request["presence"] = PRESENCE_DELTA
+        self.writer.write(encode_json(request))
+
+        # The reply comes in the original JSON framing; only cut that one
+        # frame, later ones may already use the negotiated codec
+        frames = []
+        while not frames:
+            chunk = await self.reader.read(READ_CHUNK)
+            if not chunk:
+                raise ConnectionError("Closed during login")
+            frames = self.frames.feed(chunk, limit=1)
+        reply = self.codec.decode(frames[0])
+
+        if reply.get("type") == MSG_ERROR:
+            raise ConnectionError(reply.get("message"))
+
+        self.codec = CODECS.get(reply.get("codec"), self.codec)
+        self.frames.set_codec(self.codec)
+        if reply.get("compress") == COMPRESSION_DEFLATE:
+            self.frames.enable_compression()
+            self.compressor = FrameCompressor()
+
+        # MSG_CONVERSATIONS is the last frame of the login history
+        pending = self.frames.decode(self.frames.feed())
+        self._count(pending)
+        while not any(m.get("type") == MSG_CONVERSATIONS for m in pending):
+            chunk = await self.reader.read(READ_CHUNK)
+            if not chunk:
+                raise ConnectionError("Closed during login")
+            pending = self.frames.decode(self.frames.feed(chunk))
+            self._count(pending)
+
+        bench.results.logins.append(time.perf_counter() - started)
+        self.online = True
+        self._task = asyncio.create_task(self._read_loop())
+
+    async def _read_loop(self):
+        try:
+            while True:
+                chunk = await self.reader.read(READ_CHUNK)
+                if not chunk:
+                    break
+                self._count(self.frames.decode(self.frames.feed(chunk)))
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            if self.online:
+                self.online = False
+                self.bench.results.disconnects += 1
+
+    def _count(self, messages):
+        results = self.bench.results
+        now = time.perf_counter_ns()
+        for msg in messages:
+            if msg.get("type") not in (MSG_GROUP, MSG_PRIVATE):
+                continue
+            text = msg.get("text") or ""
+            if not text.startswith(MARK):
+                continue
+            sent_ns = int(text[len(MARK):text.index("|", len(MARK))])
+            if results.measuring:
+                results.delivered += 1
+                results.latencies.append((now - sent_ns) / 1e9)
+
+    def send_chat(self, target=None):
+        bench = self.bench
+        stamp = f"{MARK}{time.perf_counter_ns()}|"
+        text = stamp + "x" * max(0, bench.args.size - len(stamp))
+
+        if target:
+            message = {"type": MSG_PRIVATE, "target": target, "text": text}
+        else:
+            message = {"type": MSG_GROUP, "text": text}
+        message["ts"] = int(time.time())
+
+        frame = self.codec.encode(message)
+        if self.compressor is not None:
+            frame = self.compressor.compress(frame)
+        self.writer.write(frame)
+        if bench.results.measuring:
+            bench.results.sent += 1
+
+    async def close(self):
+        self.online = False
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except (ConnectionError, OSError):
+                pass
+        if self._task is not None:
+            self._task.cancel()
+
+
+# =========================
+# Benchmark driver
+# =========================
+
+class Bench:
+    def __init__(self, args):
+        self.args = args
+        self.results = Results()
+        self.clients = []
+        self._names = 0
+
+    def _new_client(self):
+        self._names += 1
+        return BenchClient(self, f"bench{self._names}")
+
+    async def _login(self, client, limit):
+        async with limit:
+            try:
+                await client.login()
+                return client
+            except (ConnectionError, OSError, asyncio.TimeoutError) as e:
+                self.results.login_failures += 1
+                if self.args.verbose:
+                    print(f"[Bench] login failed: {e}")
+                await client.close()
+                return None
+
+    async def _sender(self, client):
+        args = self.args
+        while True:
+            # Poisson arrivals at --rate messages per second per client
+            await asyncio.sleep(random.expovariate(args.rate))
+            if not client.online:
+                return
+            target = None
+            if random.random() < args.pm_ratio:
+                peer = random.choice(self.clients)
+                if peer is not client and peer.online:
+                    target = peer.username
+            try:
+                client.send_chat(target)
+            except (ConnectionError, OSError):
+                return
+
+    async def _churn(self, limit, senders):
+        while True:
+            await asyncio.sleep(1 / self.args.churn)
+            online = [c for c in self.clients if c.online]
+            if online:
+                leaving = random.choice(online)
+                self.clients.remove(leaving)
+                await leaving.close()
+
+            client = await self._login(self._new_client(), limit)
+            if client:
+                self.clients.append(client)
+                senders.append(asyncio.create_task(self._sender(client)))
+
+    async def _sample_rss(self, started):
+        while True:
+            rss = process_rss_kb(self.args.server_pid)
+            if rss is not None:
+                self.results.rss_samples.append(
+                    (round(time.perf_counter() - started, 1), rss)
+                )
+            await asyncio.sleep(1)
+
+    async def run(self):
+        args = self.args
+        results = self.results
+        limit = asyncio.Semaphore(args.connect_concurrency)
+
+        ramp_started = time.perf_counter()
+        logged_in = await asyncio.gather(
+            *(self._login(self._new_client(), limit) for _ in range(args.clients))
+        )
+        self.clients = [c for c in logged_in if c]
+        ramp = time.perf_counter() - ramp_started
+        print(f"[Bench] {len(self.clients)} clients logged in in {ramp:.2f}s")
+
+        background = []
+        if args.server_pid:
+            background.append(
+                asyncio.create_task(self._sample_rss(time.perf_counter()))
+            )
+
+        results.measuring = True
+        started = time.perf_counter()
+        senders = [asyncio.create_task(self._sender(c)) for c in self.clients]
+        if args.churn > 0:
+            background.append(asyncio.create_task(self._churn(limit, senders)))
+
+        await asyncio.sleep(args.duration)
+        for task in senders + background:
+            task.cancel()
+        elapsed = time.perf_counter() - started
+
+        # Let messages still in flight arrive
+        await asyncio.sleep(args.drain)
+        results.measuring = False
+
+        await asyncio.gather(*(c.close() for c in self.clients))
+        return self.report(ramp, elapsed)
+
+    def report(self, ramp, elapsed):
+        args = self.args
+        results = self.results
+        rss = [kb for _, kb in results.rss_samples]
+
+        return {
+            "config": {k: v for k, v in vars(args).items() if k != "output"},
+            "ts": int(time.time()),
+            "ramp_seconds": round(ramp, 3),
+            "duration_seconds": round(elapsed, 3),
+            "sent": results.sent,
+            "delivered": results.delivered,
+            "sent_per_second": round(results.sent / elapsed, 1),
+            "delivered_per_second": round(results.delivered / elapsed, 1),
+            "login_failures": results.login_failures,
+            "unexpected_disconnects": results.disconnects,
+            "latency": summarize(results.latencies),
+            "login": summarize(results.logins),
+            "server_rss_kb": {
+                "max": max(rss) if rss else None,
+                "last": rss[-1] if rss else None,
+                "samples": results.rss_samples,
+            },
+        }
+
+
+# =========================
+# Server under test
+# =========================
+
+def spawn_server(args):
+    """
+    Starts run_server.py in a scratch directory (fresh database) and waits
+    until it accepts connections.
+    """
+    workdir = tempfile.mkdtemp(prefix="chat-bench-")
+    command = [
+        sys.executable,
+        os.path.join(os.path.dirname(os.path.abspath(__file__)), "run_server.py"),
+        "--host", args.host,
+        "--port", str(args.port),
+        "--engine", args.engine,
+    ] + args.server_arg
+    process = subprocess.Popen(command, cwd=workdir, stdout=subprocess.DEVNULL)
+
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection((args.host, args.port), timeout=1).close()
+            return process
+        except OSError:
+            if process.poll() is not None:
+                raise RuntimeError("Server exited during startup")
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError("Server did not start listening")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Chat server load generator")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=12345)
+    parser.add_argument("--clients", type=int, default=1000,
+                        help="simulated clients connected for the whole run")
+    parser.add_argument("--duration", type=float, default=30,
+                        help="seconds of measured load")
+    parser.add_argument("--rate", type=float, default=0.2,
+                        help="messages per second sent by each client")
+    parser.add_argument("--size", type=int, default=100,
+                        help="message text size in characters")
+    parser.add_argument("--pm-ratio", type=float, default=0.2,
+                        help="fraction of messages sent as PMs")
+    parser.add_argument("--churn", type=float, default=0,
+                        help="clients replaced (leave + join) per second")
+    parser.add_argument("--codec", choices=sorted(CODECS), default=CODEC_JSON)
+    parser.add_argument("--compress", action="store_true",
+                        help="ask for stream compression (binary codec)")
+    parser.add_argument("--full-userlists", action="store_true",
+                        help="don't ask for presence deltas (older clients)")
+    parser.add_argument("--connect-concurrency", type=int, default=100,
+                        help="logins in flight at once")
+    parser.add_argument("--drain", type=float, default=2,
+                        help="seconds to wait for in-flight messages")
+    parser.add_argument("--server-pid", type=int,
+                        help="sample RSS of this server process (and children)")
+    parser.add_argument("--spawn", action="store_true",
+                        help="start run_server.py with a fresh database")
+    parser.add_argument("--engine", choices=["threaded", "asyncio"],
+                        default="threaded", help="engine for --spawn")
+    parser.add_argument("--server-arg", action="append", default=[],
+                        help="extra run_server.py argument for --spawn")
+    parser.add_argument("--output", help="write the results as JSON here")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    server = None
+    if args.spawn:
+        server = spawn_server(args)
+        args.server_pid = server.pid
+
+    try:
+        report = asyncio.run(Bench(args).run())
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    latency = report["latency"]
+    login = report["login"]
+    print(f"[Bench] sent {report['sent_per_second']}/s, "
+          f"delivered {report['delivered_per_second']}/s")
+    print(f"[Bench] latency p50 {latency['p50_ms']} ms, "
+          f"p99 {latency['p99_ms']} ms, p999 {latency['p999_ms']} ms")
+    print(f"[Bench] login p50 {login['p50_ms']} ms, p99 {login['p99_ms']} ms")
+    print(f"[Bench] server RSS max {report['server_rss_kb']['max']} KB")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
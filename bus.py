@@ -0,0 +1,385 @@
+import hmac
+import itertools
+import json
+import os
+import queue
+import socket
+import threading
+
+from outbound import SocketConnection, POLICY_BLOCK, mark_non_blocking
+from common import encode_json, FrameReader
+
+# Bus frames are internal and may carry whole messages plus user lists
+BUS_MAX_FRAME = 16 * 1024 * 1024
+
+# Frames a bus link may buffer before its sender waits (POLICY_BLOCK)
+BUS_QUEUE_SIZE = 65536
+BUS_BLOCK_TIMEOUT = 5.0
+
+# Seconds a worker waits for the hub to answer a request
+REQUEST_TIMEOUT = 5.0
+
+
+# =========================
+# Addresses
+# =========================
+
+def _bus_socket(address):
+    """
+    A str address is a Unix socket path, a (host, port) tuple is TCP.
+    """
+    if isinstance(address, str):
+        return socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return sock
+
+
+def _link(sock):
+    return SocketConnection(
+        sock,
+        maxsize=BUS_QUEUE_SIZE,
+        policy=POLICY_BLOCK,
+        block_timeout=BUS_BLOCK_TIMEOUT,
+    )
+
+
+# =========================
+# Hub
+# =========================
+
+class Hub:
+    """
+    Central state shared by every worker process or cluster node.
+
+    - owns the global username registry and presence version
+    - sequences chat messages: persist(message, scope, target, fanout)
+      stores a message, stamps its id and calls fanout(), after which the
+      message goes to every peer (each keeps its caches in step and
+      delivers to its own sockets)
+    - without persist (cluster broker) it only stamps ids; every node then
+      stores the messages it receives under those ids
+    - relays transient messages (system notices) to every peer
+    - applies PM delivery acks with `ack` when it stores messages, or
+      passes them on to every node when it does not
+
+    Peers are objects with sendall(bytes); the hub never blocks on one
+    beyond its link's queue policy. With a token, peers must present it in
+    their hello before anything else they send is accepted.
+    """
+
+    def __init__(self, persist=None, token=None, ack=None):
+        self.persist = persist
+        self.ack = ack
+        self.token = token
+        self._lock = threading.Lock()
+        self._publish_lock = threading.Lock()
+        self._peers = set()         # peers that completed their hello
+        self._owners = {}           # username -> peer
+        self._next_id = 1           # only used without persist
+        self.version = 1            # presence version, bumped on every change
+
+    # ---- peers ----
+
+    def detach(self, peer):
+        """
+        Forgets a peer and releases every username it held.
+        """
+        with self._lock:
+            self._peers.discard(peer)
+            lost = [u for u, p in self._owners.items() if p is peer]
+            for username in lost:
+                del self._owners[username]
+            if lost:
+                self.version += 1
+            event = self._presence()
+        if lost:
+            self._fanout(event)
+
+    def _presence(self):
+        # Caller holds self._lock
+        return {
+            "op": "presence",
+            "version": self.version,
+            "users": sorted(self._owners)
+        }
+
+    def _fanout(self, event):
+        frame = encode_json(event)
+        with self._lock:
+            peers = list(self._peers)
+        for peer in peers:
+            peer.sendall(frame)
+
+    # ---- requests ----
+
+    def handle(self, peer, msg):
+        """
+        Processes one frame from a peer.
+        """
+        op = msg.get("op")
+
+        if op == "hello":
+            self._hello(peer, msg)
+            return
+
+        with self._lock:
+            if peer not in self._peers:
+                return
+
+        if op == "publish":
+            self.publish(msg["message"], msg["scope"], msg.get("target"))
+
+        elif op == "relay":
+            self._fanout({"op": "relay", "message": msg["message"]})
+
+        elif op == "ack":
+            if self.ack is not None:
+                self.ack(msg["username"], msg.get("ids"))
+            else:
+                self._fanout({
+                    "op": "ack",
+                    "username": msg["username"],
+                    "ids": msg.get("ids")
+                })
+
+        elif op in ("claim", "release"):
+            with self._lock:
+                changed = False
+                ok = True
+                username = msg.get("username")
+
+                if op == "claim":
+                    ok = username not in self._owners
+                    if ok:
+                        self._owners[username] = peer
+                        changed = True
+                elif op == "release":
+                    if self._owners.get(username) is peer:
+                        del self._owners[username]
+                        changed = True
+
+                if changed:
+                    self.version += 1
+                event = self._presence()
+
+            reply = dict(event, op="reply", req=msg.get("req"), ok=ok)
+            peer.sendall(encode_json(reply))
+            if changed:
+                self._fanout(event)
+
+    def _hello(self, peer, msg):
+        ok = not self.token or hmac.compare_digest(
+            str(msg.get("token") or ""), self.token
+        )
+        if ok:
+            with self._publish_lock:
+                # A node may already hold messages newer than our counter
+                self._next_id = max(self._next_id, msg.get("last_id", 0) + 1)
+            with self._lock:
+                self._peers.add(peer)
+
+        with self._lock:
+            reply = dict(self._presence(), op="reply", req=msg.get("req"), ok=ok)
+        peer.sendall(encode_json(reply))
+
+    def publish(self, message, scope, target):
+        stored = self.persist is not None
+
+        def fanout():
+            self._fanout({
+                "op": "message",
+                "message": message,
+                "scope": scope,
+                "stored": stored
+            })
+
+        # Serialized so messages reach every peer in id order, whichever
+        # peer sent them
+        with self._publish_lock:
+            if stored:
+                self.persist(message, scope, target, fanout)
+            else:
+                message["id"] = self._next_id
+                self._next_id += 1
+                fanout()
+
+
+def serve_hub(hub, address):
+    """
+    Accepts worker links on `address` in a background thread.
+    """
+    if isinstance(address, str) and os.path.exists(address):
+        os.unlink(address)
+
+    listener = _bus_socket(address)
+    if not isinstance(address, str):
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(address)
+    listener.listen()
+
+    def accept_loop():
+        while True:
+            sock, _ = listener.accept()
+            threading.Thread(
+                target=_serve_peer, args=(hub, sock), daemon=True
+            ).start()
+
+    threading.Thread(target=accept_loop, daemon=True).start()
+    return listener
+
+
+def _serve_peer(hub, sock):
+    peer = _link(sock)
+    reader = FrameReader(sock, max_frame=BUS_MAX_FRAME)
+    try:
+        while True:
+            messages = reader.read_messages()
+            if messages is None:
+                break
+            for msg in messages:
+                hub.handle(peer, msg)
+    except Exception as e:
+        print(f"[Bus Error] {e}")
+    finally:
+        hub.detach(peer)
+        peer.close()
+
+
+# =========================
+# Worker side
+# =========================
+
+class BusClient:
+    """
+    A worker's link to the hub.
+
+    send() is fire-and-forget; request() waits for the hub's reply.
+    Everything the hub pushes is passed to on_event(event) from the reader
+    thread, in the order the hub sent it. on_close() runs if the link dies.
+    """
+
+    def __init__(self, address, on_event, on_close=None):
+        self.on_event = on_event
+        self.on_close = on_close
+
+        sock = _bus_socket(address)
+        sock.connect(address)
+        self._link = _link(sock)
+        self._reader = FrameReader(sock, max_frame=BUS_MAX_FRAME)
+
+        self._ids = itertools.count(1)
+        self._pending = {}          # req id -> [threading.Event, reply]
+        self._lock = threading.Lock()
+
+        threading.Thread(target=self._read_loop, daemon=True).start()
+
+    def send(self, op, **fields):
+        fields["op"] = op
+        self._link.sendall(encode_json(fields))
+
+    def request(self, op, **fields):
+        req = next(self._ids)
+        slot = [threading.Event(), None]
+        with self._lock:
+            self._pending[req] = slot
+
+        try:
+            self.send(op, req=req, **fields)
+            if not slot[0].wait(REQUEST_TIMEOUT):
+                raise TimeoutError(f"Bus request {op!r} timed out")
+        finally:
+            with self._lock:
+                self._pending.pop(req, None)
+        return slot[1]
+
+    def close(self):
+        self._link.close()
+
+    def _read_loop(self):
+        # Delivers to every local client; must not wait on a slow one
+        mark_non_blocking()
+        try:
+            while True:
+                messages = self._reader.read_messages()
+                if messages is None:
+                    break
+                for msg in messages:
+                    if msg.get("op") == "reply":
+                        with self._lock:
+                            slot = self._pending.get(msg.get("req"))
+                        if slot:
+                            slot[1] = msg
+                            slot[0].set()
+                        continue
+                    # One bad event must not cost the link (and the worker)
+                    try:
+                        self.on_event(msg)
+                    except Exception as e:
+                        print(f"[Bus Error] {msg.get('op')} event: {e}")
+        except Exception as e:
+            print(f"[Bus Error] {e}")
+        finally:
+            if self.on_close:
+                self.on_close()
+
+
+class LocalBroker:
+    """
+    In-process stand-in for BusClient: talks to a Hub object directly,
+    without sockets. Used when a node hosts the cluster broker itself, and
+    handy for tests. Same interface and event order as BusClient: replies
+    come back synchronously, pushed events on a dispatcher thread.
+    """
+
+    def __init__(self, hub, on_event, on_close=None):
+        self.hub = hub
+        self.on_event = on_event
+        self.on_close = on_close
+
+        self._ids = itertools.count(1)
+        self._replies = {}
+        self._events = queue.SimpleQueue()
+        threading.Thread(target=self._dispatch, daemon=True).start()
+
+    def sendall(self, data):
+        # Called by the hub, as for any other peer
+        msg = json.loads(data)
+        if msg.get("op") == "reply":
+            self._replies[msg.get("req")] = msg
+        else:
+            self._events.put(msg)
+
+    def send(self, op, **fields):
+        fields["op"] = op
+        self.hub.handle(self, fields)
+
+    def request(self, op, **fields):
+        req = next(self._ids)
+        self.send(op, req=req, **fields)
+        return self._replies.pop(req)
+
+    def close(self):
+        self.hub.detach(self)
+        self._events.put(None)
+
+    def _dispatch(self):
+        mark_non_blocking()
+        while True:
+            event = self._events.get()
+            if event is None:
+                break
+            try:
+                self.on_event(event)
+            except Exception as e:
+                print(f"[Bus Error] {e}")
+
+
+def connect(address, on_event, on_close=None):
+    """
+    Opens a link to a hub: in-process for a Hub object, otherwise over a
+    Unix socket path or a (host, port) tuple.
+    """
+    if isinstance(address, Hub):
+        return LocalBroker(address, on_event, on_close)
+    return BusClient(address, on_event, on_close)
@@ -1,7 +1,21 @@
+import bisect
 import tkinter as tk
+from collections import deque
 from tkinter import ttk, messagebox, scrolledtext
 import client_net
-from common import MSG_SYSTEM, MSG_GROUP, MSG_PRIVATE, MSG_HISTORY_RESPONSE, MSG_USERLIST
+from common import MSG_SYSTEM, MSG_GROUP, MSG_PRIVATE, MSG_CHANNEL, MSG_HISTORY_RESPONSE, MSG_USERLIST, MSG_PRESENCE, MSG_CONVERSATIONS, MSG_PENDING
+
+# Milliseconds between two refreshes of the chat view; messages arriving
+# in between are shown together
+RENDER_INTERVAL_MS = 50
+
+# Most queued messages handled per refresh, so a long history replay
+# spreads over several frames instead of freezing the window
+RENDER_BATCH_MAX = 2000
+
+# Lines kept in the chat view; older ones are dropped
+SCROLLBACK_LINES = 5000
+
 
 class ChatGUIAdvanced:
     def __init__(self, root):
@@ -12,6 +26,12 @@ class ChatGUIAdvanced:
 
         self.username = None
         self.online_users = set()
+        self.online = client_net.OnlineUsers()
+
+        # Filled by the receiver thread, emptied by _render() on the Tk
+        # thread: deque appends and pops are thread-safe
+        self._inbox = deque()
+        self._listed_users = []     # what the Listbox shows, sorted
 
         self._build_login_screen()
 
@@ -108,6 +128,8 @@ class ChatGUIAdvanced:
         # Disconnect button
         tk.Button(bottom, text="Disconnect", bg="#3a3a3a", fg="#eaeaea", relief="flat", command=self._disconnect).pack(side="right", padx=5)
 
+        self.root.after(RENDER_INTERVAL_MS, self._render)
+
     # =========================
     # Sending Messages
     # =========================
@@ -117,13 +139,26 @@ class ChatGUIAdvanced:
             return
 
         mode = self.mode_var.get()
-        if mode == "Group Chat":
+        if text.startswith(("/join ", "/leave ", "/c ")):
+            self._channel_command(text)
+        elif mode == "Group Chat":
             client_net.send_group_message(text)
         else:
             self._open_private_popup(text)
 
         self.msg_entry.delete(0, tk.END)
 
+    def _channel_command(self, text):
+        command, _, rest = text.partition(" ")
+        if command == "/c":
+            channel, _, body = rest.strip().partition(" ")
+            if body.strip():
+                client_net.send_channel_message(channel.lstrip("#"), body.strip())
+        elif command == "/join":
+            client_net.join_channel(rest.strip().lstrip("#"))
+        else:
+            client_net.leave_channel(rest.strip().lstrip("#"))
+
     def _open_private_popup(self, text):
         users = sorted(u for u in self.online_users if u != self.username)
         if not users:
@@ -156,73 +191,127 @@ class ChatGUIAdvanced:
     # Receiving Messages
     # =========================
     def _on_message(self, msg):
-        self.root.after(0, lambda: self._handle_message(msg))
-
-    def _handle_message(self, msg):
-        t = msg.get("type")
+        # Receiver thread: only queue, the Tk thread renders
+        self._inbox.append(msg)
 
-        if t == MSG_USERLIST:
-            users = msg.get("users", [])
-            self.online_users = set(users)
+    def _on_status(self, status, details):
+        self._inbox.append(f"[{status}] {details}\n")
+
+    def _render(self):
+        """
+        Applies the queued messages to the window: one insert into the
+        chat view and at most one user list update per refresh.
+        """
+        lines = []
+        users_changed = False
+        for _ in range(min(len(self._inbox), RENDER_BATCH_MAX)):
+            item = self._inbox.popleft()
+            if isinstance(item, str):
+                lines.append(item)
+                continue
+            if item.get("type") in (MSG_USERLIST, MSG_PRESENCE):
+                # Snapshots and deltas both go through the tracker
+                users_changed |= self.online.apply(item)
+                continue
+            text = self._format_message(item)
+            if text:
+                lines.append(text)
+
+        if lines:
+            self._append_text("".join(lines))
+        if users_changed:
+            self.online_users = self.online.users
             self._update_user_list()
-            return
 
+        self.root.after(RENDER_INTERVAL_MS, self._render)
+
+    def _format_message(self, msg):
+        t = msg.get("type")
 
         if t == MSG_SYSTEM:
-            text = msg.get("text", "")
-            self._append_text(f"* {text} *\n")
-            # Update online users
-            if "joined the chat" in text:
-                user = text.split(" joined the chat")[0].strip()
-                self.online_users.add(user)
-            if "left the chat" in text:
-                user = text.split(" left the chat")[0].strip()
-                self.online_users.discard(user)
-            self._update_user_list()
-            return
+            prefix = f"[#{msg['channel']}] " if msg.get("channel") else ""
+            return f"{prefix}* {msg.get('text', '')} *\n"
 
         if t == MSG_GROUP:
-            sender = msg.get("from")
-            self.online_users.add(sender)
-            self._append_text(f"{sender}: {msg.get('text')}\n")
-            self._update_user_list()
-            return
+            return f"{msg.get('from')}: {msg.get('text')}\n"
 
         if t == MSG_PRIVATE:
-            sender = msg.get("from")
-            self.online_users.add(sender)
-            self._append_text(f"[PM] {sender}: {msg.get('text')}\n")
-            self._update_user_list()
-            return
+            return f"[PM] {msg.get('from')}: {msg.get('text')}\n"
+
+        if t == MSG_CHANNEL:
+            return f"[#{msg.get('channel')}] {msg.get('from')}: {msg.get('text')}\n"
 
         if t == MSG_HISTORY_RESPONSE:
-            scope = msg.get("scope")
+            lines = []
             for item in msg.get("messages", []):
+                # Rows of a "resume" page carry their own scope
+                scope = item.get("scope") or msg.get("scope")
                 sender = item.get("sender")
                 text = item.get("text")
                 if scope == "group":
-                    self._append_text(f"{sender}: {text}\n")
+                    lines.append(f"{sender}: {text}\n")
                 elif scope == "pm":
-                    target = item.get("target")
-                    self._append_text(f"[PM] {sender} -> {target}: {text}\n")
-            self._append_text("\n")
-
-    def _on_status(self, status, details):
-        self.root.after(0, lambda: self._append_text(f"[{status}] {details}\n"))
+                    lines.append(f"[PM] {sender} -> {item.get('target')}: {text}\n")
+                elif scope == "channel":
+                    lines.append(f"[#{item.get('target')}] {sender}: {text}\n")
+            lines.append("\n")
+            return "".join(lines)
+
+        if t == MSG_PENDING:
+            return "".join(
+                f"[PM] {item.get('sender')}: {item.get('text')}\n"
+                for item in msg.get("messages", [])
+            )
+
+        if t == MSG_CONVERSATIONS:
+            lines = [
+                f"[PM] {item.get('sender')} -> {item.get('target')}: {item.get('text')}\n"
+                for conv in msg.get("conversations", [])
+                for item in conv.get("messages", [])
+            ]
+            lines.append("\n")
+            return "".join(lines)
+
+        return None
 
     # =========================
     # Helpers
     # =========================
     def _append_text(self, text):
+        # Only follow new messages if the user has not scrolled up
+        at_bottom = self.chat_display.yview()[1] >= 1.0
         self.chat_display.config(state="normal")
         self.chat_display.insert(tk.END, text)
-        self.chat_display.see(tk.END)
+        excess = int(self.chat_display.index("end-1c").split(".")[0]) - SCROLLBACK_LINES
+        if excess > 0:
+            self.chat_display.delete("1.0", f"{excess + 1}.0")
+        if at_bottom:
+            self.chat_display.see(tk.END)
         self.chat_display.config(state="disabled")
 
     def _update_user_list(self):
-        self.user_listbox.delete(0, tk.END)
-        for u in sorted(self.online_users):
-            self.user_listbox.insert(tk.END, u)
+        """
+        Patches the Listbox with the users who joined or left since the
+        last update instead of rebuilding it.
+        """
+        listed = self._listed_users
+        current = self.online_users
+        shown = set(listed)
+        if len(shown ^ current) > len(listed) // 2:
+            # Mostly new (the login snapshot): one bulk insert is cheaper
+            self._listed_users = sorted(current)
+            self.user_listbox.delete(0, tk.END)
+            self.user_listbox.insert(tk.END, *self._listed_users)
+            return
+
+        for u in shown - current:
+            i = bisect.bisect_left(listed, u)
+            del listed[i]
+            self.user_listbox.delete(i)
+        for u in sorted(current - shown):
+            i = bisect.bisect_left(listed, u)
+            listed.insert(i, u)
+            self.user_listbox.insert(i, u)
 
     def _disconnect(self):
         client_net.disconnect()
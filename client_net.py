@@ -1,243 +1,904 @@
+import asyncio
+import random
 import socket
 import threading
+from collections import deque
 
 from common import (
     send_json,
-    recv_json,
     current_timestamp,
+    FrameReader,
+    CODECS,
+    CODEC_JSON,
+    JSON_CODEC,
+    COMPRESSION_DEFLATE,
+    FrameCompressor,
     MSG_LOGIN,
     MSG_LOGIN_OK,
     MSG_ERROR,
     MSG_GROUP,
     MSG_PRIVATE,
+    MSG_CHANNEL,
+    MSG_JOIN,
+    MSG_LEAVE,
+    MSG_HISTORY_REQUEST,
+    MSG_HISTORY_RESPONSE,
+    MSG_CONVERSATIONS,
+    MSG_PENDING,
+    MSG_ACK,
+    MSG_SEARCH,
+    MSG_ADMIN,
+    MSG_USERLIST,
+    MSG_PRESENCE,
+    MSG_USERS_REQUEST,
+    PRESENCE_DELTA,
+    DELIVERY_ACK,
+    ACK_MAX,
 )
 
-# =========================
-# Internal client state
-# =========================
+# Bytes asked for per read by AsyncClient
+READ_CHUNK = 65536
 
-_sock = None
-_receiver_thread = None
-_stop_event = threading.Event()
-_is_connected = False
+# Reconnect delays grow from RECONNECT_BASE to RECONNECT_MAX seconds; each
+# one is drawn at random below that bound, so clients dropped together by
+# a restart come back spread out instead of in one wave
+RECONNECT_BASE = 0.5
+RECONNECT_MAX = 30.0
 
-_on_message = None   # callback(msg_dict)
-_on_status = None    # callback(status_str, details_str_optional)
+# Message ids remembered to drop duplicates after a resume
+RECENT_IDS = 4096
 
-_state_lock = threading.Lock()
+# Live chat messages, the ones that carry ids
+_CHAT_TYPES = (MSG_GROUP, MSG_PRIVATE, MSG_CHANNEL)
 
 
-# =========================
-# Small internal helpers
-# =========================
-
-def _set_status(status, details=""):
+def reconnect_delay(attempt):
     """
-    Calls the status callback if provided.
-    status examples: 'connected', 'disconnected', 'error', 'info'
+    Seconds to wait before reconnect attempt `attempt` (0 for the first):
+    exponential backoff with full jitter.
     """
-    if _on_status:
-        try:
-            _on_status(status, details)
-        except Exception:
-            # Never let UI/CLI callback errors crash networking
-            pass
+    return random.uniform(0, min(RECONNECT_MAX, RECONNECT_BASE * 2 ** attempt))
 
 
-def _safe_close_socket():
-    global _sock
-    if _sock is not None:
-        try:
-            _sock.shutdown(socket.SHUT_RDWR)
-        except Exception:
-            pass
-        try:
-            _sock.close()
-        except Exception:
-            pass
-        _sock = None
+def _login_request(username, codec, compress, last_id=None):
+    request = {
+        "type": MSG_LOGIN,
+        "username": username,
+        "codec": codec,
+        "compress": COMPRESSION_DEFLATE if compress else None,
+        "presence": PRESENCE_DELTA,
+        "delivery": DELIVERY_ACK,
+        "ts": current_timestamp()
+    }
+    if last_id is not None:
+        request["last_id"] = last_id
+    return request
+
+
+def _login_error(reply):
+    """
+    Returns why a login reply is a rejection, or None for login_ok.
+    """
+    if reply is None:
+        return "Server closed connection during login"
+    if reply.get("type") == MSG_ERROR:
+        return reply.get("message", "Login rejected")
+    if reply.get("type") != MSG_LOGIN_OK:
+        return f"Unexpected login reply: {reply}"
+    return None
 
 
 # =========================
-# Public API
+# Requests and resume state
 # =========================
 
-def connect(server_ip, port, username, on_message=None, on_status=None, timeout=8):
+class _ClientBase:
     """
-    Connects to the server and performs login.
-    Starts a background receiver thread.
-
-    Parameters:
-      - server_ip, port: where the server is running
-      - username: desired username (must be unique)
-      - on_message: function(msg_dict) called when a message arrives
-      - on_status: function(status, details) called for connection events
-      - timeout: socket timeout for initial connect
+    The protocol requests and the resume state, shared by Client and
+    AsyncClient. Subclasses provide _send_simple(message, action), which
+    sends one message and returns True, or reports the failure through
+    on_status and returns False.
+
+    A client remembers the newest message id it has seen and the channels
+    it joined. After a reconnect it logs in with that id and rejoins its
+    channels from it, so the server only sends what was missed. Messages
+    that arrive twice around a resume are dropped by id.
+
+    PMs addressed to the client are acknowledged once they were handed to
+    on_message, one MSG_ACK per read; the server delivers the unacked ones
+    again (MSG_PENDING) at the next login.
     """
-    global _sock, _receiver_thread, _is_connected, _on_message, _on_status
-
-    _on_message = on_message
-    _on_status = on_status
-
-    # Reset stop flag if reused
-    _stop_event.clear()
-
-    # Create socket + connect
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    s.settimeout(timeout)
-    try:
-        s.connect((server_ip, int(port)))
-    except Exception as e:
-        _safe_close_socket()
-        _set_status("error", f"Failed to connect: {e}")
+
+    def _reset_resume(self):
+        self.last_id = None
+        self.channels = set()
+        self._recent = set()
+        self._recent_order = deque()
+        self._to_ack = []
+
+    def _seen(self, msg_id):
+        # Remembers msg_id; True if it was already there
+        if msg_id in self._recent:
+            return True
+        self._recent.add(msg_id)
+        self._recent_order.append(msg_id)
+        if len(self._recent_order) > RECENT_IDS:
+            self._recent.discard(self._recent_order.popleft())
         return False
-    finally:
-        # After connect, go back to blocking mode for normal reads
-        try:
-            s.settimeout(None)
-        except Exception:
-            pass
 
-    _sock = s
+    def _raise_last_id(self, msg_id):
+        if isinstance(msg_id, int) and (self.last_id is None or msg_id > self.last_id):
+            self.last_id = msg_id
+
+    def _track(self, msg):
+        """
+        Updates the resume state from one received message. Returns False
+        for a duplicate that should not be handed to on_message.
+        """
+        msg_type = msg.get("type")
+
+        if msg_type in _CHAT_TYPES and msg.get("id") is not None:
+            if msg_type == MSG_PRIVATE and msg.get("target") == self.username:
+                # Acked even as a duplicate: the copy that was shown may
+                # have been acked on a connection that is gone
+                self._to_ack.append(msg["id"])
+            if self._seen(msg["id"]):
+                return False
+            self._raise_last_id(msg["id"])
+
+        elif msg_type == MSG_PENDING:
+            rows = msg.get("messages") or []
+            self._to_ack.extend(
+                row["id"] for row in rows if isinstance(row.get("id"), int)
+            )
+            rows = msg["messages"] = [
+                row for row in rows
+                if row.get("id") is None or not self._seen(row["id"])
+            ]
+            for row in rows:
+                self._raise_last_id(row.get("id"))
+
+        elif msg_type == MSG_HISTORY_RESPONSE:
+            rows = msg.get("messages") or []
+            if msg.get("after") is not None:
+                # Missed messages: some may also have arrived live
+                rows = msg["messages"] = [
+                    row for row in rows
+                    if row.get("id") is None or not self._seen(row["id"])
+                ]
+            for row in rows:
+                self._raise_last_id(row.get("id"))
+
+        elif msg_type == MSG_CONVERSATIONS:
+            for conv in msg.get("conversations") or []:
+                self._raise_last_id(conv.get("last_id"))
+                # The same PMs may come again from the pending queue
+                for row in conv.get("messages") or []:
+                    if row.get("id") is not None:
+                        self._seen(row["id"])
+
+        return True
 
-    # Send login
-    try:
-        send_json(_sock, {
-            "type": MSG_LOGIN,
-            "username": username,
+    def _send_acks(self):
+        ids, self._to_ack = self._to_ack, []
+        for start in range(0, len(ids), ACK_MAX):
+            self._send_simple({
+                "type": MSG_ACK,
+                "ids": ids[start:start + ACK_MAX]
+            }, "acknowledge")
+
+    def _rejoin(self, after):
+        for channel in sorted(self.channels):
+            request = {"type": MSG_JOIN, "channel": channel}
+            if after is not None:
+                request["after"] = after
+            self._send_simple(request, "rejoin channel")
+
+    def send_group_message(self, text):
+        """
+        Sends a group chat message to the server.
+        """
+        return self._send_simple({
+            "type": MSG_GROUP,
+            "text": text,
             "ts": current_timestamp()
-        })
-    except Exception as e:
-        _safe_close_socket()
-        _set_status("error", f"Failed to send login: {e}")
-        return False
+        }, "send group message")
 
-    # Wait for login_ok or error (server replies immediately)
-    try:
-        reply = recv_json(_sock)
-    except Exception as e:
-        _safe_close_socket()
-        _set_status("error", f"Failed to read login reply: {e}")
-        return False
+    def send_private_message(self, target, text):
+        """
+        Sends a private message to a specific user via the server.
+        """
+        return self._send_simple({
+            "type": MSG_PRIVATE,
+            "target": target,
+            "text": text,
+            "ts": current_timestamp()
+        }, "send private message")
+
+    def join_channel(self, channel):
+        """
+        Subscribes to a channel. The server answers with the channel's recent
+        history (a history_response) and announces the join to its members.
+        """
+        self.channels.add(channel)
+        return self._send_simple({"type": MSG_JOIN, "channel": channel}, "join channel")
+
+    def leave_channel(self, channel):
+        """
+        Unsubscribes from a channel.
+        """
+        self.channels.discard(channel)
+        return self._send_simple({"type": MSG_LEAVE, "channel": channel}, "leave channel")
+
+    def send_channel_message(self, channel, text):
+        """
+        Sends a message to a channel this client has joined.
+        """
+        return self._send_simple({
+            "type": MSG_CHANNEL,
+            "channel": channel,
+            "text": text,
+            "ts": current_timestamp()
+        }, "send channel message")
+
+    def request_history(self, scope="group", with_user=None, before=None,
+                        limit=50, channel=None):
+        """
+        Asks the server for older messages: `limit` messages before the message
+        id `before` (the newest ones when None), for the group, for the PM
+        conversation with `with_user` or for a joined `channel`. The page
+        arrives as a history_response.
+        """
+        request = {
+            "type": MSG_HISTORY_REQUEST,
+            "scope": scope,
+            "limit": limit,
+            "ts": current_timestamp()
+        }
+        if before is not None:
+            request["before"] = before
+        if with_user:
+            request["with"] = with_user
+        if channel:
+            request["channel"] = channel
+        return self._send_simple(request, "request history")
+
+    def search(self, query, scope=None, sender=None, with_user=None,
+               channel=None, since=None, until=None, offset=0, limit=20):
+        """
+        Searches the messages this user may read for `query` (every word must
+        match, "word*" matches a prefix), optionally only in one scope, from
+        one sender, with one PM partner, in one joined channel or between two
+        timestamps. Results arrive best match first as search_results; ask for
+        the next page with offset + limit while has_more is set.
+        """
+        request = {
+            "type": MSG_SEARCH,
+            "query": query,
+            "offset": offset,
+            "limit": limit
+        }
+        filters = {
+            "scope": scope,
+            "from": sender,
+            "with": with_user,
+            "channel": channel,
+            "since": since,
+            "until": until,
+        }
+        request.update((k, v) for k, v in filters.items() if v is not None)
+        return self._send_simple(request, "search")
+
+    def request_users(self, query=None, after=None, limit=100):
+        """
+        Asks for one page of the online list: users after the name `after`,
+        only those containing `query` if given. Without either, the answer is
+        a fresh snapshot. The page arrives as a userlist message.
+        """
+        request = {
+            "type": MSG_USERS_REQUEST,
+            "limit": limit
+        }
+        if query:
+            request["query"] = query
+        if after is not None:
+            request["after"] = after
+        return self._send_simple(request, "request users")
+
+    def admin_command(self, command, token):
+        """
+        Sends an operator command ("stats", "metrics", "profile_start" or
+        "profile_stop"); the result arrives as an admin_response, or an error
+        if the token is wrong.
+        """
+        return self._send_simple({
+            "type": MSG_ADMIN,
+            "command": command,
+            "token": token
+        }, "send admin command")
 
-    if reply is None:
-        _safe_close_socket()
-        _set_status("error", "Server closed connection during login")
-        return False
 
-    if reply.get("type") == MSG_ERROR:
-        _safe_close_socket()
-        _set_status("error", reply.get("message", "Login rejected"))
-        return False
+# =========================
+# Threaded client
+# =========================
 
-    if reply.get("type") != MSG_LOGIN_OK:
-        _safe_close_socket()
-        _set_status("error", f"Unexpected login reply: {reply}")
-        return False
+class Client(_ClientBase):
+    """
+    One connection to the server, read by its own background thread.
 
-    # Mark connected
-    with _state_lock:
-        _is_connected = True
+    on_message(msg_dict) and on_status(status, details) are called from
+    that thread. Sending is thread-safe. Each instance is independent, so
+    a process can hold as many as it has threads for; see AsyncClient for
+    thousands.
 
-    _set_status("connected", f"Logged in as {reply.get('username', username)}")
+    With reconnect (the default), a lost connection is retried with
+    jittered backoff until it is back or disconnect() is called; status
+    "reconnecting" reports each wait.
+    """
 
-    # Start receiver thread
-    _receiver_thread = threading.Thread(target=receive_loop, daemon=True)
-    _receiver_thread.start()
+    def __init__(self, on_message=None, on_status=None):
+        self.username = None
+        self._sock = None
+        self._reader = None
+        self._codec = JSON_CODEC
+        self._compressor = None
+        self._send_lock = threading.Lock()    # keeps compressed frames in stream order
+        self._receiver_thread = None
+        self._stop_event = threading.Event()
+        self._is_connected = False
+        self._state_lock = threading.Lock()
+        self._params = None
+        self._reconnect = False
+        self._reset_resume()
+
+        self._on_message = on_message   # callback(msg_dict)
+        self._on_status = on_status     # callback(status_str, details_str_optional)
+
+    def _set_status(self, status, details=""):
+        """
+        Calls the status callback if provided.
+        status examples: 'connected', 'disconnected', 'reconnecting',
+        'error', 'info'
+        """
+        if self._on_status:
+            try:
+                self._on_status(status, details)
+            except Exception:
+                # Never let UI/CLI callback errors crash networking
+                pass
 
-    return True
+    def _safe_close_socket(self, sock=None):
+        # Closes `sock` (the current socket by default); a receiver thread
+        # left over from an earlier connection only ever closes its own
+        if sock is None:
+            sock = self._sock
+        if sock is None:
+            return
+        if sock is self._sock:
+            self._sock = None
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except Exception:
+            pass
+        try:
+            sock.close()
+        except Exception:
+            pass
 
+    def _send(self, data):
+        frame = self._codec.encode(data)
+        with self._send_lock:
+            if self._compressor is not None:
+                frame = self._compressor.compress(frame)
+            self._sock.sendall(frame)
 
-def receive_loop():
-    """
-    Continuously receives messages from the server in a background thread.
-    Calls the on_message callback for each received message.
-    """
-    global _is_connected
+    def _send_simple(self, message, action):
+        if not self.is_connected():
+            self._set_status("error", "Not connected")
+            return False
 
-    while not _stop_event.is_set():
         try:
-            msg = recv_json(_sock)
+            self._send(message)
+            return True
         except Exception as e:
-            _set_status("error", f"Receive error: {e}")
-            msg = None
-
-        if msg is None:
-            # Disconnected (or error)
-            break
-
-        if _on_message:
+            self._set_status("error", f"Failed to {action}: {e}")
+            return False
+
+    def connect(self, server_ip, port, username, on_message=None,
+                on_status=None, timeout=8, codec=CODEC_JSON, compress=False,
+                reconnect=True):
+        """
+        Connects to the server and performs login.
+        Starts a background receiver thread.
+
+        Parameters:
+          - server_ip, port: where the server is running
+          - username: desired username (must be unique)
+          - on_message: function(msg_dict) called when a message arrives
+          - on_status: function(status, details) called for connection events
+          - timeout: socket timeout for initial connect
+          - codec: wire codec to ask for ("json" or the compact "binary")
+          - compress: ask for deflate stream compression (binary codec only)
+          - reconnect: reconnect automatically when the connection drops
+        """
+        if self.is_connected():
+            self.disconnect()
+        # Stops a reconnect loop still waiting from an earlier session
+        self._stop_event.set()
+
+        if on_message is not None:
+            self._on_message = on_message
+        if on_status is not None:
+            self._on_status = on_status
+        if username != self.username:
+            self._reset_resume()
+
+        self._params = (server_ip, port, username, timeout, codec, compress)
+        self._reconnect = reconnect
+        self._stop_event = threading.Event()
+        return self._open(self._stop_event)
+
+    def _open(self, stop_event):
+        """
+        One connection attempt with the parameters of the last connect().
+        A client that saw messages before logs in with the newest id, to
+        get only what it missed.
+        """
+        server_ip, port, username, timeout, codec, compress = self._params
+        resume_from = self.last_id
+
+        # Create socket + connect
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.settimeout(timeout)
+        try:
+            s.connect((server_ip, int(port)))
+        except Exception as e:
+            self._safe_close_socket(s)
+            self._set_status("error", f"Failed to connect: {e}")
+            return False
+        finally:
+            # After connect, go back to blocking mode for normal reads
             try:
-                _on_message(msg)
+                s.settimeout(None)
             except Exception:
-                # Never let callback issues kill receiver thread
                 pass
 
-    with _state_lock:
-        _is_connected = False
+        reader = FrameReader(s)
 
-    _safe_close_socket()
-    _set_status("disconnected", "Connection closed")
+        # Send login (always as JSON, the codec switch happens after login_ok)
+        try:
+            send_json(s, _login_request(username, codec, compress, resume_from))
+        except Exception as e:
+            self._safe_close_socket(s)
+            self._set_status("error", f"Failed to send login: {e}")
+            return False
 
+        # Wait for login_ok or error (server replies immediately)
+        try:
+            reply = reader.read_message()
+        except Exception as e:
+            self._safe_close_socket(s)
+            self._set_status("error", f"Failed to read login reply: {e}")
+            return False
+
+        error = _login_error(reply)
+        if error:
+            self._safe_close_socket(s)
+            self._set_status("error", error)
+            return False
+
+        # Older servers don't negotiate and keep talking JSON
+        codec = CODECS.get(reply.get("codec"), JSON_CODEC)
+        reader.set_codec(codec)
+        compressor = None
+        if reply.get("compress") == COMPRESSION_DEFLATE:
+            reader.enable_compression()
+            compressor = FrameCompressor()
+
+        # Mark connected, unless disconnect() came in meanwhile
+        with self._state_lock:
+            if stop_event.is_set():
+                self._safe_close_socket(s)
+                return False
+            self._sock = s
+            self._reader = reader
+            self._codec = codec
+            self._compressor = compressor
+            self._is_connected = True
+        self.username = reply.get("username", username)
+
+        self._set_status("connected", f"Logged in as {self.username}")
+
+        # Start receiver thread
+        self._receiver_thread = threading.Thread(
+            target=self.receive_loop, args=(s, reader, stop_event),
+            daemon=True
+        )
+        self._receiver_thread.start()
+
+        self._rejoin(resume_from)
+        return True
 
-def send_group_message(text):
-    """
-    Sends a group chat message to the server.
-    """
-    if not is_connected():
-        _set_status("error", "Not connected")
-        return False
+    def receive_loop(self, sock, reader, stop_event):
+        """
+        Continuously receives messages from the server in a background thread.
+        Calls the on_message callback for each received message, and
+        reconnects if the connection is lost.
+        """
+        while not stop_event.is_set():
+            try:
+                messages = reader.read_messages()
+            except Exception as e:
+                if not stop_event.is_set():
+                    self._set_status("error", f"Receive error: {e}")
+                messages = None
+
+            if messages is None:
+                # Disconnected (or error)
+                break
+
+            for msg in messages:
+                if not self._track(msg):
+                    continue
+                if self._on_message:
+                    try:
+                        self._on_message(msg)
+                    except Exception:
+                        # Never let callback issues kill receiver thread
+                        pass
+            self._send_acks()
+
+        if stop_event.is_set():
+            # disconnect() already cleaned up and reported it
+            return
+
+        with self._state_lock:
+            if self._sock is sock:
+                self._is_connected = False
+
+        self._safe_close_socket(sock)
+
+        if not self._reconnect:
+            self._set_status("disconnected", "Connection closed")
+            return
+
+        self._set_status("disconnected", "Connection lost")
+        attempt = 0
+        while True:
+            delay = reconnect_delay(attempt)
+            self._set_status("reconnecting", f"Retrying in {delay:.1f}s")
+            if stop_event.wait(delay) or self._open(stop_event):
+                return
+            attempt += 1
+
+    def disconnect(self):
+        """
+        Disconnects gracefully from the server.
+        """
+        with self._state_lock:
+            self._stop_event.set()
+            self._is_connected = False
+
+        self._safe_close_socket()
+        self._set_status("disconnected", "Disconnected by user")
+
+    def is_connected(self):
+        """
+        Returns True if the client is currently connected.
+        """
+        with self._state_lock:
+            return bool(self._is_connected)
 
-    try:
-        send_json(_sock, {
-            "type": MSG_GROUP,
-            "text": text,
-            "ts": current_timestamp()
-        })
-        return True
-    except Exception as e:
-        _set_status("error", f"Failed to send group message: {e}")
-        return False
 
+# =========================
+# Asyncio client
+# =========================
 
-def send_private_message(target, text):
+class AsyncClient(_ClientBase):
     """
-    Sends a private message to a specific user via the server.
+    One connection to the server on an asyncio event loop: many of them
+    share one loop and one thread, which is what bots and load tests need.
+
+    connect() and disconnect() are coroutines. The request methods are
+    the same as Client's and return True or False right away: they only
+    append the frame to the stream's buffer, so call them from the loop
+    and await drain() now and then to let the socket catch up.
+    on_message may be a plain function or a coroutine function. Lost
+    connections are retried like Client's.
     """
-    if not is_connected():
-        _set_status("error", "Not connected")
-        return False
 
-    try:
-        send_json(_sock, {
-            "type": MSG_PRIVATE,
-            "target": target,
-            "text": text,
-            "ts": current_timestamp()
-        })
+    def __init__(self, on_message=None, on_status=None):
+        self.username = None
+        self._reader = None
+        self._writer = None
+        self._frames = None
+        self._codec = JSON_CODEC
+        self._compressor = None
+        self._task = None
+        self._is_connected = False
+        self._params = None
+        self._reconnect = False
+        self._reset_resume()
+
+        self._on_message = on_message
+        self._on_status = on_status
+
+    def _set_status(self, status, details=""):
+        if self._on_status:
+            try:
+                self._on_status(status, details)
+            except Exception:
+                pass
+
+    def _send_simple(self, message, action):
+        if not self._is_connected:
+            self._set_status("error", "Not connected")
+            return False
+
+        try:
+            frame = self._codec.encode(message)
+            if self._compressor is not None:
+                frame = self._compressor.compress(frame)
+            self._writer.write(frame)
+            return True
+        except Exception as e:
+            self._set_status("error", f"Failed to {action}: {e}")
+            return False
+
+    async def drain(self):
+        """
+        Waits until the stream's write buffer is below its high-water mark.
+        """
+        if self._writer is not None:
+            await self._writer.drain()
+
+    async def connect(self, server_ip, port, username, on_message=None,
+                      on_status=None, timeout=8, codec=CODEC_JSON,
+                      compress=False, reconnect=True):
+        """
+        Connects and logs in like Client.connect(), then reads in a task on
+        the running loop. Returns True once logged in.
+        """
+        if self._is_connected:
+            await self.disconnect()
+        self._cancel_task()
+
+        if on_message is not None:
+            self._on_message = on_message
+        if on_status is not None:
+            self._on_status = on_status
+        if username != self.username:
+            self._reset_resume()
+
+        self._params = (server_ip, port, username, timeout, codec, compress)
+        self._reconnect = reconnect
+        return await self._open()
+
+    async def _open(self):
+        server_ip, port, username, timeout, codec, compress = self._params
+        resume_from = self.last_id
+
+        try:
+            self._reader, self._writer = await asyncio.wait_for(
+                asyncio.open_connection(server_ip, int(port)), timeout
+            )
+        except (OSError, asyncio.TimeoutError) as e:
+            self._set_status("error", f"Failed to connect: {e}")
+            return False
+
+        self._frames = FrameReader()
+        self._codec = JSON_CODEC
+        self._compressor = None
+
+        try:
+            self._writer.write(JSON_CODEC.encode(
+                _login_request(username, codec, compress, resume_from)
+            ))
+            reply = await asyncio.wait_for(self._read_login_reply(), timeout)
+        except Exception as e:
+            await self._close_writer()
+            self._set_status("error", f"Failed to read login reply: {e}")
+            return False
+
+        error = _login_error(reply)
+        if error:
+            await self._close_writer()
+            self._set_status("error", error)
+            return False
+
+        self._codec = CODECS.get(reply.get("codec"), JSON_CODEC)
+        self._frames.set_codec(self._codec)
+        if reply.get("compress") == COMPRESSION_DEFLATE:
+            self._frames.enable_compression()
+            self._compressor = FrameCompressor()
+
+        self._is_connected = True
+        self.username = reply.get("username", username)
+        self._set_status("connected", f"Logged in as {self.username}")
+
+        # Whatever arrived behind login_ok is split with the new codec
+        pending = self._frames.decode(self._frames.feed())
+        self._task = asyncio.create_task(self._receive_loop(pending))
+        self._rejoin(resume_from)
         return True
-    except Exception as e:
-        _set_status("error", f"Failed to send private message: {e}")
-        return False
 
+    async def _read_login_reply(self):
+        # Only cut the reply itself: the frames behind it may already use
+        # the negotiated codec
+        frames = []
+        while not frames:
+            chunk = await self._reader.read(READ_CHUNK)
+            if not chunk:
+                return None
+            frames = self._frames.feed(chunk, limit=1)
+        return JSON_CODEC.decode(frames[0])
+
+    async def _deliver(self, messages):
+        for msg in messages:
+            if not self._track(msg):
+                continue
+            if self._on_message:
+                try:
+                    result = self._on_message(msg)
+                    if asyncio.iscoroutine(result):
+                        await result
+                except Exception:
+                    pass
+        self._send_acks()
+
+    async def _receive_loop(self, pending):
+        try:
+            await self._deliver(pending)
+            while True:
+                chunk = await self._reader.read(READ_CHUNK)
+                if not chunk:
+                    break
+                await self._deliver(self._frames.decode(self._frames.feed(chunk)))
+        except Exception as e:
+            self._set_status("error", f"Receive error: {e}")
+
+        self._is_connected = False
+        await self._close_writer()
+
+        if not self._reconnect:
+            self._set_status("disconnected", "Connection closed")
+            return
+
+        self._set_status("disconnected", "Connection lost")
+        attempt = 0
+        while True:
+            delay = reconnect_delay(attempt)
+            self._set_status("reconnecting", f"Retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+            if await self._open():
+                return
+            attempt += 1
+
+    async def _close_writer(self):
+        writer, self._writer = self._writer, None
+        if writer is None:
+            return
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except (OSError, ConnectionError):
+            pass
 
-def disconnect():
-    """
-    Disconnects gracefully from the server.
-    """
-    global _is_connected
-    _stop_event.set()
+    def _cancel_task(self):
+        task, self._task = self._task, None
+        if task is not None and task is not asyncio.current_task():
+            task.cancel()
 
-    with _state_lock:
-        _is_connected = False
+    async def disconnect(self):
+        """
+        Disconnects gracefully from the server.
+        """
+        self._is_connected = False
+        self._cancel_task()
+        await self._close_writer()
+        self._set_status("disconnected", "Disconnected by user")
 
-    _safe_close_socket()
-    _set_status("disconnected", "Disconnected by user")
+    def is_connected(self):
+        return self._is_connected
 
 
-def is_connected():
+# =========================
+# Module-level API
+# =========================
+
+# The functions below drive one default Client, for the CLI and the GUI
+_default = Client()
+
+connect = _default.connect
+send_group_message = _default.send_group_message
+send_private_message = _default.send_private_message
+join_channel = _default.join_channel
+leave_channel = _default.leave_channel
+send_channel_message = _default.send_channel_message
+request_history = _default.request_history
+search = _default.search
+request_users = _default.request_users
+admin_command = _default.admin_command
+disconnect = _default.disconnect
+is_connected = _default.is_connected
+
+
+# =========================
+# Online users
+# =========================
+
+class OnlineUsers:
     """
-    Returns True if the client is currently connected.
+    The online list as the server announces it, for the CLI and GUI.
+
+    Feed every userlist and presence message to apply(). Login snapshots
+    and pages replace or extend the list, presence deltas patch it. A
+    delta that skips versions (frames dropped by a full queue on the
+    server) triggers a snapshot request. Search results (userlists with a
+    query) are left alone.
+
+    Resync requests go through `client` (the default Client if None).
+    Not thread-safe: call it from one thread (the receiver or the UI).
     """
-    with _state_lock:
-        return bool(_is_connected)
+
+    def __init__(self, client=None):
+        self.client = client
+        self.users = set()
+        self.count = 0              # users online on the server
+        self.has_more = False       # the server holds more than we listed
+        self.version = None
+        self._cursor = None         # last name of the newest page
+        self._resyncing = False
+
+    def apply(self, msg):
+        """
+        Returns True if the set of users changed.
+        """
+        msg_type = msg.get("type")
+
+        if msg_type == MSG_USERLIST:
+            if msg.get("query"):
+                return False
+            users = msg.get("users", [])
+            if msg.get("after") is None:
+                changed = self.users != set(users)
+                self.users = set(users)
+                self._resyncing = False
+            else:
+                changed = not self.users.issuperset(users)
+                self.users.update(users)
+            if users:
+                self._cursor = users[-1]
+            self.version = msg.get("version", self.version)
+            self.count = msg.get("count", len(self.users))
+            self.has_more = msg.get("has_more", False)
+            return changed
+
+        if msg_type == MSG_PRESENCE:
+            if self.version is not None and msg["version"] <= self.version:
+                return False
+            if self.version is None or msg["since"] > self.version:
+                if not self._resyncing:
+                    self._resyncing = True
+                    (self.client or _default).request_users()
+                return False
+
+            before = len(self.users)
+            joined = set(msg.get("joined", [])) - self.users
+            self.users.update(joined)
+            self.users.difference_update(msg.get("left", []))
+            self.version = msg["version"]
+            self.count = msg.get("count", len(self.users))
+            return bool(joined) or len(self.users) != before
+
+        return False
+
+    def next_page(self, limit=100):
+        """
+        Asks for the users after the last one we know, if there are more.
+        """
+        if not self.has_more:
+            return False
+        return (self.client or _default).request_users(
+            after=self._cursor, limit=limit
+        )
@@ -1,7 +1,14 @@
 import json
+import struct
 import time
+import weakref
+import zlib
 
-_socket_buffers = {}
+# Readers used by recv_json(), one per socket
+_socket_readers = weakref.WeakKeyDictionary()
+
+# Largest single frame accepted from a peer
+MAX_FRAME_BYTES = 1024 * 1024
 
 # ============
 # constants
@@ -15,40 +22,476 @@ MSG_GROUP = "group"
 MSG_PRIVATE = "private"
 MSG_SYSTEM = "system"
 
+# PMs queued while their recipient was offline, delivered in batches at
+# login, and the acknowledgement of received PMs
+MSG_PENDING = "pending"
+MSG_ACK = "ack"
+
+# Named channels: members join and leave them, channel messages only go to
+# members
+MSG_CHANNEL = "channel"
+MSG_JOIN = "join"
+MSG_LEAVE = "leave"
+
 MSG_HISTORY_REQUEST = "history_request"
 MSG_HISTORY_RESPONSE = "history_response"
 
+# Full-text search over the messages a user may read, best matches first
+MSG_SEARCH = "search"
+MSG_SEARCH_RESULTS = "search_results"
+
 MSG_USERLIST = "userlist"
 
+# Versioned join/leave deltas of the online list, and paged or searched
+# reads of it
+MSG_PRESENCE = "presence"
+MSG_USERS_REQUEST = "users_request"
+
+# One summary per PM conversation, sent at login instead of full histories
+MSG_CONVERSATIONS = "conversations"
+
+# Operator commands, accepted only with the server's admin token
+MSG_ADMIN = "admin"
+MSG_ADMIN_RESPONSE = "admin_response"
+
+# Wire codecs a client can ask for in the "codec" field of MSG_LOGIN
+CODEC_JSON = "json"
+CODEC_BINARY = "binary"
+
+# Stream compression a client can ask for in the "compress" field of
+# MSG_LOGIN (length-prefixed codecs only)
+COMPRESSION_DEFLATE = "deflate"
+
+# Presence mode a client can ask for in the "presence" field of MSG_LOGIN:
+# MSG_PRESENCE deltas instead of a full userlist on every change
+PRESENCE_DELTA = "delta"
+
+# Delivery mode a client can ask for in the "delivery" field of MSG_LOGIN:
+# it acknowledges every PM it receives (MSG_ACK) and gets the unacked ones
+# again as MSG_PENDING at its next login
+DELIVERY_ACK = "ack"
+
+# Most message ids one MSG_ACK may carry
+ACK_MAX = 1000
+
 # =========================
 # JSON socket helpers
 # =========================
 
+def encode_json(data):
+    """
+    Serializes a Python dictionary to one newline-terminated JSON frame.
+    The result is plain bytes, so one frame can be shared by any number of
+    recipients.
+    """
+    return (json.dumps(data) + "\n").encode("utf-8")
+
+
 def send_json(sock, data):
     """
     Sends a Python dictionary as a JSON message over a socket.
     A newline character is appended to mark the end of the message.
     """
-    message = json.dumps(data) + "\n"
-    sock.sendall(message.encode("utf-8"))
+    sock.sendall(encode_json(data))
 
 
 def recv_json(sock):
-    buf = _socket_buffers.get(sock, "")
+    """
+    Receives a single JSON message from a socket, or None once the peer
+    closed the connection. Frames read ahead are kept for the next call.
+    """
+    reader = _socket_readers.get(sock)
+    if reader is None:
+        reader = _socket_readers[sock] = FrameReader(sock)
+
+    msg = reader.read_message()
+    if msg is None:
+        _socket_readers.pop(sock, None)
+    return msg
+
+
+# =========================
+# Wire codecs
+# =========================
+
+class JsonCodec:
+    """
+    The original protocol: one JSON object per line.
+    """
+
+    name = CODEC_JSON
+    framing = "line"
+
+    def encode(self, data):
+        return encode_json(data)
+
+    def decode(self, payload):
+        return json.loads(payload)
+
+
+# Compact message type codes; 0 means the type name is sent inline
+TYPE_CODES = {
+    MSG_LOGIN: 1,
+    MSG_LOGIN_OK: 2,
+    MSG_ERROR: 3,
+    MSG_GROUP: 4,
+    MSG_PRIVATE: 5,
+    MSG_SYSTEM: 6,
+    MSG_HISTORY_REQUEST: 7,
+    MSG_HISTORY_RESPONSE: 8,
+    MSG_USERLIST: 9,
+    MSG_CONVERSATIONS: 10,
+    MSG_ADMIN: 11,
+    MSG_ADMIN_RESPONSE: 12,
+    MSG_PRESENCE: 13,
+    MSG_USERS_REQUEST: 14,
+    MSG_CHANNEL: 15,
+    MSG_JOIN: 16,
+    MSG_LEAVE: 17,
+    MSG_SEARCH: 18,
+    MSG_SEARCH_RESULTS: 19,
+    MSG_PENDING: 20,
+    MSG_ACK: 21,
+}
+
+# Positional field order per message type; anything else travels in a
+# trailing dict of extras
+BODY_FIELDS = {
+    MSG_LOGIN: ("username", "ts"),
+    MSG_LOGIN_OK: ("username",),
+    MSG_ERROR: ("message",),
+    MSG_GROUP: ("id", "ts", "from", "text"),
+    MSG_PRIVATE: ("id", "ts", "from", "target", "text"),
+    MSG_SYSTEM: ("ts", "text"),
+    MSG_HISTORY_REQUEST: ("scope", "with", "before", "limit", "ts", "channel",
+                          "after"),
+    MSG_HISTORY_RESPONSE: ("scope", "with", "before", "has_more", "messages",
+                           "channel", "after"),
+    MSG_USERLIST: ("ts", "users"),
+    MSG_CONVERSATIONS: ("conversations",),
+    MSG_ADMIN: ("command", "token"),
+    MSG_ADMIN_RESPONSE: ("command", "result"),
+    MSG_PRESENCE: ("since", "version", "count", "joined", "left"),
+    MSG_USERS_REQUEST: ("query", "after", "limit"),
+    MSG_CHANNEL: ("id", "ts", "from", "channel", "text"),
+    MSG_JOIN: ("channel",),
+    MSG_LEAVE: ("channel",),
+    MSG_SEARCH: ("query", "scope", "from", "with", "channel", "since", "until",
+                 "offset", "limit"),
+    MSG_SEARCH_RESULTS: ("query", "offset", "has_more", "messages"),
+    MSG_PENDING: ("has_more", "messages"),
+    MSG_ACK: ("ids",),
+}
+
+# History rows inside "messages" lists are sent positionally as well
+ROW_FIELDS = ("id", "ts", "sender", "scope", "target", "text")
+_ROW_LISTS = {
+    MSG_HISTORY_RESPONSE: "messages",
+    MSG_SEARCH_RESULTS: "messages",
+    MSG_PENDING: "messages",
+}
+
+# 4-byte big-endian payload length; the top bit flags a compressed payload
+_HEADER = struct.Struct(">I")
+HEADER_SIZE = _HEADER.size
+FLAG_COMPRESSED = 0x80000000
+
+
+class BinaryCodec:
+    """
+    Compact, length-prefixed framing negotiated at login.
+
+    Every frame is a 4-byte length header followed by a JSON array:
+    [type code, field values in BODY_FIELDS order..., {extras}?]. Keys are
+    never repeated on the wire, history rows become plain arrays, and the
+    length prefix means the reader never scans for delimiters. Encoding and
+    decoding still go through the C JSON implementation, which in pure
+    Python beats any hand-rolled binary format.
+    """
+
+    name = CODEC_BINARY
+    framing = "length"
+
+    _dumps = json.JSONEncoder(separators=(",", ":")).encode
+    _CODE_TYPES = {code: t for t, code in TYPE_CODES.items()}
+
+    def encode(self, data):
+        payload = self._dumps(self.pack(data)).encode("utf-8")
+        return _HEADER.pack(len(payload)) + payload
+
+    def pack(self, data):
+        msg_type = data.get("type")
+        code = TYPE_CODES.get(msg_type)
+        if code is None:
+            return [0, data]
+
+        fields = BODY_FIELDS[msg_type]
+        body = [code]
+        body.extend(data.get(f) for f in fields)
+
+        rows_key = _ROW_LISTS.get(msg_type)
+        if rows_key and body[1 + fields.index(rows_key)]:
+            body[1 + fields.index(rows_key)] = [
+                [row.get(f) for f in ROW_FIELDS]
+                for row in data[rows_key]
+            ]
+
+        # Any key outside BODY_FIELDS, whether or not every field is set
+        extras = {k: v for k, v in data.items()
+                  if k != "type" and k not in fields}
+        if extras:
+            body.append(extras)
+        return body
+
+    def decode(self, payload):
+        return self.unpack(json.loads(payload))
+
+    def unpack(self, body):
+        code = body[0]
+        if code == 0:
+            return body[1]
 
-    while True:
-        if "\n" in buf:
-            line, _, rest = buf.partition("\n")
-            _socket_buffers[sock] = rest
-            return json.loads(line)
+        msg_type = self._CODE_TYPES[code]
+        fields = BODY_FIELDS[msg_type]
+        data = dict(zip(fields, body[1:]))
+        if None in data.values():
+            data = {k: v for k, v in data.items() if v is not None}
+        data["type"] = msg_type
 
-        chunk = sock.recv(4096)
-        if not chunk:
-            _socket_buffers.pop(sock, None)
+        if len(body) > len(fields) + 1:
+            data.update(body[-1])
+
+        rows_key = _ROW_LISTS.get(msg_type)
+        if rows_key and rows_key in data:
+            data[rows_key] = [dict(zip(ROW_FIELDS, row))
+                              for row in data[rows_key]]
+        return data
+
+
+JSON_CODEC = JsonCodec()
+BINARY_CODEC = BinaryCodec()
+
+CODECS = {
+    CODEC_JSON: JSON_CODEC,
+    CODEC_BINARY: BINARY_CODEC,
+}
+
+
+# =========================
+# Stream compression
+# =========================
+
+# Frames with a smaller payload are sent as they are
+COMPRESS_THRESHOLD = 512
+
+
+class FrameCompressor:
+    """
+    Per-connection deflate stream for length-prefixed frames.
+
+    One compression context is shared by every frame the connection sends,
+    so keys, usernames and phrases seen in earlier frames compress to short
+    back-references in later ones. Each compressed frame ends with a sync
+    flush, which lets the peer decode it without waiting for more data.
+    Frames must go through compress() in the order they are written.
+
+    on_frame(raw_bytes, compressed_bytes, cpu_seconds) is called for every
+    frame that was compressed.
+    """
+
+    def __init__(self, threshold=COMPRESS_THRESHOLD, level=6, on_frame=None):
+        self.threshold = threshold
+        self.on_frame = on_frame
+        self._deflate = zlib.compressobj(level)
+
+    def compress(self, frame):
+        size = len(frame) - HEADER_SIZE
+        if size < self.threshold:
+            return frame
+
+        started = time.thread_time()
+        deflate = self._deflate
+        payload = (deflate.compress(memoryview(frame)[HEADER_SIZE:])
+                   + deflate.flush(zlib.Z_SYNC_FLUSH))
+        if self.on_frame:
+            self.on_frame(size, len(payload), time.thread_time() - started)
+        return _HEADER.pack(len(payload) | FLAG_COMPRESSED) + payload
+
+
+# =========================
+# Framed reader
+# =========================
+
+class FrameTooLarge(ValueError):
+    pass
+
+
+class FrameReader:
+    """
+    Per-connection reader of protocol frames.
+
+    Bytes are received straight into one reusable bytearray with recv_into()
+    and frames are cut out of it in place. The newline search only covers
+    bytes that arrived since the last search, and frames are decoded as a
+    whole, so a UTF-8 character split across two reads is never an issue.
+
+    Frames are newline-delimited JSON until set_codec() switches the reader
+    to a length-prefixed codec; bytes already buffered are kept. After
+    enable_compression(), frames flagged with FLAG_COMPRESSED are inflated
+    with one stream shared by the whole connection.
+    Without a socket, feed() accepts bytes read elsewhere (asyncio).
+    """
+
+    def __init__(self, sock=None, max_frame=MAX_FRAME_BYTES, bufsize=65536):
+        self.sock = sock
+        self.max_frame = max_frame
+        self.codec = JSON_CODEC
+        self._buf = bytearray(bufsize)
+        self._start = 0     # first byte not yet returned
+        self._end = 0       # end of received data
+        self._scan = 0      # where the next newline search starts
+        self._inflate = None
+
+    def _make_room(self, need=1):
+        pending = self._end - self._start
+        if self._start:
+            # Slide the partial frame to the front of the buffer
+            self._buf[:pending] = self._buf[self._start:self._end]
+            self._scan -= self._start
+            self._start = 0
+            self._end = pending
+        if len(self._buf) - self._end < need:
+            if pending > self.max_frame:
+                raise FrameTooLarge(f"Frame exceeds {self.max_frame} bytes")
+            size = max(len(self._buf) * 2, self._end + need)
+            self._buf.extend(bytes(size - len(self._buf)))
+
+    def set_codec(self, codec):
+        self.codec = codec
+        self._scan = self._start
+
+    def enable_compression(self):
+        self._inflate = zlib.decompressobj()
+
+    def _decompress(self, payload):
+        if self._inflate is None:
+            raise ValueError("Compressed frame on an uncompressed connection")
+        # Bounded, so a tiny frame cannot inflate into gigabytes
+        data = self._inflate.decompress(payload, self.max_frame)
+        if self._inflate.unconsumed_tail:
+            raise FrameTooLarge(f"Frame exceeds {self.max_frame} bytes")
+        return data
+
+    def _split(self, limit=None):
+        if self.codec.framing == "length":
+            return self._split_length(limit)
+
+        frames = []
+        buf = self._buf
+        while len(frames) != limit:
+            idx = buf.find(b"\n", self._scan, self._end)
+            if idx < 0:
+                self._scan = self._end
+                break
+            if idx > self._start:
+                frames.append(bytes(buf[self._start:idx]))
+            self._start = self._scan = idx + 1
+
+        if self._end - self._start > self.max_frame:
+            raise FrameTooLarge(f"Frame exceeds {self.max_frame} bytes")
+        if self._start == self._end:
+            self._start = self._end = self._scan = 0
+        return frames
+
+    def _split_length(self, limit=None):
+        frames = []
+        buf = self._buf
+        while (len(frames) != limit
+               and self._end - self._start >= HEADER_SIZE):
+            (header,) = _HEADER.unpack_from(buf, self._start)
+            length = header & ~FLAG_COMPRESSED
+            if length > self.max_frame:
+                raise FrameTooLarge(f"Frame exceeds {self.max_frame} bytes")
+
+            begin = self._start + HEADER_SIZE
+            if self._end - begin < length:
+                break
+            payload = bytes(buf[begin:begin + length])
+            self._start = begin + length
+            if header & FLAG_COMPRESSED:
+                payload = self._decompress(payload)
+            frames.append(payload)
+
+        self._scan = self._start
+        if self._start == self._end:
+            self._start = self._end = self._scan = 0
+        return frames
+
+    def decode(self, frames):
+        """
+        Decodes frames returned by feed() or read_frames() into dicts.
+        """
+        return [self.codec.decode(f) for f in frames]
+
+    def feed(self, data=b"", limit=None):
+        """
+        Adds received bytes and returns the complete frames (bytes), at
+        most `limit` of them; the rest stay buffered for the next call.
+        """
+        if len(self._buf) - self._end < len(data):
+            self._make_room(len(data))
+        self._buf[self._end:self._end + len(data)] = data
+        self._end += len(data)
+        return self._split(limit)
+
+    def _recv(self):
+        # One recv_into() at the end of the buffer; False on EOF
+        if self._end == len(self._buf):
+            self._make_room()
+        view = memoryview(self._buf)[self._end:]
+        try:
+            n = self.sock.recv_into(view)
+        finally:
+            view.release()
+        self._end += n
+        return bool(n)
+
+    def read_frames(self):
+        """
+        Performs one recv_into() and returns all complete frames it
+        completed (possibly an empty list). Returns None on EOF.
+        """
+        if not self._recv():
             return None
+        return self._split()
+
+    def read_messages(self):
+        """
+        Blocks until at least one message is available and returns all of
+        them as dicts. Returns None once the peer closed the connection.
+        """
+        frames = self._split()
+        while not frames:
+            frames = self.read_frames()
+            if frames is None:
+                return None
+        return self.decode(frames)
+
+    def read_message(self):
+        """
+        Returns the next message as a dict, or None on EOF.
+
+        Only that one frame is cut from the buffer, so whatever the peer
+        sent right behind a handshake reply is still split with the codec
+        set afterwards.
+        """
+        while True:
+            frames = self._split(limit=1)
+            if frames:
+                return self.codec.decode(frames[0])
+            if not self._recv():
+                return None
 
-        buf += chunk.decode("utf-8")
-        _socket_buffers[sock] = buf
 
 # =========================
 # Utility helpers
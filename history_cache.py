@@ -0,0 +1,300 @@
+import bisect
+import threading
+from collections import OrderedDict
+
+import storage
+
+# Rough per-message overhead of a cached dict, on top of its text
+_MESSAGE_OVERHEAD = 200
+
+
+# =========================
+# Cached windows
+# =========================
+
+class _Window:
+    """
+    The newest messages of one conversation, contiguous and sorted by id.
+    `complete` means there is nothing older than the window in storage.
+    """
+
+    def __init__(self, messages, complete):
+        self.messages = messages
+        self.ids = [m["id"] for m in messages]
+        self.complete = complete
+        self.size = sum(_message_size(m) for m in messages)
+
+    def add(self, message, capacity):
+        msg_id = message["id"]
+        if self.ids and msg_id <= self.ids[-1]:
+            if msg_id in self.ids:
+                return
+            pos = bisect.bisect(self.ids, msg_id)
+        else:
+            pos = len(self.ids)
+        self.ids.insert(pos, msg_id)
+        self.messages.insert(pos, message)
+        self.size += _message_size(message)
+
+        while len(self.messages) > capacity:
+            self.ids.pop(0)
+            self.size -= _message_size(self.messages.pop(0))
+            self.complete = False
+
+    def page(self, limit, before_id):
+        """
+        Returns the page if the window can answer it, otherwise None.
+        """
+        end = bisect.bisect_left(self.ids, before_id) if before_id else len(self.ids)
+        if end >= limit:
+            return self.messages[end - limit:end]
+        if self.complete:
+            return self.messages[:end]
+        return None
+
+
+def _message_size(message):
+    return _MESSAGE_OVERHEAD + len(message.get("text") or "")
+
+
+def _pair_key(user1, user2):
+    return ("pm",) + ((user1, user2) if user1 <= user2 else (user2, user1))
+
+
+def _channel_key(channel):
+    return ("channel", channel)
+
+
+# =========================
+# History cache
+# =========================
+
+class HistoryCache:
+    """
+    Recent history kept in memory in front of storage.py.
+
+    - group: ring of the newest `group_size` group messages
+    - windows: LRU of per-conversation windows (one per PM pair or
+      channel) of `pm_window` messages, bounded by `max_conversations`
+      entries and roughly `max_bytes` of text
+
+    New messages are added once their storage commit completes, in id order,
+    so the cache never shows anything SQLite would not. Pages the cache
+    cannot answer fall back to SQLite.
+    """
+
+    def __init__(self, group_size=500, pm_window=100, max_conversations=5000,
+                 max_bytes=64 * 1024 * 1024):
+        self.group_size = group_size
+        self.pm_window = pm_window
+        self.max_conversations = max_conversations
+        self.max_bytes = max_bytes
+
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._group = None
+        self._windows = OrderedDict()   # key -> _Window, oldest use first
+        self._windows_bytes = 0
+        self._loading = {}          # key -> messages committed meanwhile
+
+    def prime(self):
+        """
+        Loads the newest group messages so logins never start cold.
+        """
+        messages = storage.load_group_history(limit=self.group_size + 1)
+        complete = len(messages) <= self.group_size
+        with self._lock:
+            self._group = _Window(messages[-self.group_size:], complete)
+
+    # ---- writes ----
+
+    def add(self, message):
+        scope = message["scope"]
+        with self._lock:
+            if scope == "group":
+                if self._group is not None:
+                    self._group.add(message, self.group_size)
+                return
+
+            if scope == "channel":
+                key = _channel_key(message["target"])
+            else:
+                key = _pair_key(message["sender"], message["target"])
+            if key in self._loading:
+                self._loading[key].append(message)
+                return
+
+            window = self._windows.get(key)
+            if window is not None:
+                self._windows_bytes -= window.size
+                window.add(message, self.pm_window)
+                self._windows_bytes += window.size
+                self._windows.move_to_end(key)
+                self._evict()
+
+    def _evict(self):
+        # Caller holds self._lock
+        while self._windows and (len(self._windows) > self.max_conversations
+                                 or self._windows_bytes > self.max_bytes):
+            _, window = self._windows.popitem(last=False)
+            self._windows_bytes -= window.size
+
+    # ---- reads ----
+
+    def group_page(self, limit, before_id):
+        with self._lock:
+            page = self._group.page(limit, before_id) if self._group else None
+            if page is not None:
+                self.hits += 1
+                return list(page)
+            self.misses += 1
+
+        return storage.load_group_history(limit=limit, before_id=before_id)
+
+    def private_page(self, user1, user2, limit, before_id):
+        return self._window_page(
+            _pair_key(user1, user2),
+            lambda limit, before_id=None: storage.load_private_history(
+                user1, user2, limit=limit, before_id=before_id
+            ),
+            limit, before_id,
+        )
+
+    def channel_page(self, channel, limit, before_id):
+        return self._window_page(
+            _channel_key(channel),
+            lambda limit, before_id=None: storage.load_channel_history(
+                channel, limit=limit, before_id=before_id
+            ),
+            limit, before_id,
+        )
+
+    def _window_page(self, key, load, limit, before_id):
+        # load(limit, before_id) reads the conversation from storage
+        with self._lock:
+            window = self._windows.get(key)
+            if window is not None:
+                page = window.page(limit, before_id)
+                if page is not None:
+                    self._windows.move_to_end(key)
+                    self.hits += 1
+                    return list(page)
+            self.misses += 1
+
+            # Only the newest window is worth caching, not deep pages
+            load_window = window is None and key not in self._loading
+            if load_window:
+                self._loading[key] = []
+
+        if not load_window:
+            return load(limit, before_id)
+
+        try:
+            size = max(self.pm_window, limit)
+            messages = load(size + 1)
+        except Exception:
+            with self._lock:
+                self._loading.pop(key, None)
+            raise
+
+        with self._lock:
+            window = _Window(messages[-size:], len(messages) <= size)
+            for message in self._loading.pop(key):
+                window.add(message, size)
+            self._windows[key] = window
+            self._windows_bytes += window.size
+            self._evict()
+            page = window.page(limit, before_id)
+
+        if page is not None:
+            return list(page)
+        return load(limit, before_id)
+
+
+# =========================
+# Storage front
+# =========================
+
+_cache = None
+_listeners = []
+
+
+def add_listener(callback):
+    """
+    Registers callback(row) to be called with every message row right after
+    it is committed (and added to the cache), in id order.
+    """
+    _listeners.append(callback)
+
+
+def init_cache(**options):
+    """
+    Creates and primes the shared cache. Until this is called every
+    function below goes straight to storage.
+    """
+    global _cache
+    _cache = HistoryCache(**options)
+    _cache.prime()
+    return _cache
+
+
+def get_cache():
+    return _cache
+
+
+def save_message(ts, sender, scope, target, text, on_commit=None,
+                 msg_id=None):
+    """
+    Same as storage.save_message, but also adds the message to the cache
+    and notifies the listeners once it is committed.
+    """
+    def committed(msg_id):
+        notify_committed({
+            "id": msg_id,
+            "ts": ts,
+            "sender": sender,
+            "scope": scope,
+            "target": target,
+            "text": text
+        })
+        if on_commit:
+            on_commit(msg_id)
+
+    return storage.save_message(
+        ts, sender, scope, target, text, committed, msg_id=msg_id
+    )
+
+
+def notify_committed(row):
+    """
+    Adds a committed message row to the cache and notifies the listeners.
+    Worker processes call this for rows committed by the hub.
+    """
+    if _cache is not None:
+        _cache.add(row)
+    for listener in _listeners:
+        listener(row)
+
+
+def load_group_history(limit=50, before_id=None):
+    if _cache is None:
+        return storage.load_group_history(limit=limit, before_id=before_id)
+    return _cache.group_page(limit, before_id)
+
+
+def load_private_history(user1, user2, limit=50, before_id=None):
+    if _cache is None:
+        return storage.load_private_history(
+            user1, user2, limit=limit, before_id=before_id
+        )
+    return _cache.private_page(user1, user2, limit, before_id)
+
+
+def load_channel_history(channel, limit=50, before_id=None):
+    if _cache is None:
+        return storage.load_channel_history(
+            channel, limit=limit, before_id=before_id
+        )
+    return _cache.channel_page(channel, limit, before_id)
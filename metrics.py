@@ -0,0 +1,267 @@
+import bisect
+import functools
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import profiling
+
+# Prefix of every metric name in the Prometheus output
+PREFIX = "chat_"
+
+# Histogram upper bounds in seconds, from 50µs to 10s
+LATENCY_BUCKETS = (
+    0.00005, 0.0001, 0.00025, 0.0005,
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+
+# =========================
+# Counters
+# =========================
+
+_lock = threading.Lock()
+_counters = {}
+_help = {}
+
+
+def describe(name, text):
+    """
+    Sets the help text shown for a metric in the Prometheus output.
+    """
+    _help[name] = text
+
+
+def incr(name, amount=1):
+    """
+    Adds `amount` to a named server-wide counter.
+    """
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + amount
+
+
+def incr_many(amounts):
+    """
+    Adds several counters at once, from a dict of name -> amount.
+    """
+    with _lock:
+        for name, amount in amounts.items():
+            _counters[name] = _counters.get(name, 0) + amount
+
+
+def snapshot():
+    """
+    Returns a copy of every counter.
+    """
+    with _lock:
+        return dict(_counters)
+
+
+def reset():
+    with _lock:
+        _counters.clear()
+    for hist in list(_histograms.values()):
+        hist.reset()
+
+
+# =========================
+# Gauges
+# =========================
+
+_gauges = {}
+
+
+def gauge(name, read, text=""):
+    """
+    Registers a gauge: read() is called whenever metrics are collected.
+    """
+    _gauges[name] = read
+    if text:
+        describe(name, text)
+
+
+def read_gauges():
+    values = {}
+    for name, read in list(_gauges.items()):
+        try:
+            values[name] = read()
+        except Exception:
+            pass
+    return values
+
+
+# =========================
+# Histograms
+# =========================
+
+_histograms = {}
+
+
+class Histogram:
+    """
+    Fixed-bucket histogram, cheap enough for every message: observe() is a
+    bisect over ~20 bounds plus three additions under a lock.
+    """
+
+    def __init__(self, name, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.counts = [0] * (len(self.buckets) + 1)
+            self.count = 0
+            self.sum = 0.0
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.count += 1
+            self.sum += value
+
+    def quantile(self, q):
+        """
+        Upper bound of the bucket holding the q-quantile (an estimate).
+        """
+        with self._lock:
+            counts, count = list(self.counts), self.count
+        if not count:
+            return None
+        rank = q * count
+        seen = 0
+        for i, n in enumerate(counts):
+            seen += n
+            if seen >= rank:
+                return self.buckets[i] if i < len(self.buckets) else float("inf")
+        return float("inf")
+
+    def summary(self):
+        p50, p99 = self.quantile(0.5), self.quantile(0.99)
+        return {
+            "count": self.count,
+            "mean_ms": round(self.sum / self.count * 1000, 3) if self.count else None,
+            "p50_ms": None if p50 is None else p50 * 1000,
+            "p99_ms": None if p99 is None else p99 * 1000,
+        }
+
+
+def histogram(name, text="", buckets=LATENCY_BUCKETS):
+    """
+    Returns the histogram called `name`, creating it on first use.
+    """
+    hist = _histograms.get(name)
+    if hist is None:
+        hist = _histograms.setdefault(name, Histogram(name, buckets))
+        if text:
+            describe(name, text)
+    return hist
+
+
+def histogram_summaries():
+    return {name: h.summary() for name, h in _histograms.items() if h.count}
+
+
+def timed(hist):
+    """
+    Decorator recording the duration of every call in `hist`.
+    """
+    def wrap(func):
+        @functools.wraps(func)
+        def timed_call(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                hist.observe(time.perf_counter() - started)
+        return timed_call
+    return wrap
+
+
+class TimedLock:
+    """
+    Drop-in for threading.Lock in `with` blocks that records how long
+    acquirers had to wait. Uncontended acquisitions are not timed.
+    """
+
+    def __init__(self, hist):
+        self._lock = threading.Lock()
+        self._hist = hist
+
+    def __enter__(self):
+        if not self._lock.acquire(False):
+            started = time.perf_counter()
+            self._lock.acquire()
+            self._hist.observe(time.perf_counter() - started)
+            if profiling.tracing:
+                profiling.span("lock_wait", started)
+        return self
+
+    def __exit__(self, *exc):
+        self._lock.release()
+
+
+# =========================
+# Prometheus exposition
+# =========================
+
+def render_prometheus():
+    """
+    Every metric in the Prometheus text exposition format.
+    """
+    lines = []
+
+    def header(name, kind):
+        if name in _help:
+            lines.append(f"# HELP {PREFIX}{name} {_help[name]}")
+        lines.append(f"# TYPE {PREFIX}{name} {kind}")
+
+    for name, value in sorted(snapshot().items()):
+        header(name, "counter")
+        lines.append(f"{PREFIX}{name} {value}")
+
+    for name, value in sorted(read_gauges().items()):
+        header(name, "gauge")
+        lines.append(f"{PREFIX}{name} {value}")
+
+    for name, hist in sorted(_histograms.items()):
+        with hist._lock:
+            counts, count, total = list(hist.counts), hist.count, hist.sum
+        header(name, "histogram")
+        cumulative = 0
+        for bound, n in zip(hist.buckets, counts):
+            cumulative += n
+            lines.append(f'{PREFIX}{name}_bucket{{le="{bound}"}} {cumulative}')
+        lines.append(f'{PREFIX}{name}_bucket{{le="+Inf"}} {count}')
+        lines.append(f"{PREFIX}{name}_sum {total}")
+        lines.append(f"{PREFIX}{name}_count {count}")
+
+    return "\n".join(lines) + "\n"
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render_prometheus().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def serve_http(host="127.0.0.1", port=9100):
+    """
+    Serves GET /metrics in a background thread.
+    """
+    httpd = ThreadingHTTPServer((host, port), _MetricsHandler)
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd
@@ -0,0 +1,302 @@
+import socket
+import threading
+import time
+from collections import deque
+
+import metrics
+import profiling
+from common import JSON_CODEC
+
+# =========================
+# Overflow policies
+# =========================
+
+# Discard the oldest queued frame to make room for the new one.
+POLICY_DROP_OLDEST = "drop_oldest"
+# Treat the reader as dead: drop its queue and close the connection.
+POLICY_DISCONNECT = "disconnect"
+# Wait up to block_timeout for room, then disconnect like POLICY_DISCONNECT.
+POLICY_BLOCK = "block"
+
+POLICIES = (POLICY_DROP_OLDEST, POLICY_DISCONNECT, POLICY_BLOCK)
+
+
+# =========================
+# Threads that must not wait
+# =========================
+
+_thread_flags = threading.local()
+
+
+def mark_non_blocking():
+    """
+    Marks the calling thread as one that delivers for many clients (the
+    storage writer, bus readers) and so must never wait for queue space:
+    under POLICY_BLOCK a full queue cuts its consumer off right away.
+    """
+    _thread_flags.non_blocking = True
+
+
+def is_non_blocking():
+    return getattr(_thread_flags, "non_blocking", False)
+
+
+# =========================
+# Bounded outbound queue
+# =========================
+
+class OutboundQueue:
+    """
+    Bounded FIFO of encoded frames waiting to be written to one client.
+
+    Producers (fan-out, replies) only ever call put(); a single writer per
+    connection drains it. put() never touches the socket, so the time spent
+    broadcasting does not depend on how fast any one reader is.
+    """
+
+    def __init__(self, maxsize=1024, policy=POLICY_DROP_OLDEST,
+                 block_timeout=0.5, on_ready=None):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown overflow policy: {policy}")
+
+        self.maxsize = maxsize
+        self.policy = policy
+        self.block_timeout = block_timeout
+        self.on_ready = on_ready    # callback() when items become available
+
+        self.dropped = 0
+        self.closed = False
+        self.overflowed = False     # set when the consumer must be cut off
+
+        self._items = deque()
+        self._cond = threading.Condition()
+
+    def __len__(self):
+        return len(self._items)
+
+    def put(self, data, can_block=True):
+        """
+        Queues one frame. Returns False if the frame was not queued because
+        the queue is closed or the consumer has just been cut off.
+        """
+        with self._cond:
+            if self.closed:
+                return False
+
+            if len(self._items) >= self.maxsize:
+                if self.policy == POLICY_DROP_OLDEST:
+                    self._items.popleft()
+                    self.dropped += 1
+                    metrics.incr("outbound_dropped_total")
+
+                elif self.policy == POLICY_BLOCK and can_block:
+                    self._cond.wait_for(
+                        lambda: self.closed or len(self._items) < self.maxsize,
+                        timeout=self.block_timeout,
+                    )
+                    if self.closed:
+                        return False
+
+                if len(self._items) >= self.maxsize:
+                    self._overflow()
+                    return False
+
+            was_empty = not self._items
+            self._items.append(data)
+            self._cond.notify_all()
+
+        if was_empty and self.on_ready:
+            self.on_ready()
+        return True
+
+    def _overflow(self):
+        # Caller holds self._cond
+        metrics.incr_many({
+            "outbound_dropped_total": len(self._items) + 1,
+            "outbound_overflow_disconnects_total": 1,
+        })
+        self.dropped += len(self._items) + 1
+        self._items.clear()
+        self.overflowed = True
+        self.closed = True
+        self._cond.notify_all()
+
+    def pop_all(self):
+        """
+        Returns every queued frame without blocking.
+        """
+        with self._cond:
+            items = list(self._items)
+            self._items.clear()
+            self._cond.notify_all()
+        return items
+
+    def get_batch(self, timeout=None):
+        """
+        Blocks until at least one frame is queued (or the queue is closed)
+        and returns everything that is queued. An empty list means closed.
+        """
+        with self._cond:
+            self._cond.wait_for(lambda: self._items or self.closed, timeout)
+            items = list(self._items)
+            self._items.clear()
+            self._cond.notify_all()
+        return items
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+        if self.on_ready:
+            self.on_ready()
+
+
+# =========================
+# Vectored writes
+# =========================
+
+# Upper bound on buffers per sendmsg() call (IOV_MAX is 1024 on Linux)
+MAX_IOVEC = 512
+
+
+def sendmsg_all(sock, buffers):
+    """
+    Writes every buffer in order using as few system calls as possible.
+    On platforms without sendmsg() the buffers are joined and sent at once.
+    """
+    if not hasattr(sock, "sendmsg"):
+        sock.sendall(b"".join(buffers))
+        return
+
+    pending = deque(memoryview(b) for b in buffers)
+    while pending:
+        batch = [pending[i] for i in range(min(len(pending), MAX_IOVEC))]
+        sent = sock.sendmsg(batch)
+
+        # Drop fully written buffers, trim a partially written one
+        while sent and pending:
+            head = pending[0]
+            if sent >= len(head):
+                sent -= len(head)
+                pending.popleft()
+            else:
+                pending[0] = head[sent:]
+                sent = 0
+
+
+# =========================
+# Stream compression
+# =========================
+
+class StartCompression:
+    """
+    Queue marker: frames queued after it are compressed with `compressor`.
+
+    Switching through the queue instead of an attribute guarantees that
+    frames queued earlier (login_ok in particular) go out uncompressed.
+    """
+
+    __slots__ = ("compressor",)
+
+    def __init__(self, compressor):
+        self.compressor = compressor
+
+
+def prepare_frames(conn, items):
+    """
+    Turns a batch taken off a connection's queue into the buffers to
+    write, compressing them in queue order once compression started.
+    """
+    out = []
+    for item in items:
+        if type(item) is StartCompression:
+            conn.compressor = item.compressor
+        elif conn.compressor is not None:
+            out.append(conn.compressor.compress(item))
+        else:
+            out.append(item)
+    return out
+
+
+# =========================
+# Connection state
+# =========================
+
+class ProtocolState:
+    """
+    Per-connection protocol state negotiated at login and used by the
+    shared handlers in server.py. Both engines' connection classes inherit
+    it, so new state is added here once.
+    """
+
+    def __init__(self):
+        self.codec = JSON_CODEC     # switched after the login handshake
+        self.compressor = None      # only touched by the connection's writer
+        self.presence_deltas = False  # MSG_PRESENCE instead of full userlists
+        self.resume_after = None    # last message id the client saw, if resuming
+        self.acks = False           # acknowledges PMs, gets MSG_PENDING at login
+        self.pending_cursor = None  # last id of the MSG_PENDING batch in flight
+
+
+# =========================
+# Threaded connection
+# =========================
+
+class SocketConnection(ProtocolState):
+    """
+    A client socket paired with its own outbound queue and writer thread.
+
+    sendall() only enqueues encoded frames, so the shared handlers never
+    block on a slow peer.
+    """
+
+    def __init__(self, sock, maxsize=1024, policy=POLICY_DROP_OLDEST,
+                 block_timeout=0.5):
+        super().__init__()
+        self.sock = sock
+        self.queue = OutboundQueue(maxsize, policy, block_timeout)
+
+        self._writer = threading.Thread(target=self._write_loop, daemon=True)
+        self._writer.start()
+
+    def sendall(self, data):
+        if (not self.queue.put(data, can_block=not is_non_blocking())
+                and self.queue.overflowed):
+            self._abort()
+
+    def start_compression(self, compressor):
+        self.queue.put(StartCompression(compressor))
+
+    def close(self):
+        """
+        Closes gracefully: frames already queued are still written first.
+        """
+        self.queue.close()
+
+    def _abort(self):
+        # Wakes up the reader thread, which then runs the normal cleanup
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def _write_loop(self):
+        try:
+            while True:
+                items = self.queue.get_batch()
+                if not items:
+                    break
+                if profiling.tracing:
+                    started = time.perf_counter()
+                    sendmsg_all(self.sock, prepare_frames(self, items))
+                    profiling.span("send", started, frames=len(items))
+                else:
+                    sendmsg_all(self.sock, prepare_frames(self, items))
+        except OSError:
+            self.queue.close()
+            self._abort()
+        finally:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
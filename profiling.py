@@ -0,0 +1,225 @@
+import json
+import os
+import signal
+import sys
+import threading
+import time
+from collections import Counter
+
+# Seconds between two stack samples
+SAMPLE_INTERVAL = 0.005
+
+# Trace events kept per session; later ones are only counted
+MAX_TRACE_EVENTS = 500000
+
+# Hot paths check this before recording a span, so tracing costs one
+# attribute lookup while it is off
+tracing = False
+
+_settings = {
+    "directory": "profiles",
+    "interval": SAMPLE_INTERVAL,
+}
+
+_lock = threading.Lock()
+_session = None
+
+
+# =========================
+# Session
+# =========================
+
+class _Session:
+    """
+    One profiling run: a sampler thread collecting stacks plus the trace
+    events recorded by span() while it lasts.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.started_at = time.time()
+        self.origin = time.perf_counter()
+        self.pid = os.getpid()
+        self.stacks = Counter()
+        self.samples = 0
+        self.events = []
+        self.dropped = 0
+        self.done = threading.Event()
+        self.thread = threading.Thread(
+            target=self._sample_loop, name="profiler", daemon=True
+        )
+
+    def add(self, event):
+        # list.append is atomic, no lock needed on the hot path
+        if len(self.events) < MAX_TRACE_EVENTS:
+            self.events.append(event)
+        else:
+            self.dropped += 1
+
+    def micros(self, t):
+        return round((t - self.origin) * 1e6, 1)
+
+    def _sample_loop(self):
+        own = threading.get_ident()
+        while not self.done.wait(self.interval):
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_label(frame.f_code))
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+
+def _label(code):
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+# =========================
+# Control
+# =========================
+
+def install(directory="profiles", interval=SAMPLE_INTERVAL, signals=True):
+    """
+    Sets where profiles go and how often stacks are sampled. With signals,
+    SIGUSR1 starts profiling and SIGUSR2 stops it and writes the files.
+    Must be called from the main thread.
+    """
+    _settings["directory"] = directory
+    _settings["interval"] = interval
+
+    if signals and hasattr(signal, "SIGUSR1"):
+        signal.signal(signal.SIGUSR1, lambda *_: start())
+        # Writing the files may take a moment, keep it off the main thread
+        signal.signal(signal.SIGUSR2, lambda *_: threading.Thread(
+            target=stop, daemon=True
+        ).start())
+
+
+def start(trace=True):
+    """
+    Starts sampling stacks and, with trace, recording spans. Returns False
+    if a session is already running.
+    """
+    global _session, tracing
+
+    with _lock:
+        if _session is not None:
+            return False
+        session = _session = _Session(_settings["interval"])
+        session.thread.start()
+        tracing = trace
+
+    print(f"[Profiling] Started (pid {session.pid})")
+    return True
+
+
+def stop():
+    """
+    Ends the running session and writes its files into the profile
+    directory:
+
+    - <stamp>-<pid>.folded: collapsed stacks, one "frame;frame;... count"
+      line per stack (flamegraph.pl, speedscope, inferno)
+    - <stamp>-<pid>.trace.json: Chrome trace events (chrome://tracing,
+      Perfetto, speedscope)
+
+    Returns a summary with the file paths, or None if nothing was running.
+    """
+    global _session, tracing
+
+    with _lock:
+        session = _session
+        if session is None:
+            return None
+        tracing = False
+        _session = None
+
+    session.done.set()
+    session.thread.join()
+
+    directory = _settings["directory"]
+    os.makedirs(directory, exist_ok=True)
+    stamp = time.strftime("%Y%m%d-%H%M%S", time.localtime(session.started_at))
+    base = os.path.join(directory, f"{stamp}-{session.pid}")
+
+    with open(base + ".folded", "w", encoding="utf-8") as f:
+        for stack, count in session.stacks.most_common():
+            f.write(f"{stack} {count}\n")
+
+    names = {t.ident: t.name for t in threading.enumerate()}
+    tids = {e["tid"] for e in session.events}
+    metadata = [
+        {
+            "name": "thread_name",
+            "ph": "M",
+            "pid": session.pid,
+            "tid": tid,
+            "args": {"name": names.get(tid, str(tid))}
+        }
+        for tid in tids
+    ]
+    with open(base + ".trace.json", "w", encoding="utf-8") as f:
+        json.dump({
+            "traceEvents": metadata + session.events,
+            "displayTimeUnit": "ms",
+        }, f)
+
+    summary = {
+        "seconds": round(time.time() - session.started_at, 3),
+        "samples": session.samples,
+        "events": len(session.events),
+        "dropped_events": session.dropped,
+        "stacks": base + ".folded",
+        "trace": base + ".trace.json",
+    }
+    print(f"[Profiling] Stopped: {summary}")
+    return summary
+
+
+# =========================
+# Spans
+# =========================
+
+def span(name, started, ended=None, **args):
+    """
+    Records work done on the calling thread between two perf_counter()
+    values (ended defaults to now). Callers check `tracing` first.
+    """
+    session = _session
+    if session is None:
+        return
+    if ended is None:
+        ended = time.perf_counter()
+    session.add({
+        "name": name,
+        "ph": "X",
+        "ts": session.micros(started),
+        "dur": round((ended - started) * 1e6, 1),
+        "pid": session.pid,
+        "tid": threading.get_ident(),
+        "args": args,
+    })
+
+
+def async_span(name, span_id, started, ended, **args):
+    """
+    Records an interval that is not tied to one thread, such as a message
+    waiting for its commit. Spans sharing a name are grouped by span_id.
+    """
+    session = _session
+    if session is None:
+        return
+    common = {
+        "name": name,
+        "cat": "message",
+        "id": span_id,
+        "pid": session.pid,
+        "tid": threading.get_ident(),
+    }
+    session.add(dict(common, ph="b", ts=session.micros(started), args=args))
+    session.add(dict(common, ph="e", ts=session.micros(ended)))
@@ -0,0 +1,78 @@
+import threading
+import time
+
+
+# =========================
+# Token bucket
+# =========================
+
+class TokenBucket:
+    """
+    Allows `rate` events per second on average and bursts of up to `burst`.
+
+    take() may also lend tokens ahead of time: an event that arrives with
+    the bucket empty is admitted if a token will be available within
+    max_delay seconds, and the caller is told how long to wait. The debt is
+    paid back by the refill, so a client that keeps sending is slowed down
+    to exactly `rate`.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        # Caller holds self._lock
+        self.tokens = min(
+            self.burst, self.tokens + (now - self.updated) * self.rate
+        )
+        self.updated = now
+
+    def take(self, max_delay=0.0):
+        """
+        Returns 0 if the event may go ahead now, the seconds to wait before
+        it may, or None if that wait would exceed max_delay (no token is
+        taken then).
+        """
+        with self._lock:
+            self._refill(time.monotonic())
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0.0
+
+            wait = (1 - self.tokens) / self.rate
+            if wait > max_delay:
+                return None
+            self.tokens -= 1
+            return wait
+
+    def retry_after(self):
+        """
+        Seconds until the next token is available.
+        """
+        with self._lock:
+            self._refill(time.monotonic())
+            return max(0.0, (1 - self.tokens) / self.rate)
+
+    def is_full(self):
+        with self._lock:
+            self._refill(time.monotonic())
+            return self.tokens >= self.burst
+
+
+def parse_limit(text):
+    """
+    Parses "RATE:BURST" (or just "RATE", burst = rate) into a (rate, burst)
+    tuple. "0" means unlimited and gives None.
+    """
+    rate, _, burst = text.partition(":")
+    rate = float(rate)
+    if rate <= 0:
+        return None
+    burst = float(burst) if burst else max(rate, 1.0)
+    if burst < 1:
+        raise ValueError("burst must be at least 1")
+    return (rate, burst)
@@ -5,11 +5,60 @@ from common import (
     MSG_SYSTEM,
     MSG_GROUP,
     MSG_PRIVATE,
+    MSG_CHANNEL,
     MSG_ERROR,
     MSG_HISTORY_RESPONSE,
+    MSG_SEARCH_RESULTS,
     MSG_LOGIN_OK,
+    MSG_CONVERSATIONS,
+    MSG_PENDING,
+    MSG_ADMIN_RESPONSE,
+    MSG_USERLIST,
+    MSG_PRESENCE,
 )
 
+# Online list, kept up to date from userlist snapshots and presence deltas
+_online = client_net.OnlineUsers()
+
+# Oldest message id seen per conversation ("group", a username or
+# "#channel"), used as the cursor for /history
+_oldest_ids = {}
+
+
+# Filters of the last /search and the offset of its next page
+_last_search = {}
+
+
+def _parse_search(text):
+    """
+    Splits "/search" arguments into words and filters: from:<user>,
+    with:<user>, in:group, in:pm or in:#<channel>.
+    """
+    words, filters = [], {}
+    for word in text.split():
+        key, _, value = word.partition(":")
+        if key == "from" and value:
+            filters["sender"] = value
+        elif key == "with" and value:
+            filters["with_user"] = value
+        elif key == "in" and value.startswith("#"):
+            filters["channel"] = value[1:]
+        elif key == "in" and value:
+            filters["scope"] = value
+        else:
+            words.append(word)
+    filters["query"] = " ".join(words)
+    return filters
+
+
+def _remember_oldest(key, messages):
+    ids = [m["id"] for m in messages if isinstance(m, dict) and m.get("id")]
+    if key in _oldest_ids:
+        ids.append(_oldest_ids[key])
+    if ids:
+        _oldest_ids[key] = min(ids)
+
+
 def _format_history_item(item):
     """
     Tries to format history rows safely even if storage returns dicts or tuples.
@@ -24,6 +73,8 @@ def _format_history_item(item):
         text = item.get("text", "")
         if scope == "pm":
             return f"[PM] {sender} -> {target}: {text}"
+        if scope == "channel":
+            return f"[#{target}] {sender}: {text}"
         return f"{sender}: {text}"
 
     # Tuple/list format (fallback)
@@ -55,6 +106,9 @@ def on_message(msg):
     msg_type = msg.get("type")
 
     if msg_type == MSG_SYSTEM:
+        if msg.get("channel"):
+            print(f"\n[#{msg['channel']}] * {msg.get('text', '')} *")
+            return
         print(f"\n* {msg.get('text', '')} *")
         return
 
@@ -71,14 +125,34 @@ def on_message(msg):
         print(f"\n[PM] {sender} -> {target}: {text}")
         return
 
+    if msg_type == MSG_CHANNEL:
+        print(f"\n[#{msg.get('channel', '')}] {msg.get('from', '')}: {msg.get('text', '')}")
+        return
+
     if msg_type == MSG_HISTORY_RESPONSE:
         scope = msg.get("scope")
         messages = msg.get("messages", [])
 
+        if scope == "channel":
+            _remember_oldest(f"#{msg.get('channel')}", messages)
+        elif scope != "resume":
+            _remember_oldest(msg.get("with") or "group", messages)
+
+        if scope == "resume":
+            # Reconnected: only what was missed meanwhile
+            if messages:
+                print(f"\n--- Missed while disconnected ({len(messages)}) ---")
+                for item in messages:
+                    print(_format_history_item(item))
+                print("--- End Missed ---\n")
+            return
+
         if scope == "group":
             print("\n--- Group History ---")
             for item in messages:
                 print(_format_history_item(item))
+            if msg.get("has_more"):
+                print("(older messages: /history)")
             print("--- End Group History ---\n")
             return
 
@@ -87,16 +161,102 @@ def on_message(msg):
             print(f"\n--- PM History with {other} ---")
             for item in messages:
                 print(_format_history_item(item))
+            if msg.get("has_more"):
+                print(f"(older messages: /history {other})")
             print(f"--- End PM History with {other} ---\n")
             return
 
+        if scope == "channel":
+            channel = msg.get("channel", "")
+            if msg.get("after") is not None:
+                # Rejoined after a reconnect: only the missed messages
+                for item in messages:
+                    print(_format_history_item(item))
+                return
+            print(f"\n--- #{channel} History ---")
+            for item in messages:
+                print(_format_history_item(item))
+            if msg.get("has_more"):
+                print(f"(older messages: /history #{channel})")
+            print(f"--- End #{channel} History ---\n")
+            return
+
         print(f"\n[History] {msg}")
         return
 
+    if msg_type == MSG_PENDING:
+        messages = msg.get("messages", [])
+        if messages:
+            print(f"\n--- Delivered while offline ({len(messages)}) ---")
+            for item in messages:
+                print(_format_history_item(item))
+            print("--- End Delivered ---\n")
+        return
+
+    if msg_type == MSG_SEARCH_RESULTS:
+        messages = msg.get("messages", [])
+        print(f"\n--- Search '{msg.get('query', '')}' ---")
+        for item in messages:
+            print(_format_history_item(item))
+        if not messages:
+            print("(no matches)")
+        if msg.get("has_more"):
+            _last_search["offset"] = msg.get("offset", 0) + len(messages)
+            print("(more results: /search)")
+        else:
+            _last_search.pop("offset", None)
+        print("--- End Search ---\n")
+        return
+
+    if msg_type == MSG_USERLIST:
+        users = msg.get("users", [])
+        if msg.get("query"):
+            print(f"\n[Users matching '{msg['query']}'] {', '.join(users) or '(none)'}")
+            return
+        _online.apply(msg)
+        print(f"\n[Online: {_online.count}] {', '.join(sorted(_online.users))}")
+        if _online.has_more:
+            print("(more users: /users)")
+        return
+
+    if msg_type == MSG_PRESENCE:
+        # The system messages already announce joins and leaves
+        _online.apply(msg)
+        return
+
+    if msg_type == MSG_CONVERSATIONS:
+        conversations = msg.get("conversations", [])
+        if not conversations:
+            return
+
+        print("\n--- Private Conversations ---")
+        for conv in conversations:
+            other = conv.get("with", "unknown")
+            messages = conv.get("messages", [])
+            _remember_oldest(other, messages)
+
+            print(f"[{other}] {conv.get('count', len(messages))} messages")
+            for item in messages:
+                print("  " + _format_history_item(item))
+            if conv.get("count", 0) > len(messages):
+                print(f"  (older messages: /history {other})")
+        print("--- End Private Conversations ---\n")
+        return
+
     if msg_type == MSG_LOGIN_OK:
         print(f"\n[Logged in as {msg.get('username', '')}]")
         return
 
+    if msg_type == MSG_ADMIN_RESPONSE:
+        result = msg.get("result")
+        print(f"\n--- Admin: {msg.get('command', '')} ---")
+        if isinstance(result, dict):
+            for key, value in result.items():
+                print(f"  {key}: {value}")
+        else:
+            print(result)
+        return
+
     if msg_type == MSG_ERROR:
         print(f"\n[Server Error] {msg.get('message', '')}")
         return
@@ -124,6 +284,10 @@ def main():
 
     print("Type a group message and press Enter.")
     print("Private message format: /pm <username> <message>")
+    print("Channels: /join <channel>, /leave <channel>, /c <channel> <message>")
+    print("Older messages: /history  or  /history <username|#channel>")
+    print("Online users: /users  or  /users <search>")
+    print("Search: /search <words> [from:<user>] [with:<user>] [in:group|pm|#<channel>]")
     print("Exit: Ctrl+C\n")
 
     try:
@@ -140,6 +304,55 @@ def main():
                 target = parts[1].strip()
                 msg_text = parts[2].strip()
                 client_net.send_private_message(target, msg_text)
+            elif text.startswith("/join ") or text.startswith("/leave "):
+                command, _, channel = text.partition(" ")
+                channel = channel.strip().lstrip("#")
+                if command == "/join":
+                    client_net.join_channel(channel)
+                else:
+                    client_net.leave_channel(channel)
+            elif text.startswith("/c "):
+                parts = text.split(" ", 2)
+                if len(parts) < 3:
+                    print("Usage: /c <channel> <message>")
+                    continue
+                client_net.send_channel_message(parts[1].lstrip("#"), parts[2].strip())
+            elif text == "/users" or text.startswith("/users "):
+                query = text[len("/users"):].strip()
+                if query:
+                    client_net.request_users(query=query)
+                elif not _online.next_page():
+                    print(f"[Online: {_online.count}] {', '.join(sorted(_online.users))}")
+            elif text == "/search" or text.startswith("/search "):
+                args = text[len("/search"):].strip()
+                if args:
+                    _last_search.clear()
+                    _last_search.update(_parse_search(args))
+                    client_net.search(**_last_search)
+                elif "offset" in _last_search:
+                    client_net.search(**_last_search)
+                else:
+                    print("Usage: /search <words> [from:<user>] [with:<user>] [in:group|pm|#<channel>]")
+            elif text.startswith("/admin "):
+                parts = text.split()
+                if len(parts) != 3:
+                    print("Usage: /admin <token> <stats|metrics|profile_start|profile_stop>")
+                    continue
+                client_net.admin_command(parts[2], parts[1])
+            elif text == "/history" or text.startswith("/history "):
+                other = text[len("/history"):].strip()
+                if other.startswith("#"):
+                    client_net.request_history(
+                        scope="channel",
+                        channel=other[1:],
+                        before=_oldest_ids.get(other),
+                    )
+                    continue
+                client_net.request_history(
+                    scope="pm" if other else "group",
+                    with_user=other or None,
+                    before=_oldest_ids.get(other or "group"),
+                )
             else:
                 client_net.send_group_message(text)
 
@@ -1,9 +1,308 @@
-from server import start_server
-from storage import init_db
+import argparse
+import multiprocessing
+import os
+import signal
+import sys
+import tempfile
+import threading
+import time
+
+import metrics
+import profiling
+
+from bus import Hub, serve_hub
+from outbound import POLICIES
+from ratelimit import parse_limit
+from server import start_server, config, configure, get_stats, persist_then
+from storage import init_db, start_writer, stop_writer, ack_messages, DURABILITY_MODES
+from history_cache import init_cache
 
 def main():
+    parser = argparse.ArgumentParser(description="Multi-client chat server")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=12345)
+    parser.add_argument(
+        "--engine", choices=["threaded", "asyncio"], default="threaded",
+        help="thread-per-client or single asyncio event loop"
+    )
+    parser.add_argument(
+        "--queue-size", type=int, default=config["outbound_queue_size"],
+        help="frames buffered per client before the overflow policy applies"
+    )
+    parser.add_argument(
+        "--overflow-policy", choices=POLICIES, default=config["outbound_policy"],
+        help="what to do when a client's outbound queue is full"
+    )
+    parser.add_argument(
+        "--block-timeout", type=float, default=config["outbound_block_timeout"],
+        help="seconds a sender may wait under the block policy"
+    )
+    parser.add_argument(
+        "--durability", choices=DURABILITY_MODES, default=config["durability"],
+        help="deliver messages after commit, or immediately and persist async"
+    )
+    parser.add_argument(
+        "--commit-batch", type=int, default=256,
+        help="maximum rows per storage commit"
+    )
+    parser.add_argument(
+        "--commit-delay", type=float, default=0.005,
+        help="seconds the storage writer waits to grow a batch"
+    )
+    parser.add_argument(
+        "--cache-group", type=int, default=500,
+        help="newest group messages kept in memory"
+    )
+    parser.add_argument(
+        "--cache-pm-window", type=int, default=100,
+        help="newest messages kept in memory per PM conversation"
+    )
+    parser.add_argument(
+        "--cache-pm-conversations", type=int, default=5000,
+        help="PM conversations kept in memory (least recently used evicted)"
+    )
+    parser.add_argument(
+        "--cache-mb", type=int, default=64,
+        help="approximate memory budget of the PM cache in megabytes"
+    )
+    parser.add_argument(
+        "--no-compression", action="store_true",
+        help="refuse stream compression even when clients ask for it"
+    )
+    parser.add_argument(
+        "--compress-threshold", type=int, default=config["compress_threshold"],
+        help="smallest frame payload in bytes worth compressing"
+    )
+    parser.add_argument(
+        "--compress-level", type=int, choices=range(1, 10),
+        default=config["compress_level"], metavar="1-9",
+        help="zlib level for compressed connections"
+    )
+    parser.add_argument(
+        "--stats-interval", type=float, default=0,
+        help="print server stats every N seconds (0 disables)"
+    )
+    parser.add_argument(
+        "--workers", type=int, default=1,
+        help="worker processes sharing the port (SO_REUSEPORT) behind a hub"
+    )
+    parser.add_argument(
+        "--cluster-serve", metavar="HOST:PORT",
+        help="join a cluster as the node hosting its broker, listening here"
+    )
+    parser.add_argument(
+        "--cluster-join", metavar="HOST:PORT",
+        help="join a cluster through the broker at this address"
+    )
+    parser.add_argument(
+        "--cluster-token",
+        help="shared secret every cluster node must present to the broker"
+    )
+    parser.add_argument(
+        "--admin-token",
+        help="secret that enables admin commands (stats, metrics) over the protocol"
+    )
+    parser.add_argument(
+        "--metrics-port", type=int, default=0,
+        help="serve Prometheus metrics over HTTP on this port, 0 = off; "
+             "with --workers, worker N uses port + 1 + N"
+    )
+    parser.add_argument(
+        "--metrics-host", default="127.0.0.1",
+        help="address for the metrics endpoint"
+    )
+    for kind, what in (
+        ("group", "group and channel messages per user"),
+        ("private", "private messages per user"),
+        ("history", "history requests and channel joins/leaves per user"),
+        ("users", "user list requests per user"),
+        ("search", "searches per user"),
+        ("connection", "messages of any type per connection"),
+    ):
+        parser.add_argument(
+            f"--{kind}-rate", type=parse_limit, metavar="RATE[:BURST]",
+            default=config[f"{kind}_rate"],
+            help=f"token bucket for {what}, 0 = unlimited"
+        )
+    parser.add_argument(
+        "--rate-max-delay", type=float, default=config["rate_max_delay"],
+        help="seconds a client's reads may be paused by a rate limit before "
+             "its messages are rejected"
+    )
+    parser.add_argument(
+        "--presence-tick", type=float, default=config["presence_tick"],
+        help="seconds joins and leaves are collected before one combined "
+             "announcement (0 = announce each one right away)"
+    )
+    parser.add_argument(
+        "--resume-max", type=int, default=config["resume_max"],
+        help="most missed messages sent to a reconnecting client; beyond "
+             "that it gets the normal login history"
+    )
+    parser.add_argument(
+        "--pending-batch", type=int, default=config["pending_batch"],
+        help="undelivered PMs sent per batch at login; the next batch "
+             "follows once the client acked the previous one"
+    )
+    parser.add_argument(
+        "--profile-dir", default="profiles",
+        help="where profiles are written (start/stop with SIGUSR1/SIGUSR2 "
+             "or the profile_start/profile_stop admin commands)"
+    )
+    parser.add_argument(
+        "--profile-interval", type=float, default=profiling.SAMPLE_INTERVAL,
+        help="seconds between stack samples while profiling"
+    )
+    args = parser.parse_args()
+
+    if args.workers > 1 and (args.cluster_serve or args.cluster_join):
+        parser.error("--workers cannot be combined with cluster mode")
+
+    options = dict(
+        outbound_queue_size=args.queue_size,
+        outbound_policy=args.overflow_policy,
+        outbound_block_timeout=args.block_timeout,
+        durability=args.durability,
+        compression=not args.no_compression,
+        compress_threshold=args.compress_threshold,
+        compress_level=args.compress_level,
+        admin_token=args.admin_token,
+        group_rate=args.group_rate,
+        private_rate=args.private_rate,
+        history_rate=args.history_rate,
+        users_rate=args.users_rate,
+        search_rate=args.search_rate,
+        connection_rate=args.connection_rate,
+        rate_max_delay=args.rate_max_delay,
+        presence_tick=args.presence_tick,
+        resume_max=args.resume_max,
+        pending_batch=args.pending_batch,
+    )
+    profile_options = dict(
+        directory=args.profile_dir,
+        interval=args.profile_interval,
+    )
+    cache_options = dict(
+        group_size=args.cache_group,
+        pm_window=args.cache_pm_window,
+        max_conversations=args.cache_pm_conversations,
+        max_bytes=args.cache_mb * 1024 * 1024,
+    )
+
     init_db()
-    start_server(host="0.0.0.0", port=12345)
+    start_writer(max_batch=args.commit_batch, max_delay=args.commit_delay)
+
+    # Turn SIGTERM into a normal exit so pending messages get flushed
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    profiling.install(**profile_options)
+
+    if args.metrics_port:
+        start_metrics(args.metrics_host, args.metrics_port)
+
+    try:
+        if args.workers > 1:
+            run_hub(args, options, cache_options, profile_options)
+        else:
+            init_cache(**cache_options)
+            if args.stats_interval > 0:
+                start_stats(args.stats_interval)
+            start_server(
+                host=args.host,
+                port=args.port,
+                engine=args.engine,
+                bus=cluster_broker(args),
+                bus_token=args.cluster_token,
+                **options
+            )
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop_writer()
+
+def parse_address(text):
+    host, _, port = text.rpartition(":")
+    return (host or "0.0.0.0", int(port))
+
+def cluster_broker(args):
+    """
+    Returns what start_server() should link to in cluster mode: the
+    in-process broker when this node hosts it, else the remote address.
+    """
+    if args.cluster_serve:
+        hub = Hub(token=args.cluster_token)
+        serve_hub(hub, parse_address(args.cluster_serve))
+        print(f"Cluster broker listening on {args.cluster_serve}")
+        return hub
+    if args.cluster_join:
+        return parse_address(args.cluster_join)
+    return None
+
+def run_hub(args, options, cache_options, profile_options):
+    """
+    Multi-process mode: this process owns the storage writer and the hub,
+    the workers own the client sockets. Workers that die are restarted.
+    """
+    configure(**options)
+
+    bus_path = os.path.join(
+        tempfile.gettempdir(), f"chat-bus-{os.getpid()}.sock"
+    )
+    serve_hub(Hub(persist=persist_then, ack=ack_messages), bus_path)
+
+    worker_options = dict(options, bus=bus_path, reuse_port=True)
+    context = multiprocessing.get_context("spawn")
+
+    def spawn(index):
+        metrics_port = args.metrics_port and args.metrics_port + 1 + index
+        process = context.Process(
+            target=run_worker,
+            args=(args.host, args.port, args.engine, worker_options,
+                  cache_options, profile_options, args.stats_interval,
+                  args.metrics_host, metrics_port),
+            daemon=True,
+        )
+        process.start()
+        return process
+
+    workers = [spawn(i) for i in range(args.workers)]
+    print(f"Hub running with {args.workers} workers on {args.host}:{args.port}")
+
+    try:
+        while True:
+            time.sleep(1)
+            for i, process in enumerate(workers):
+                if not process.is_alive():
+                    print(f"[Hub] Worker {process.pid} exited, restarting")
+                    workers[i] = spawn(i)
+    finally:
+        for process in workers:
+            process.terminate()
+        os.unlink(bus_path)
+
+def run_worker(host, port, engine, options, cache_options, profile_options,
+               stats_interval, metrics_host="127.0.0.1", metrics_port=0):
+    profiling.install(**profile_options)
+    init_cache(**cache_options)
+    if stats_interval > 0:
+        start_stats(stats_interval)
+    if metrics_port:
+        start_metrics(metrics_host, metrics_port)
+    try:
+        start_server(host=host, port=port, engine=engine, **options)
+    except KeyboardInterrupt:
+        pass
+
+def start_stats(interval):
+    threading.Thread(target=print_stats, args=(interval,), daemon=True).start()
+
+def start_metrics(host, port):
+    metrics.serve_http(host, port)
+    print(f"Metrics on http://{host}:{port}/metrics")
+
+def print_stats(interval):
+    while True:
+        time.sleep(interval)
+        print(f"[Stats] {get_stats()}")
 
 if __name__ == "__main__":
     main()
@@ -1,25 +1,70 @@
+import bisect
+import hmac
+import os
+import re
 import socket
+import sqlite3
 import threading
-from storage import load_pm_partners
+import time
+import metrics
+import profiling
+from storage import (
+    load_recent_conversations,
+    load_messages_since,
+    load_pending,
+    ack_messages,
+    last_message_id,
+    search_messages,
+)
+from outbound import SocketConnection, POLICY_DROP_OLDEST, POLICIES
+from snapshots import VersionedFrame, GroupHistorySnapshot
+from ratelimit import TokenBucket
 
 from common import (
-    send_json,
-    recv_json,
     current_timestamp,
+    CODECS,
+    COMPRESSION_DEFLATE,
+    COMPRESS_THRESHOLD,
+    FrameCompressor,
+    JSON_CODEC,
+    FrameReader,
+    FrameTooLarge,
+    MAX_FRAME_BYTES,
     MSG_LOGIN,
     MSG_LOGIN_OK,
     MSG_GROUP,
     MSG_PRIVATE,
     MSG_SYSTEM,
+    MSG_PENDING,
+    MSG_ACK,
     MSG_ERROR,
+    MSG_HISTORY_REQUEST,
     MSG_HISTORY_RESPONSE,
+    MSG_SEARCH,
+    MSG_SEARCH_RESULTS,
     MSG_USERLIST,
+    MSG_CONVERSATIONS,
+    MSG_ADMIN,
+    MSG_ADMIN_RESPONSE,
+    MSG_CHANNEL,
+    MSG_JOIN,
+    MSG_LEAVE,
+    MSG_PRESENCE,
+    MSG_USERS_REQUEST,
+    PRESENCE_DELTA,
+    DELIVERY_ACK,
+    ACK_MAX,
 )
 
-from storage import (
+from storage import DURABILITY_COMMIT, DURABILITY_MODES
+from history_cache import (
     save_message,
     load_group_history,
     load_private_history,
+    load_channel_history,
+    add_listener,
+    get_cache,
+    notify_committed,
 )
 
 # =========================
@@ -28,7 +73,319 @@ from storage import (
 
 clients = {}        
 usernames = {}      
-lock = threading.Lock()
+# Names claimed by logins that are not yet visible to fan-out
+claimed = set()
+
+# Channel subscription index, both sides kept under lock: channel messages
+# only ever touch the members' sockets
+channels = {}       # channel name -> set of member conns
+memberships = {}    # conn -> set of channel names
+lock = metrics.TimedLock(metrics.histogram(
+    "lock_wait_seconds", "Time spent waiting for the server lock (contended only)"
+))
+
+# Bumped (under lock) every time someone logs in or out
+presence_generation = 0
+
+# Sorted list of every online user. In multi-process and cluster modes it
+# is the global list the hub last announced, and presence_generation then
+# follows the hub's version
+all_users = []
+
+# Multi-process and cluster modes: link to the hub or broker (see bus.py)
+bus = None
+
+# Tunables, overridable through start_server(**options)
+config = {
+    # Frames buffered per client before the overflow policy kicks in
+    "outbound_queue_size": 1024,
+    # One of outbound.POLICIES: drop_oldest, disconnect or block
+    "outbound_policy": POLICY_DROP_OLDEST,
+    # Seconds a producer may wait under the "block" policy
+    "outbound_block_timeout": 0.5,
+    # storage.DURABILITY_COMMIT delivers after commit, "async" right away
+    "durability": DURABILITY_COMMIT,
+    # Messages pushed per scope at login, and the largest page a client
+    # may ask for with MSG_HISTORY_REQUEST
+    "history_limit": 50,
+    "history_page_max": 200,
+    # Newest messages of each PM conversation included in the login summary
+    "pm_preview": 3,
+    # A client logging in with the last_id it saw gets only the messages
+    # it missed, unless there are more than this; then it gets the normal
+    # login history
+    "resume_max": 1000,
+    # Unacknowledged PMs per MSG_PENDING frame; the next batch goes out
+    # once the client acked the previous one
+    "pending_batch": 200,
+    # Largest frame a client may send before being disconnected
+    "max_frame_bytes": MAX_FRAME_BYTES,
+    # Grant stream compression to clients that ask for it, for payloads of
+    # at least compress_threshold bytes, at this zlib level
+    "compression": True,
+    "compress_threshold": COMPRESS_THRESHOLD,
+    "compress_level": 6,
+    # Multi-process / cluster mode: hub address (Unix socket path, (host,
+    # port) tuple or in-process bus.Hub), the token it expects, and
+    # SO_REUSEPORT for workers sharing one port
+    "bus": None,
+    "bus_token": None,
+    "reuse_port": False,
+    # Secret for MSG_ADMIN commands; admin commands are refused without one
+    "admin_token": None,
+    # Token buckets as (messages per second, burst), None = unlimited: per
+    # user for each message type, and for everything one connection sends
+    "group_rate": (10, 30),
+    "private_rate": (10, 30),
+    "history_rate": (5, 20),
+    "connection_rate": (30, 60),
+    # Longest a client's reader is paused to keep it within its limits;
+    # messages that would need longer are rejected with MSG_ERROR
+    "rate_max_delay": 1.0,
+    "users_rate": (5, 20),
+    # Users in the login snapshot of a delta client; larger servers send
+    # the first page and clients read the rest with MSG_USERS_REQUEST
+    "userlist_login_max": 1000,
+    "userlist_page_max": 500,
+    # Logins and logouts are announced together, at most this many seconds
+    # late: one system notice and one presence delta per tick. 0 sends each
+    # one right away
+    "presence_tick": 0.05,
+    # Channels one connection may be a member of at once
+    "max_channels": 100,
+    # MSG_SEARCH: results per page by default and at most, and the longest
+    # query accepted
+    "search_limit": 20,
+    "search_page_max": 50,
+    "search_query_max": 256,
+    "search_rate": (2, 10),
+}
+
+# =========================
+# Metrics
+# =========================
+
+_group_seconds = metrics.histogram(
+    "handle_group_seconds", "handle_group_message time, excluding the commit"
+)
+_private_seconds = metrics.histogram(
+    "handle_private_seconds", "handle_private_message time, excluding the commit"
+)
+_channel_seconds = metrics.histogram(
+    "handle_channel_seconds", "handle_channel_message time, excluding the commit"
+)
+_fanout_seconds = metrics.histogram(
+    "fanout_seconds", "Time to encode and queue one message for its recipients"
+)
+_send_history_seconds = metrics.histogram(
+    "send_history_seconds", "Login history (group snapshot + conversations) time"
+)
+_history_request_seconds = metrics.histogram(
+    "history_request_seconds", "MSG_HISTORY_REQUEST handling time"
+)
+_search_seconds = metrics.histogram(
+    "search_request_seconds", "MSG_SEARCH handling time"
+)
+_presence_seconds = metrics.histogram(
+    "presence_broadcast_seconds", "broadcast_presence time"
+)
+
+metrics.describe("connections_total", "Accepted client connections")
+metrics.describe("logins_total", "Successful logins")
+metrics.describe("logins_rejected_total", "Rejected logins")
+metrics.describe("messages_received_total", "Messages received from logged in clients")
+metrics.describe("fanout_frames_total", "Frames queued by broadcasts")
+metrics.describe("pending_delivered_total", "PMs sent from pending queues at login")
+metrics.describe("acks_total", "PMs acknowledged by their recipient")
+metrics.describe("resumed_logins_total", "Logins answered with only the missed messages")
+metrics.describe("resume_fallbacks_total", "Resuming logins that missed too much and got the full login history")
+metrics.describe("rate_limit_delayed_total", "Messages whose reader was paused by a rate limit")
+metrics.describe("rate_limit_rejected_total", "Messages rejected by a rate limit")
+
+
+
+def new_connection(sock):
+    return SocketConnection(
+        sock,
+        maxsize=config["outbound_queue_size"],
+        policy=config["outbound_policy"],
+        block_timeout=config["outbound_block_timeout"],
+    )
+
+
+def _connections():
+    with lock:
+        return list(clients)
+
+
+def claim_username(username):
+    """
+    Reserves a username for a login in progress. Returns False if it is
+    taken. With a bus, the claim is made at the hub so it holds across
+    workers. Nothing is sent to the connection until register_user().
+    """
+    with lock:
+        if username in usernames or username in claimed:
+            return False
+        if bus is None:
+            claimed.add(username)
+            return True
+
+    reply = bus.request("claim", username=username)
+    if not reply["ok"]:
+        return False
+    with lock:
+        claimed.add(username)
+    _apply_presence(reply)
+    return True
+
+
+def register_user(username, conn):
+    """
+    Makes a claimed username's connection visible to broadcasts and PMs.
+    Called once login_ok and the codec switch are queued, so nothing
+    reaches the client ahead of them.
+    """
+    global presence_generation
+
+    with lock:
+        claimed.discard(username)
+        clients[conn] = username
+        usernames[username] = conn
+        if bus is None:
+            presence_generation += 1
+            bisect.insort(all_users, username)
+            _record_change(username, True)
+
+
+def send(conn, message):
+    """
+    Queues one message for a connection, encoded with its wire codec.
+    """
+    conn.sendall(conn.codec.encode(message))
+
+
+def broadcast(message, conns=None):
+    """
+    Serializes a message once per wire codec in use and queues the same
+    bytes for every connection (all logged in clients by default).
+    """
+    started = time.perf_counter()
+    if conns is None:
+        conns = _connections()
+
+    encoded = {}
+    for conn in conns:
+        data = encoded.get(conn.codec)
+        if data is None:
+            encode_started = time.perf_counter()
+            data = encoded[conn.codec] = conn.codec.encode(message)
+            if profiling.tracing:
+                profiling.span("encode", encode_started, codec=conn.codec.name)
+        conn.sendall(data)
+
+    ended = time.perf_counter()
+    _fanout_seconds.observe(ended - started)
+    metrics.incr("fanout_frames_total", len(conns))
+    if profiling.tracing:
+        profiling.span(
+            "fanout", started, ended,
+            id=message.get("id"), type=message.get("type"),
+            recipients=len(conns), codecs=len(encoded),
+        )
+
+
+def login(conn, reader, msg):
+    """
+    Handles the MSG_LOGIN handshake shared by both engines. Registers the
+    user, agrees on the wire codec and replies. Returns the username, or
+    None if the login was rejected.
+    """
+    if not msg or msg.get("type") != MSG_LOGIN:
+        metrics.incr("logins_rejected_total")
+        send(conn, {
+            "type": MSG_ERROR,
+            "message": "Login required"
+        })
+        return None
+
+    username = msg.get("username")
+
+    # The online list is kept sorted, so names must be comparable strings
+    if not isinstance(username, str) or not username.strip():
+        metrics.incr("logins_rejected_total")
+        send(conn, {
+            "type": MSG_ERROR,
+            "message": "Invalid username"
+        })
+        return None
+
+    if not claim_username(username):
+        metrics.incr("logins_rejected_total")
+        send(conn, {
+            "type": MSG_ERROR,
+            "message": "Username already taken"
+        })
+        return None
+
+    # Unknown codecs quietly fall back to JSON; the reply says which one won
+    codec = CODECS.get(msg.get("codec"), JSON_CODEC)
+
+    # Compressed frames are flagged in the length header, so line-delimited
+    # JSON never gets compression
+    compress = (
+        config["compression"]
+        and codec.framing == "length"
+        and msg.get("compress") == COMPRESSION_DEFLATE
+    )
+
+    reply = {
+        "type": MSG_LOGIN_OK,
+        "username": username,
+        "codec": codec.name
+    }
+    if compress:
+        reply["compress"] = COMPRESSION_DEFLATE
+    # Clients that don't ask keep getting the full userlist on every change
+    if msg.get("presence") == PRESENCE_DELTA:
+        reply["presence"] = PRESENCE_DELTA
+        conn.presence_deltas = True
+    if msg.get("delivery") == DELIVERY_ACK:
+        reply["delivery"] = DELIVERY_ACK
+        conn.acks = True
+    # A reconnecting client says what it saw last; see send_history()
+    last_id = msg.get("last_id")
+    if type(last_id) is int and last_id >= 0:
+        conn.resume_after = last_id
+    send(conn, reply)
+
+    # Everything after login_ok uses the negotiated codec, both ways
+    conn.codec = codec
+    reader.set_codec(codec)
+
+    if compress:
+        conn.start_compression(FrameCompressor(
+            threshold=config["compress_threshold"],
+            level=config["compress_level"],
+            on_frame=_count_compression,
+        ))
+        reader.enable_compression()
+
+    # Only now may fan-out reach the connection: after login_ok, in the
+    # negotiated codec and behind the compression switch
+    register_user(username, conn)
+
+    metrics.incr("logins_total")
+    return username
+
+
+def _count_compression(raw_bytes, compressed_bytes, cpu_seconds):
+    metrics.incr_many({
+        "compress_frames": 1,
+        "compress_bytes_in": raw_bytes,
+        "compress_bytes_out": compressed_bytes,
+        "compress_cpu_seconds": cpu_seconds,
+    })
 
 
 # =========================
@@ -37,75 +394,205 @@ lock = threading.Lock()
 
 def handle_client(client_socket):
     username = None
+    conn = new_connection(client_socket)
+    reader = FrameReader(client_socket, max_frame=config["max_frame_bytes"])
+    metrics.incr("connections_total")
 
     try:
         # ---- LOGIN ----
-        msg = recv_json(client_socket)
-        if not msg or msg.get("type") != MSG_LOGIN:
-            send_json(client_socket, {
-                "type": MSG_ERROR,
-                "message": "Login required"
-            })
+        username = login(conn, reader, reader.read_message())
+        if username is None:
             return
 
-        username = msg.get("username")
-
-        with lock:
-            if username in usernames:
-                send_json(client_socket, {
-                    "type": MSG_ERROR,
-                    "message": "Username already taken"
-                })
-                return
-
-            clients[client_socket] = username
-            usernames[username] = client_socket
-
-        send_json(client_socket, {
-            "type": MSG_LOGIN_OK,
-            "username": username
-        })
-
-        send_userlist(client_socket)
+        send_userlist(conn)
 
-        send_history(client_socket, username)
+        send_history(conn, username)
 
-        broadcast_system(f"{username} joined the chat")
-
-        broadcast_userlist()
+        announce_presence(username, joined=True)
 
         # ---- MAIN LOOP ----
         while True:
-            msg = recv_json(client_socket)
-            if msg is None:
+            messages = reader.read_messages()
+            if messages is None:
                 break
 
-            msg_type = msg.get("type")
-
-            if msg_type == MSG_GROUP:
-                handle_group_message(username, msg)
-
-            elif msg_type == MSG_PRIVATE:
-                handle_private_message(username, msg)
+            for msg in messages:
+                allowed, delay = admit(conn, username, msg)
+                if delay:
+                    # Not reading lets TCP push back on the sender
+                    time.sleep(delay)
+                if allowed:
+                    handle_message(conn, username, msg)
+
+    except FrameTooLarge as e:
+        send(conn, {
+            "type": MSG_ERROR,
+            "message": str(e)
+        })
 
     except Exception as e:
         print(f"[Server Error] {e}")
 
     finally:
-        remove_client(client_socket)
+        remove_client(conn)
 
 
 
+# =========================
+# Rate limiting
+# =========================
+
+# Message type -> config key of its per-user limit. Types with the same key
+# draw from one bucket: group and channel messages share group_rate, and
+# channel joins (a history read each) and leaves share history_rate
+RATE_LIMITED_TYPES = {
+    MSG_GROUP: "group_rate",
+    MSG_PRIVATE: "private_rate",
+    MSG_CHANNEL: "group_rate",
+    MSG_HISTORY_REQUEST: "history_rate",
+    MSG_JOIN: "history_rate",
+    MSG_LEAVE: "history_rate",
+    MSG_USERS_REQUEST: "users_rate",
+    MSG_SEARCH: "search_rate",
+}
+
+# Answers to server traffic; limiting them would only slow delivery down
+RATE_EXEMPT_TYPES = {MSG_ACK}
+
+# Buckets outlive a connection while they are in debt, so reconnecting
+# does not reset a user's limits
+_bucket_lock = threading.Lock()
+_connection_buckets = {}    # conn -> TokenBucket
+_user_buckets = {}          # username -> {limit config key: TokenBucket}
+
+
+def _bucket(buckets, key, limit):
+    bucket = buckets.get(key)
+    if bucket is None:
+        with _bucket_lock:
+            bucket = buckets.setdefault(key, TokenBucket(*limit))
+    return bucket
+
+
+def admit(conn, username, msg):
+    """
+    Applies the rate limits to one message from a logged in client.
+    Returns (allowed, delay): the engine pauses reading from the client for
+    `delay` seconds, then handles the message if allowed. A message that
+    would need a pause longer than rate_max_delay is rejected with
+    MSG_ERROR, and the reader still pauses until the limit frees up (at
+    most rate_max_delay).
+    """
+    msg_type = msg.get("type")
+    if msg_type in RATE_EXEMPT_TYPES:
+        return True, 0.0
+
+    max_delay = config["rate_max_delay"]
+    checks = []
+
+    limit = config["connection_rate"]
+    if limit:
+        checks.append(_bucket(_connection_buckets, conn, limit))
+
+    key = RATE_LIMITED_TYPES.get(msg_type)
+    limit = key and config[key]
+    if limit:
+        with _bucket_lock:
+            per_type = _user_buckets.setdefault(username, {})
+        checks.append(_bucket(per_type, key, limit))
+
+    delay = 0.0
+    for bucket in checks:
+        wait = bucket.take(max_delay)
+        if wait is None:
+            metrics.incr("rate_limit_rejected_total")
+            send(conn, {
+                "type": MSG_ERROR,
+                "message": f"Rate limit exceeded, {msg_type} message dropped"
+            })
+            return False, min(bucket.retry_after(), max_delay)
+        delay = max(delay, wait)
+
+    if delay:
+        metrics.incr("rate_limit_delayed_total")
+    return True, delay
+
+
+def _forget_buckets(conn, username):
+    with _bucket_lock:
+        _connection_buckets.pop(conn, None)
+        per_type = _user_buckets.get(username)
+        if per_type is not None and all(b.is_full() for b in per_type.values()):
+            del _user_buckets[username]
+
+
 # =========================
 # Message handlers
 # =========================
 
-def handle_group_message(sender, msg):
+# Message types whose handlers may block (SQLite reads, admin commands
+# such as profile_stop writing its files); the asyncio engine runs these
+# in its executor instead of on the event loop
+BLOCKING_TYPES = {MSG_HISTORY_REQUEST, MSG_JOIN, MSG_SEARCH, MSG_ACK, MSG_ADMIN}
+
+
+def handle_message(conn, username, msg):
+    """
+    Dispatches one message from a logged in client. Shared by both engines.
+    """
+    msg_type = msg.get("type")
+    metrics.incr("messages_received_total")
+
+    if msg_type == MSG_GROUP:
+        handle_group_message(conn, username, msg)
+
+    elif msg_type == MSG_PRIVATE:
+        handle_private_message(conn, username, msg)
+
+    elif msg_type == MSG_CHANNEL:
+        handle_channel_message(conn, username, msg)
+
+    elif msg_type == MSG_JOIN:
+        handle_join(conn, username, msg)
+
+    elif msg_type == MSG_LEAVE:
+        handle_leave(conn, username, msg)
+
+    elif msg_type == MSG_HISTORY_REQUEST:
+        handle_history_request(conn, username, msg)
+
+    elif msg_type == MSG_ACK:
+        handle_ack(conn, username, msg)
+
+    elif msg_type == MSG_SEARCH:
+        handle_search(conn, username, msg)
+
+    elif msg_type == MSG_USERS_REQUEST:
+        handle_users_request(conn, msg)
+
+    elif msg_type == MSG_ADMIN:
+        handle_admin(conn, username, msg)
+
+
+def _invalid_message(conn, text, target=""):
+    # Anything but strings would fail the INSERT, after fan-out already
+    # saw the message
+    if isinstance(text, str) and isinstance(target, str):
+        return False
+    send(conn, {
+        "type": MSG_ERROR,
+        "message": "Invalid message"
+    })
+    return True
+
+
+def handle_group_message(conn, sender, msg):
+    started = time.perf_counter()
     text = msg.get("text")
+    if _invalid_message(conn, text):
+        return
     ts = current_timestamp()
 
-    save_message(ts, sender, "group", None, text)
-
     message = {
         "type": MSG_GROUP,
         "from": sender,
@@ -113,18 +600,21 @@ def handle_group_message(sender, msg):
         "ts": ts
     }
 
-    with lock:
-        for sock in clients:
-            send_json(sock, message)
+    publish(message, "group", None)
+    ended = time.perf_counter()
+    _group_seconds.observe(ended - started)
+    if profiling.tracing:
+        profiling.span("receive group", started, ended, id=message.get("id"))
 
 
-def handle_private_message(sender, msg):
+def handle_private_message(conn, sender, msg):
+    started = time.perf_counter()
     target = msg.get("target")
     text = msg.get("text")
+    if _invalid_message(conn, text, target):
+        return
     ts = current_timestamp()
 
-    save_message(ts, sender, "pm", target, text)
-
     message = {
         "type": MSG_PRIVATE,
         "from": sender,
@@ -133,109 +623,987 @@ def handle_private_message(sender, msg):
         "ts": ts
     }
 
+    publish(message, "pm", target)
+    ended = time.perf_counter()
+    _private_seconds.observe(ended - started)
+    if profiling.tracing:
+        profiling.span("receive private", started, ended, id=message.get("id"))
+
+
+# =========================
+# Channels
+# =========================
+
+_CHANNEL_NAME = re.compile(r"[A-Za-z0-9_-]{1,32}")
+
+
+def _channel_error(conn, text):
+    send(conn, {
+        "type": MSG_ERROR,
+        "message": text
+    })
+
+
+def handle_join(conn, username, msg):
+    """
+    Subscribes the connection to a channel (created on first join), sends
+    it the channel's recent history and tells the members. A client
+    rejoining after a reconnect passes `after` to get only what it missed.
+    """
+    channel = msg.get("channel")
+    if not isinstance(channel, str) or not _CHANNEL_NAME.fullmatch(channel):
+        _channel_error(conn, "Invalid channel name")
+        return
+
+    with lock:
+        joined = memberships.setdefault(conn, set())
+        if channel in joined:
+            return
+        if len(joined) >= config["max_channels"]:
+            full = True
+        else:
+            full = False
+            joined.add(channel)
+            channels.setdefault(channel, set()).add(conn)
+
+    if full:
+        _channel_error(conn, f"Too many channels (max {config['max_channels']})")
+        return
+
+    request = {"scope": "channel", "channel": channel}
+    if msg.get("after") is not None:
+        request["after"] = msg["after"]
+    handle_history_request(conn, username, request)
+    broadcast_system(f"{username} joined #{channel}", channel=channel)
+
+
+def handle_leave(conn, username, msg):
+    channel = msg.get("channel")
+    if not isinstance(channel, str):
+        return
+
+    with lock:
+        left = _unsubscribe(conn, channel)
+
+    if left:
+        # Sent after leaving, so it goes to the remaining members; the
+        # leaver learns from the missing messages
+        broadcast_system(f"{username} left #{channel}", channel=channel)
+
+
+def _unsubscribe(conn, channel):
+    # Caller holds lock. Returns True if conn was a member
+    joined = memberships.get(conn)
+    if not joined or channel not in joined:
+        return False
+    joined.discard(channel)
+    members = channels[channel]
+    members.discard(conn)
+    if not members:
+        del channels[channel]
+    return True
+
+
+def handle_channel_message(conn, sender, msg):
+    started = time.perf_counter()
+    channel = msg.get("channel")
+
+    if not _is_member(conn, channel):
+        _channel_error(conn, f"Not a member of #{channel}")
+        return
+    if _invalid_message(conn, msg.get("text")):
+        return
+
+    message = {
+        "type": MSG_CHANNEL,
+        "from": sender,
+        "channel": channel,
+        "text": msg.get("text"),
+        "ts": current_timestamp()
+    }
+
+    publish(message, "channel", channel)
+    ended = time.perf_counter()
+    _channel_seconds.observe(ended - started)
+    if profiling.tracing:
+        profiling.span("receive channel", started, ended, id=message.get("id"))
+
+
+def _is_member(conn, channel):
     with lock:
-        target_sock = usernames.get(target)
-        sender_sock = usernames.get(sender)
+        return isinstance(channel, str) and channel in memberships.get(conn, ())
+
+
+def _channel_members(channel):
+    with lock:
+        return list(channels.get(channel, ()))
+
 
-    if target_sock:
-        send_json(target_sock, message)
-    if sender_sock:
-        send_json(sender_sock, message)
+def deliver_local(message):
+    """
+    Hands a stored chat message (or a system notice) to the sockets of
+    this process that should see it: the members for channel messages and
+    notices, sender and target for PMs, everybody otherwise.
+    """
+    channel = message.get("channel")
+    if channel is not None:
+        broadcast(message, _channel_members(channel))
+        return
 
+    if message["type"] != MSG_PRIVATE:
+        broadcast(message)
+        return
 
-def broadcast_system(text):
+    with lock:
+        target_sock = usernames.get(message["target"])
+        sender_sock = usernames.get(message["from"])
+
+    broadcast(message, [s for s in (target_sock, sender_sock) if s])
+
+
+def publish(message, scope, target):
+    """
+    Stores a chat message and delivers it. With a bus, the hub stores it
+    and sends it back to every worker, this one included.
+    """
+    if bus is not None:
+        bus.send("publish", message=message, scope=scope, target=target)
+    else:
+        persist_then(message, scope, target, lambda: deliver_local(message))
+
+
+def persist_then(message, scope, target, deliver):
+    """
+    Saves a message, stamps it with its id and runs deliver() according to
+    the durability setting: after the storage writer committed it, or
+    immediately. A message that already has an id (assigned by a cluster
+    broker) is stored under that id.
+    """
+    def on_commit(msg_id):
+        message["id"] = msg_id
+        deliver()
+
+    args = (message["ts"], message["from"], scope, target, message["text"])
+    msg_id = message.get("id")
+
+    if config["durability"] == DURABILITY_COMMIT:
+        # Ids are assigned at submit time; stamping it now lets the caller
+        # (and its trace span) see it before the commit
+        message["id"] = save_message(*args, on_commit=on_commit, msg_id=msg_id)
+    else:
+        on_commit(save_message(*args, msg_id=msg_id))
+
+
+def broadcast_system(text, channel=None):
+    """
+    Sends a notice to everybody, or only to the members of `channel`.
+    """
     message = {
         "type": MSG_SYSTEM,
         "text": text,
         "ts": current_timestamp()
     }
+    if channel is not None:
+        message["channel"] = channel
+
+    if bus is not None:
+        bus.send("relay", message=message)
+    else:
+        deliver_local(message)
+
+# =========================
+# Presence
+# =========================
+
+# Users who logged in (True) or out (False) since the last delta, and the
+# presence_generation that delta brought clients to
+_presence_changes = {}
+presence_broadcast_version = 0
+
+# Keeps deltas in version order on every connection
+_presence_lock = threading.Lock()
 
-    with lock:
-        for sock in clients:
-            send_json(sock, message)
 
-def send_userlist(sock):
+def _record_change(username, online):
+    # Caller holds lock. Logging in and out again (or the reverse) before
+    # the next delta leaves nothing to report
+    if _presence_changes.get(username) == (not online):
+        del _presence_changes[username]
+    else:
+        _presence_changes[username] = online
+
+
+def _build_userlist():
     with lock:
-        users = sorted(usernames.keys())
+        users = list(all_users)
+        version = presence_generation
 
-    send_json(sock, {
+    return {
         "type": MSG_USERLIST,
         "users": users,
+        "version": version,
         "ts": current_timestamp()
-    })
+    }
 
 
-def broadcast_userlist():
+def _build_userlist_snapshot():
     with lock:
-        users = sorted(usernames.keys())
-        sockets = list(clients.keys())
+        users = all_users[:config["userlist_login_max"]]
+        count = len(all_users)
+        version = presence_generation
 
-    msg = {
+    return {
         "type": MSG_USERLIST,
         "users": users,
+        "count": count,
+        "has_more": count > len(users),
+        "version": version,
         "ts": current_timestamp()
     }
 
-    for s in sockets:
-        try:
-            send_json(s, msg)
-        except Exception:
-            pass
+
+# Encoded userlist frames, shared until the next login or logout: the full
+# list for older clients, the login snapshot for delta clients
+userlist_frame = VersionedFrame(_build_userlist)
+userlist_snapshot_frame = VersionedFrame(_build_userlist_snapshot)
+
+
+def send_userlist(conn):
+    frame = userlist_snapshot_frame if conn.presence_deltas else userlist_frame
+    conn.sendall(frame.get(presence_generation, conn.codec))
 
 
+@metrics.timed(_presence_seconds)
+def broadcast_presence():
+    """
+    Tells every client about the logins and logouts since the last call,
+    in one MSG_PRESENCE delta:
+
+        {"since": v0, "version": v1, "count": n, "joined": [...], "left": [...]}
+
+    joined/left hold each user's final state, so applying a delta to any
+    list between v0 and v1 yields the list at v1. A client whose version
+    is older than `since` missed a delta and asks for a new snapshot with
+    MSG_USERS_REQUEST. Clients that did not negotiate deltas get the full
+    userlist instead.
+    """
+    global _presence_changes, presence_broadcast_version
+
+    with _presence_lock:
+        with lock:
+            # The hub's presence push and our own login/logout path can
+            # both get here for the same change
+            if not _presence_changes:
+                return
+            changes = _presence_changes
+            _presence_changes = {}
+            since = presence_broadcast_version
+            version = presence_broadcast_version = presence_generation
+            count = len(all_users)
+            conns = list(clients)
+
+        delta = {
+            "type": MSG_PRESENCE,
+            "since": since,
+            "version": version,
+            "count": count,
+            "joined": [u for u, online in changes.items() if online],
+            "left": [u for u, online in changes.items() if not online]
+        }
+        broadcast(delta, [c for c in conns if c.presence_deltas])
+
+        for c in conns:
+            if not c.presence_deltas:
+                c.sendall(userlist_frame.get(version, c.codec))
+
+
+# Join/leave notices waiting for the next tick: username -> True if the
+# user joined, False if they left
+_pending_notices = {}
+_tick_timer = None
+_tick_lock = threading.Lock()
+
+
+def announce_presence(username, joined):
+    """
+    Queues the notice for a login or logout and schedules the next flush.
+    A user who leaves and comes back within one tick (or the reverse) is
+    not announced at all.
+    """
+    with _tick_lock:
+        if _pending_notices.get(username) == (not joined):
+            del _pending_notices[username]
+        else:
+            _pending_notices[username] = joined
+    schedule_presence()
+
+
+def schedule_presence():
+    """
+    Makes sure flush_presence() runs within presence_tick seconds, or runs
+    it right away when ticks are off.
+    """
+    global _tick_timer
+
+    tick = config["presence_tick"]
+    if tick <= 0:
+        flush_presence()
+        return
+
+    with _tick_lock:
+        if _tick_timer is not None:
+            return
+        _tick_timer = threading.Timer(tick, flush_presence)
+        _tick_timer.daemon = True
+        _tick_timer.start()
+
+
+def flush_presence():
+    """
+    Sends what changed since the last flush: one system notice naming
+    everyone who joined or left, and one presence delta.
+    """
+    global _tick_timer
+
+    with _tick_lock:
+        _tick_timer = None
+        notices = dict(_pending_notices)
+        _pending_notices.clear()
+
+    text = _presence_notice(notices)
+    if text:
+        broadcast_system(text)
+    broadcast_presence()
+
+
+def _presence_notice(notices):
+    joined = sorted(u for u, j in notices.items() if j)
+    left = sorted(u for u, j in notices.items() if not j)
+
+    parts = []
+    if joined:
+        parts.append(f"{_name_list(joined)} joined the chat")
+    if left:
+        verb = "is" if len(left) == 1 else "are"
+        parts.append(f"{_name_list(left)} {verb} no longer with us.. :c)")
+    return "; ".join(parts)
+
+
+def _name_list(users, shown=3):
+    if len(users) == 1:
+        return users[0]
+    if len(users) <= shown:
+        return f"{', '.join(users[:-1])} and {users[-1]}"
+    return f"{', '.join(users[:shown])} and {len(users) - shown} others"
+
+
+def handle_users_request(conn, msg):
+    """
+    Answers MSG_USERS_REQUEST with one page of the sorted online list:
+    users after the name `after`, only those containing `query` (case
+    insensitive) if given, at most `limit`. Without query and after, the
+    reply is a fresh snapshot that resets the client's list.
+    """
+    query = msg.get("query")
+    after = msg.get("after")
+    limit = msg.get("limit", config["userlist_page_max"])
+
+    if (
+        not isinstance(limit, int)
+        or not (query is None or isinstance(query, str))
+        or not (after is None or isinstance(after, str))
+    ):
+        send(conn, {
+            "type": MSG_ERROR,
+            "message": "Invalid users request"
+        })
+        return
+    limit = max(1, min(limit, config["userlist_page_max"]))
+
+    with lock:
+        version = presence_generation
+        count = len(all_users)
+        start = bisect.bisect_right(all_users, after) if after else 0
+        if query:
+            # Scanned outside the lock
+            candidates = all_users[start:]
+        else:
+            candidates = all_users[start:start + limit + 1]
+
+    if query:
+        needle = query.lower()
+        users = []
+        for u in candidates:
+            if needle in u.lower():
+                users.append(u)
+                if len(users) > limit:
+                    break
+    else:
+        users = candidates
+
+    send(conn, {
+        "type": MSG_USERLIST,
+        "users": users[:limit],
+        "count": count,
+        "has_more": len(users) > limit,
+        "version": version,
+        "query": query,
+        "after": after,
+        "ts": current_timestamp()
+    })
+
 
 # =========================
 # History handling
 # =========================
 
 
+# Encoded login group-history frame, extended as group messages commit
+group_history_snapshot = GroupHistorySnapshot(
+    lambda limit: load_group_history(limit=limit),
+    limit=config["history_limit"],
+)
+
+
+def _on_committed(row):
+    if row["scope"] == "group":
+        group_history_snapshot.add(row)
+
+
+add_listener(_on_committed)
+
+
+@metrics.timed(_send_history_seconds)
 def send_history(sock, username):
-    group_history = load_group_history(limit=50)
+    resumed = (
+        sock.resume_after is not None
+        and send_missed(sock, username, sock.resume_after)
+    )
+    if not resumed:
+        # Concurrent logins share one prebuilt buffer
+        sock.sendall(group_history_snapshot.get(sock.codec))
+
+        # One query and one frame for every PM conversation; clients pull
+        # the rest of a conversation on demand with MSG_HISTORY_REQUEST
+        conversations = load_recent_conversations(
+            username, per_conversation=config["pm_preview"]
+        )
+
+        send(sock, {
+            "type": MSG_CONVERSATIONS,
+            "conversations": conversations
+        })
 
-    send_json(sock, {
+    if sock.acks:
+        drain_pending(sock, username)
+    else:
+        # Clients that never ack would find their queue growing forever;
+        # for them the login history counts as delivery
+        _ack(username, None)
+
+
+def send_missed(conn, username, after):
+    """
+    Sends a reconnecting client only what it missed since message `after`:
+    one history_response with scope "resume" holding the group messages
+    and the user's PMs, oldest first (for clients that ack, only the PMs
+    they sent: received ones come from their pending queue). Returns
+    False, sending nothing, when
+    the gap is larger than resume_max or `after` is unknown here (say, a
+    reset database); the client then gets the normal login history.
+    """
+    if after > last_message_id():
+        metrics.incr("resume_fallbacks_total")
+        return False
+
+    limit = config["resume_max"]
+    messages = load_messages_since(
+        username, after, limit=limit + 1, received=not conn.acks
+    )
+    if len(messages) > limit:
+        metrics.incr("resume_fallbacks_total")
+        return False
+
+    send(conn, {
         "type": MSG_HISTORY_RESPONSE,
-        "scope": "group",
-        "messages": group_history
+        "scope": "resume",
+        "after": after,
+        "has_more": False,
+        "messages": messages
     })
+    metrics.incr("resumed_logins_total")
+    return True
 
-    pm_partners = load_pm_partners(username)
 
-    for other in pm_partners:
-        pm_history = load_private_history(username, other, limit=50)
-        if pm_history:
-            send_json(sock, {
-                "type": MSG_HISTORY_RESPONSE,
-                "scope": "pm",
-                "with": other,
-                "messages": pm_history
-            })
+# =========================
+# Store and forward
+# =========================
+
+def drain_pending(conn, username):
+    """
+    Sends the next batch of PMs `username` has not acknowledged yet, as
+    one MSG_PENDING frame, starting after the batch in flight. The client
+    acks the batch, and the ack of its last message triggers the next
+    one, so a large backlog never floods the outbound queue.
+    """
+    batch = config["pending_batch"]
+    messages = load_pending(
+        username, after_id=conn.pending_cursor or 0, limit=batch + 1
+    )
+    has_more = len(messages) > batch
+    messages = messages[:batch]
+
+    conn.pending_cursor = messages[-1]["id"] if has_more else None
+    if not messages:
+        return
+
+    metrics.incr("pending_delivered_total", len(messages))
+    send(conn, {
+        "type": MSG_PENDING,
+        "has_more": has_more,
+        "messages": messages
+    })
+
+
+def handle_ack(conn, username, msg):
+    """
+    Removes the acknowledged PMs (`ids`) from the user's pending queue and
+    sends the next pending batch once the one in flight is acked.
+    """
+    ids = msg.get("ids")
+    if (not isinstance(ids, list) or len(ids) > ACK_MAX
+            or not all(type(i) is int for i in ids)):
+        send(conn, {
+            "type": MSG_ERROR,
+            "message": "Invalid ack"
+        })
+        return
+
+    if ids:
+        metrics.incr("acks_total", len(ids))
+        _ack(username, ids)
+
+    cursor = conn.pending_cursor
+    if cursor is not None and cursor in ids:
+        drain_pending(conn, username)
+
+
+def _ack(username, ids):
+    # The hub owns the storage in multi-process mode; a cluster broker
+    # passes acks on to every node, since each keeps its own copy
+    if bus is not None:
+        bus.send("ack", username=username, ids=ids)
+    else:
+        ack_messages(username, ids)
+
+
+@metrics.timed(_history_request_seconds)
+def handle_history_request(conn, username, msg):
+    """
+    Serves one page of history: up to `limit` messages older than the id in
+    `before` (newest page when omitted), for the group, for the PM
+    conversation `with` another user, or for a `channel` the connection is
+    a member of. With `after`, only messages newer than that id are sent;
+    has_more then means some between `after` and the page were left out.
+    """
+    scope = msg.get("scope", "group")
+    before = msg.get("before")
+    after = msg.get("after")
+    other = msg.get("with")
+    channel = msg.get("channel")
+
+    try:
+        limit = int(msg.get("limit", config["history_limit"]))
+        before = int(before) if before is not None else None
+        after = int(after) if after is not None else None
+    except (TypeError, ValueError):
+        send(conn, {
+            "type": MSG_ERROR,
+            "message": "Invalid history request"
+        })
+        return
 
+    limit = max(1, min(limit, config["history_page_max"]))
+
+    # One extra row tells whether an older page exists
+    if scope == "group":
+        messages = load_group_history(limit=limit + 1, before_id=before)
+    elif scope == "pm" and other:
+        messages = load_private_history(
+            username, other, limit=limit + 1, before_id=before
+        )
+    elif scope == "channel" and _is_member(conn, channel):
+        messages = load_channel_history(
+            channel, limit=limit + 1, before_id=before
+        )
+    else:
+        send(conn, {
+            "type": MSG_ERROR,
+            "message": "Invalid history request"
+        })
+        return
+
+    if after is not None:
+        messages = [m for m in messages if m["id"] > after]
+
+    has_more = len(messages) > limit
+    if has_more:
+        messages = messages[1:]
+
+    reply = {
+        "type": MSG_HISTORY_RESPONSE,
+        "scope": scope,
+        "before": before,
+        "has_more": has_more,
+        "messages": messages
+    }
+    if after is not None:
+        reply["after"] = after
+    if scope == "pm":
+        reply["with"] = other
+    elif scope == "channel":
+        reply["channel"] = channel
+
+    send(conn, reply)
+
+
+# =========================
+# Search
+# =========================
+
+_SEARCH_SCOPES = ("group", "pm", "channel")
+
+
+def _optional_int(value):
+    return None if value is None else int(value)
+
+
+@metrics.timed(_search_seconds)
+def handle_search(conn, username, msg):
+    """
+    Answers MSG_SEARCH with one page of ranked matches among the messages
+    this user may read: group messages, their own PMs and the channels the
+    connection has joined. Optional filters: `scope`, `from` (sender),
+    `with` (PM partner), `channel`, and `since` / `until` timestamps.
+    """
+    query = msg.get("query")
+    scope = msg.get("scope")
+    sender = msg.get("from")
+    other = msg.get("with")
+    channel = msg.get("channel")
+
+    try:
+        limit = int(msg.get("limit", config["search_limit"]))
+        offset = int(msg.get("offset", 0))
+        since = _optional_int(msg.get("since"))
+        until = _optional_int(msg.get("until"))
+        valid = (
+            isinstance(query, str)
+            and 0 < len(query) <= config["search_query_max"]
+            and offset >= 0
+            and (scope is None or scope in _SEARCH_SCOPES)
+            and all(v is None or isinstance(v, str) for v in (sender, other, channel))
+        )
+    except (TypeError, ValueError):
+        valid = False
+
+    if not valid:
+        send(conn, {
+            "type": MSG_ERROR,
+            "message": "Invalid search request"
+        })
+        return
+
+    if channel is not None:
+        if not _is_member(conn, channel):
+            _channel_error(conn, f"Not a member of #{channel}")
+            return
+        scope, joined = "channel", [channel]
+    else:
+        with lock:
+            joined = sorted(memberships.get(conn, ()))
+
+    limit = max(1, min(limit, config["search_page_max"]))
+
+    try:
+        # One extra row tells whether another page exists
+        messages = search_messages(
+            username, query, scope=scope, sender=sender, with_user=other,
+            channels=joined, since=since, until=until,
+            limit=limit + 1, offset=offset,
+        )
+    except sqlite3.Error as e:
+        print(f"[Search Error] {e}")
+        send(conn, {
+            "type": MSG_ERROR,
+            "message": "Search is not available"
+        })
+        return
+
+    has_more = len(messages) > limit
+    send(conn, {
+        "type": MSG_SEARCH_RESULTS,
+        "query": query,
+        "offset": offset,
+        "has_more": has_more,
+        "messages": messages[:limit]
+    })
 
 
 # =========================
 # Cleanup
 # =========================
 
-def remove_client(client_socket):
+def remove_client(conn):
+    global presence_generation
     with lock:
-        username = clients.pop(client_socket, None)
+        for channel in list(memberships.get(conn, ())):
+            _unsubscribe(conn, channel)
+        memberships.pop(conn, None)
+
+        username = clients.pop(conn, None)
         if username:
             usernames.pop(username, None)
+            if bus is None:
+                presence_generation += 1
+                del all_users[bisect.bisect_left(all_users, username)]
+                _record_change(username, False)
+
+    if username and bus is not None:
+        try:
+            _apply_presence(bus.request("release", username=username))
+        except Exception as e:
+            print(f"[Bus Error] {e}")
+
+    _forget_buckets(conn, username)
 
     if username:
-        broadcast_system(f"{username} is no longer with us.. :c)")
-        broadcast_userlist()
+        announce_presence(username, joined=False)
+
+
+    conn.close()
+
+
+# =========================
+# Multi-process bus
+# =========================
+
+def connect_bus(address, token=None):
+    """
+    Links this process to the hub or cluster broker at `address` (see
+    bus.py).
+    """
+    global bus
+    from bus import connect
+
+    link = connect(address, on_event=_on_bus_event, on_close=_on_bus_lost)
+    reply = link.request("hello", token=token, last_id=last_message_id())
+    if not reply["ok"]:
+        link.close()
+        raise ValueError("The broker rejected this node's token")
+
+    bus = link
+    _apply_presence(reply)
+
+
+def _apply_presence(event):
+    """
+    Adopts the hub's user list if it is newer than ours and records the
+    difference for the next delta. Returns True if it was newer.
+    """
+    global presence_generation, all_users
+    with lock:
+        if event["version"] <= presence_generation:
+            return False
+        old, new = set(all_users), set(event["users"])
+        for username in new - old:
+            _record_change(username, True)
+        for username in old - new:
+            _record_change(username, False)
+        presence_generation = event["version"]
+        all_users = event["users"]
+    return True
+
+
+def _on_bus_event(event):
+    op = event.get("op")
+
+    if op == "presence":
+        if _apply_presence(event):
+            schedule_presence()
+
+    elif op == "message":
+        message = event["message"]
+        scope = event["scope"]
+
+        if not event.get("stored", True):
+            # Cluster broker: it only assigned the id, every node keeps its
+            # own copy of the history
+            persist_then(message, scope, _target_of(message),
+                         lambda: deliver_local(message))
+            return
+
+        notify_committed({
+            "id": message["id"],
+            "ts": message["ts"],
+            "sender": message["from"],
+            "scope": scope,
+            "target": _target_of(message),
+            "text": message["text"]
+        })
+        deliver_local(message)
+
+    elif op == "relay":
+        deliver_local(event["message"])
+
+    elif op == "ack":
+        # Cluster: an ack made on another node
+        ack_messages(event["username"], event.get("ids"))
+
+
+def _target_of(message):
+    # Storage target: the PM recipient or the channel name
+    return message.get("channel", message.get("target"))
+
+
+def _on_bus_lost():
+    # Without the hub this process can neither route nor sequence anything;
+    # exit and let the supervisor start a fresh one
+    print("[Server Error] Lost the bus link, exiting")
+    os._exit(1)
+
+
+# =========================
+# Stats and admin commands
+# =========================
+
+def _queued_frames():
+    return sum(len(c.queue) for c in _connections())
+
 
+def _cache_stat(name):
+    cache = get_cache()
+    return getattr(cache, name) if cache is not None else 0
 
-    client_socket.close()
+
+metrics.gauge("clients", lambda: len(clients), "Logged in clients")
+metrics.gauge("outbound_queued_frames", _queued_frames,
+              "Frames waiting in outbound queues")
+metrics.gauge("cache_hits", lambda: _cache_stat("hits"), "History cache hits")
+metrics.gauge("cache_misses", lambda: _cache_stat("misses"),
+              "History cache misses")
+
+
+def get_stats():
+    """
+    Returns the server counters and gauges, a few derived figures and a
+    summary of every latency histogram.
+    """
+    stats = metrics.snapshot()
+    stats.update(metrics.read_gauges())
+
+    raw = stats.get("compress_bytes_in", 0)
+    if raw:
+        stats["compress_ratio"] = round(raw / stats["compress_bytes_out"], 2)
+        stats["compress_cpu_us_per_kb"] = round(
+            stats["compress_cpu_seconds"] * 1e6 / (raw / 1024), 2
+        )
+
+    stats["latency"] = metrics.histogram_summaries()
+    return stats
+
+
+# Admin command -> function() returning the result
+ADMIN_COMMANDS = {
+    "stats": get_stats,
+    "metrics": metrics.render_prometheus,
+    "profile_start": profiling.start,
+    "profile_stop": profiling.stop,
+}
+
+
+def handle_admin(conn, username, msg):
+    """
+    Runs an operator command. The message must carry the admin token the
+    server was started with; without a configured token every command is
+    refused.
+    """
+    token = config["admin_token"]
+    if not token or not hmac.compare_digest(str(msg.get("token") or ""), token):
+        metrics.incr("admin_denied_total")
+        print(f"[Admin] Refused command from {username}")
+        send(conn, {
+            "type": MSG_ERROR,
+            "message": "Not authorized"
+        })
+        return
+
+    command = msg.get("command")
+    run = ADMIN_COMMANDS.get(command)
+    if run is None:
+        send(conn, {
+            "type": MSG_ERROR,
+            "message": f"Unknown admin command: {command}"
+        })
+        return
+
+    send(conn, {
+        "type": MSG_ADMIN_RESPONSE,
+        "command": command,
+        "result": run()
+    })
 
 
 # =========================
 # Server startup
 # =========================
 
-def start_server(host="0.0.0.0", port=12345):
+def configure(**options):
+    """
+    Validates options and merges them into the module level config.
+    """
+    unknown = set(options) - set(config)
+    if unknown:
+        raise ValueError(f"Unknown server options: {sorted(unknown)}")
+    config.update(options)
+
+    if config["outbound_policy"] not in POLICIES:
+        raise ValueError(f"Unknown overflow policy: {config['outbound_policy']}")
+    if config["durability"] not in DURABILITY_MODES:
+        raise ValueError(f"Unknown durability mode: {config['durability']}")
+    group_history_snapshot.limit = config["history_limit"]
+
+
+def start_server(host="0.0.0.0", port=12345, engine="threaded", **options):
+    """
+    Starts the chat server with the selected engine:
+      - "threaded": one thread per connected client (original behavior)
+      - "asyncio": all clients multiplexed on a single event loop
+    Extra keyword options override entries of the module level config.
+    With the "bus" option this process runs as one worker of a
+    multi-process server or one node of a cluster (see run_server.py
+    --workers and --cluster-serve / --cluster-join).
+    """
+    configure(**options)
+
+    if config["bus"]:
+        connect_bus(config["bus"], token=config["bus_token"])
+
+    if engine == "asyncio":
+        from server_async import start_async_server
+        start_async_server(host, port)
+        return
+
+    if engine != "threaded":
+        raise ValueError(f"Unknown server engine: {engine}")
+
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    # A restarted server can bind right away while the connections of the
+    # previous one linger in TIME_WAIT, so clients can reconnect
+    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if config["reuse_port"]:
+        # Every worker listens on the same port; the kernel spreads accepts
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
     server_socket.bind((host, port))
     server_socket.listen()
 
@@ -0,0 +1,259 @@
+import asyncio
+import signal
+import time
+
+import metrics
+import profiling
+import server
+from outbound import (
+    OutboundQueue,
+    ProtocolState,
+    StartCompression,
+    prepare_frames,
+    is_non_blocking,
+)
+
+from common import (
+    FrameReader,
+    FrameTooLarge,
+    MSG_ERROR,
+)
+
+# Bytes requested from the transport per read
+READ_CHUNK = 65536
+
+
+# =========================
+# Connection wrapper
+# =========================
+
+class AsyncConnection(ProtocolState):
+    """
+    Socket-like wrapper around an asyncio stream pair.
+
+    The shared handlers in server.py only ever call sendall() and close() on
+    the objects stored in server.clients, so the asyncio engine registers
+    these in place of raw sockets. sendall() only enqueues into the
+    connection's OutboundQueue; a writer task drains it and awaits the
+    transport, so a slow reader holds up nobody but itself.
+    """
+
+    def __init__(self, reader, writer, loop):
+        super().__init__()
+        self.reader = reader
+        self.writer = writer
+        self.loop = loop
+        self.peer = writer.get_extra_info("peername")
+        self.frames = FrameReader(max_frame=server.config["max_frame_bytes"])
+        self._ready_messages = []
+
+        self._ready = asyncio.Event()
+        self.queue = OutboundQueue(
+            maxsize=server.config["outbound_queue_size"],
+            policy=server.config["outbound_policy"],
+            block_timeout=server.config["outbound_block_timeout"],
+            on_ready=self._wake,
+        )
+        self._writer_task = loop.create_task(self._write_loop())
+
+    def _on_loop(self):
+        try:
+            return asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            return False
+
+    def _wake(self):
+        if self._on_loop():
+            self._ready.set()
+        else:
+            self.loop.call_soon_threadsafe(self._ready.set)
+
+    def _abort(self):
+        if self._on_loop():
+            self.writer.transport.abort()
+        else:
+            self.loop.call_soon_threadsafe(self.writer.transport.abort)
+
+    def sendall(self, data):
+        # Neither the event loop nor the threads delivering for everyone
+        # (storage writer, bus reader) may wait for queue space
+        can_block = not (self._on_loop() or is_non_blocking())
+        if not self.queue.put(data, can_block=can_block):
+            if self.queue.overflowed:
+                self._wake()
+                self._abort()
+
+    def start_compression(self, compressor):
+        self.queue.put(StartCompression(compressor),
+                       can_block=not self._on_loop())
+
+    def close(self):
+        """
+        Closes gracefully: frames already queued are still written first.
+        """
+        self.queue.close()
+
+    async def _write_loop(self):
+        try:
+            while True:
+                items = self.queue.pop_all()
+                if not items:
+                    if self.queue.closed:
+                        break
+                    self._ready.clear()
+                    if len(self.queue) or self.queue.closed:
+                        continue
+                    await self._ready.wait()
+                    continue
+
+                started = profiling.tracing and time.perf_counter()
+                self.writer.writelines(prepare_frames(self, items))
+                await self.writer.drain()
+                if started:
+                    profiling.span("send", started, frames=len(items))
+        except (ConnectionError, OSError):
+            self.queue.close()
+        finally:
+            if self.queue.overflowed:
+                self.writer.transport.abort()
+            else:
+                self.writer.close()
+
+    async def read_messages(self):
+        """
+        Returns every complete message available after one read, or None
+        when the peer went away.
+        """
+        if self._ready_messages:
+            ready, self._ready_messages = self._ready_messages, []
+            return ready
+
+        while True:
+            try:
+                chunk = await self.reader.read(READ_CHUNK)
+            except ConnectionError:
+                return None
+            if not chunk:
+                return None
+            frames = self.frames.feed(chunk)
+            if frames:
+                return self.frames.decode(frames)
+
+    async def read_message(self):
+        """
+        Returns the next decoded message, or None when the peer went away.
+        """
+        if not self._ready_messages:
+            messages = await self.read_messages()
+            if messages is None:
+                return None
+            self._ready_messages = messages
+        return self._ready_messages.pop(0)
+
+
+# =========================
+# Client handling
+# =========================
+
+async def handle_client(reader, writer):
+    loop = asyncio.get_running_loop()
+    conn = AsyncConnection(reader, writer, loop)
+    username = None
+    print(f"Connection from {conn.peer}")
+    metrics.incr("connections_total")
+
+    try:
+        # ---- LOGIN ----
+        msg = await conn.read_message()
+        if server.bus is not None:
+            # The username claim waits for the hub, keep it off the loop
+            username = await loop.run_in_executor(
+                None, server.login, conn, conn.frames, msg
+            )
+        else:
+            username = server.login(conn, conn.frames, msg)
+        if username is None:
+            return
+
+        server.send_userlist(conn)
+
+        # History comes from SQLite, keep it off the event loop
+        await loop.run_in_executor(None, server.send_history, conn, username)
+
+        server.announce_presence(username, joined=True)
+
+        # ---- MAIN LOOP ----
+        while True:
+            messages = await conn.read_messages()
+            if messages is None:
+                break
+
+            for msg in messages:
+                allowed, delay = server.admit(conn, username, msg)
+                if delay:
+                    # Not reading lets TCP push back on the sender
+                    await asyncio.sleep(delay)
+                if not allowed:
+                    continue
+
+                # Saving only hands the row to the storage writer, so most
+                # handlers are cheap enough to run on the loop itself
+                if msg.get("type") in server.BLOCKING_TYPES:
+                    await loop.run_in_executor(
+                        None, server.handle_message, conn, username, msg
+                    )
+                else:
+                    server.handle_message(conn, username, msg)
+
+    except FrameTooLarge as e:
+        server.send(conn, {
+            "type": MSG_ERROR,
+            "message": str(e)
+        })
+
+    except asyncio.CancelledError:
+        # Server shutting down; finish normally so asyncio doesn't log it
+        pass
+
+    except Exception as e:
+        print(f"[Server Error] {e}")
+
+    finally:
+        if server.bus is not None:
+            await loop.run_in_executor(None, server.remove_client, conn)
+        else:
+            server.remove_client(conn)
+
+
+# =========================
+# Server startup
+# =========================
+
+async def serve(host="0.0.0.0", port=12345):
+    srv = await asyncio.start_server(
+        handle_client, host, port,
+        reuse_port=server.config["reuse_port"] or None,
+    )
+
+    print(f"Server running on {host}:{port} (asyncio)")
+
+    # Stop on SIGTERM from the loop itself, so no task is interrupted
+    # halfway through a write. Not available on Windows or off the main
+    # thread; the process-wide handler of run_server.py applies there
+    serving = asyncio.current_task()
+    try:
+        asyncio.get_running_loop().add_signal_handler(
+            signal.SIGTERM, serving.cancel
+        )
+    except (NotImplementedError, RuntimeError):
+        pass
+
+    async with srv:
+        await srv.serve_forever()
+
+
+def start_async_server(host="0.0.0.0", port=12345):
+    try:
+        asyncio.run(serve(host, port))
+    except asyncio.CancelledError:
+        pass
@@ -0,0 +1,115 @@
+import json
+import threading
+from collections import deque
+
+from common import JSON_CODEC, MSG_HISTORY_RESPONSE
+
+
+# =========================
+# Versioned frames
+# =========================
+
+class VersionedFrame:
+    """
+    Caches the encoded bytes of one frame together with the version of the
+    state it was built from. Every caller asking for the same version (and
+    wire codec) shares one buffer; the message is rebuilt at most once per
+    version change and encoded at most once per codec.
+    """
+
+    def __init__(self, build):
+        self._build = build         # build() -> message dict
+        self._lock = threading.Lock()
+        # (version, message, codec -> bytes), replaced as a whole so the
+        # lock-free fast path never pairs a version with older bytes
+        self._current = (None, None, {})
+
+    def get(self, version, codec=JSON_CODEC):
+        current_version, _, encoded = self._current
+        if current_version == version:
+            data = encoded.get(codec)
+            if data is not None:
+                return data
+
+        with self._lock:
+            current_version, message, encoded = self._current
+            if current_version != version or message is None:
+                message = self._build()
+                encoded = {}
+                self._current = (version, message, encoded)
+            data = encoded.get(codec)
+            if data is None:
+                data = encoded[codec] = codec.encode(message)
+            return data
+
+
+# =========================
+# Login group history
+# =========================
+
+class GroupHistorySnapshot:
+    """
+    Encoded login group-history frame, maintained incrementally.
+
+    Each history row is JSON-encoded once, when it arrives, and kept in a
+    ring of `limit` fragments. Building the JSON frame for a new version is
+    then just a join of ready-made fragments instead of a SQLite read plus a
+    json.dumps of the whole list. Other codecs encode the rows once per
+    version.
+    """
+
+    _PREFIX = (
+        '{"type": "%s", "scope": "group", "messages": [' % MSG_HISTORY_RESPONSE
+    ).encode("utf-8")
+    _SUFFIX = b"]}\n"
+
+    def __init__(self, load, limit=50):
+        self._load = load           # load(limit) -> list of history rows
+        self.limit = limit
+        self._lock = threading.Lock()
+        self._rows = None           # deque of history rows, oldest first
+        self._fragments = None      # the same rows, JSON-encoded
+        self._last_id = 0
+        self._encoded = {}          # codec -> bytes, for self._last_id
+
+    def add(self, row):
+        """
+        Appends a committed group message (a history row dict).
+        """
+        with self._lock:
+            if self._rows is None:
+                return
+            if row["id"] <= self._last_id:
+                # Arrived out of order, rebuild from the source on next use
+                self._rows = self._fragments = None
+                return
+            self._rows.append(row)
+            self._fragments.append(json.dumps(row).encode("utf-8"))
+            self._last_id = row["id"]
+            self._encoded = {}
+
+    def get(self, codec=JSON_CODEC):
+        with self._lock:
+            if self._rows is None:
+                rows = self._load(self.limit)
+                self._rows = deque(rows, maxlen=self.limit)
+                self._fragments = deque(
+                    (json.dumps(r).encode("utf-8") for r in rows),
+                    maxlen=self.limit,
+                )
+                self._last_id = rows[-1]["id"] if rows else 0
+                self._encoded = {}
+
+            data = self._encoded.get(codec)
+            if data is None:
+                if codec is JSON_CODEC:
+                    data = (self._PREFIX + b", ".join(self._fragments)
+                            + self._SUFFIX)
+                else:
+                    data = codec.encode({
+                        "type": MSG_HISTORY_RESPONSE,
+                        "scope": "group",
+                        "messages": list(self._rows)
+                    })
+                self._encoded[codec] = data
+            return data
@@ -1,5 +1,11 @@
 import sqlite3
 import os
+import threading
+import time
+
+import metrics
+import profiling
+from outbound import mark_non_blocking
 
 DB_DIR = "data"
 DB_PATH = os.path.join(DB_DIR, "chat.db")
@@ -13,6 +19,7 @@ def init_db():
     os.makedirs(DB_DIR, exist_ok=True)
 
     conn = sqlite3.connect(DB_PATH)
+    conn.execute("PRAGMA journal_mode=WAL")
     cur = conn.cursor()
 
     cur.execute("""
@@ -26,104 +33,794 @@ def init_db():
         )
     """)
 
+    # History pages walk backwards by id, within one scope...
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_messages_scope_id
+        ON messages (scope, id)
+    """)
+    # ...or within one direction of a PM pair
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_messages_pm_pair
+        ON messages (scope, sender, target, id)
+    """)
+    # PMs received by a user, for the per-user conversation overview, and
+    # the history of one channel (target = channel name)
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_messages_pm_target
+        ON messages (scope, target, id)
+    """)
+
+    # PMs not yet acknowledged by their recipient, filled by a trigger so
+    # the row commits together with the message, whoever stores it
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS pending (
+            username TEXT NOT NULL,
+            message_id INTEGER NOT NULL,
+            PRIMARY KEY (username, message_id)
+        ) WITHOUT ROWID
+    """)
+    cur.execute("""
+        CREATE TRIGGER IF NOT EXISTS messages_pending
+        AFTER INSERT ON messages
+        WHEN new.scope = 'pm' AND new.target IS NOT NULL AND new.target != new.sender
+        BEGIN
+            INSERT OR IGNORE INTO pending (username, message_id)
+            VALUES (new.target, new.id);
+        END
+    """)
+
+    _init_search(cur)
+
     conn.commit()
     conn.close()
 
 
+def _init_search(cur):
+    """
+    Creates the full-text index over message texts. It is an external
+    content FTS5 table (the text is not stored twice) that triggers keep in
+    step with every insert, so it never needs a rebuild. A database from
+    before the index is indexed once, when the table is created.
+    """
+    exists = cur.execute("""
+        SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'messages_fts'
+    """).fetchone()
+
+    try:
+        cur.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+                text,
+                content = 'messages',
+                content_rowid = 'id',
+                tokenize = 'unicode61 remove_diacritics 2'
+            )
+        """)
+    except sqlite3.OperationalError as e:
+        # SQLite built without FTS5: chat works, searches get an error
+        print(f"[Storage] Full-text search disabled: {e}")
+        return
+
+    cur.execute("""
+        CREATE TRIGGER IF NOT EXISTS messages_fts_insert
+        AFTER INSERT ON messages BEGIN
+            INSERT INTO messages_fts (rowid, text) VALUES (new.id, new.text);
+        END
+    """)
+    cur.execute("""
+        CREATE TRIGGER IF NOT EXISTS messages_fts_delete
+        AFTER DELETE ON messages BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, text)
+            VALUES ('delete', old.id, old.text);
+        END
+    """)
+
+    if not exists:
+        cur.execute("""
+            INSERT INTO messages_fts (rowid, text)
+            SELECT id, text FROM messages WHERE text IS NOT NULL
+        """)
+
+
 
 # =========================
 # Message persistence
 # =========================
 
-def save_message(ts, sender, scope, target, text):
+# Deliver a message only once the batch containing it has been committed
+DURABILITY_COMMIT = "commit"
+# Deliver right away and let the writer persist it in the background
+DURABILITY_ASYNC = "async"
+
+DURABILITY_MODES = (DURABILITY_COMMIT, DURABILITY_ASYNC)
+
+# Ids are assigned before insert, so a replayed row is simply ignored
+_INSERT_SQL = """
+    INSERT OR IGNORE INTO messages (id, ts, sender, scope, target, text)
+    VALUES (?, ?, ?, ?, ?, ?)
+"""
+
+_ACK_SQL = "DELETE FROM pending WHERE username = ? AND message_id = ?"
+_ACK_ALL_SQL = "DELETE FROM pending WHERE username = ?"
+
+
+def _apply_acks(conn, acks):
+    for username, ids in acks:
+        if ids is None:
+            conn.execute(_ACK_ALL_SQL, (username,))
+        else:
+            conn.executemany(_ACK_SQL, [(username, i) for i in ids])
+
+
+_commit_seconds = metrics.histogram(
+    "storage_commit_seconds", "Duration of one group commit (INSERT + COMMIT)"
+)
+_save_seconds = metrics.histogram(
+    "storage_save_seconds", "save_message latency, from submit to commit"
+)
+
+
+class StorageWriter:
+    """
+    Single writer thread owning one long-lived SQLite connection in WAL mode.
+
+    Handlers hand rows over with submit() and return immediately. The writer
+    collects everything submitted while it lingers for up to max_delay
+    seconds (or until max_batch rows are waiting) and commits the lot in a
+    single transaction. Message ids are assigned at submit time so callers
+    know a message's id before it reaches the disk. Delivery acks ride
+    along in the same transactions.
+    """
+
+    def __init__(self, db_path=None, max_batch=256, max_delay=0.005,
+                 synchronous="NORMAL"):
+        self.db_path = db_path or DB_PATH
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.synchronous = synchronous
+
+        self._cond = threading.Condition()
+        self._pending = []          # (row, on_commit, submit time)
+        self._acks = []             # (username, message ids or None)
+        self._next_id = 1
+        self._submitted = 0
+        self._committed = 0
+        self._stopping = False
+        self._thread = None
+
+    def start(self):
+        conn = sqlite3.connect(self.db_path)
+        (max_id,) = conn.execute("SELECT MAX(id) FROM messages").fetchone()
+        conn.close()
+        self._next_id = (max_id or 0) + 1
+
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, ts, sender, scope, target, text, on_commit=None,
+               msg_id=None):
+        """
+        Queues one message and returns its id. on_commit(msg_id) is called
+        from the writer thread right after the message's batch is committed.
+        Pass msg_id to store a message under an id assigned elsewhere.
+        """
+        with self._cond:
+            if self._stopping:
+                raise RuntimeError("Storage writer is stopped")
+            if msg_id is None:
+                msg_id = self._next_id
+            self._next_id = max(self._next_id, msg_id + 1)
+            self._pending.append(
+                ((msg_id, ts, sender, scope, target, text), on_commit,
+                 time.perf_counter())
+            )
+            self._submitted += 1
+            self._cond.notify_all()
+        return msg_id
+
+    def submit_acks(self, username, ids):
+        """
+        Queues the removal of acknowledged PMs from username's pending
+        queue (all of them when ids is None), for the next commit.
+        """
+        with self._cond:
+            if self._stopping:
+                raise RuntimeError("Storage writer is stopped")
+            self._acks.append((username, ids))
+            self._cond.notify_all()
+
+    def flush(self, timeout=None):
+        """
+        Waits until everything submitted so far has been committed.
+        """
+        with self._cond:
+            target = self._submitted
+            return self._cond.wait_for(
+                lambda: self._committed >= target, timeout
+            )
+
+    def stop(self, timeout=10):
+        """
+        Commits whatever is still queued and stops the writer thread.
+        """
+        if self._thread and self._thread.is_alive():
+            self.flush(timeout)
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        if self._thread:
+            self._thread.join(timeout)
+
+    def _take_batch(self):
+        with self._cond:
+            self._cond.wait_for(
+                lambda: self._pending or self._acks or self._stopping
+            )
+            if not self._pending and not self._acks:
+                return None
+            if not self._pending:
+                acks, self._acks = self._acks, []
+                return [], acks
+
+            # Linger briefly so concurrent senders share one commit
+            deadline = time.monotonic() + self.max_delay
+            while len(self._pending) < self.max_batch and not self._stopping:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+
+            batch = self._pending[:self.max_batch]
+            del self._pending[:self.max_batch]
+            # An ack may be for a message still waiting behind this batch;
+            # it has to be inserted before its pending row can go
+            acks = []
+            if not self._pending:
+                acks, self._acks = self._acks, []
+            return batch, acks
+
+    def _commit_row_by_row(self, conn, batch, acks):
+        """
+        Retries a failed batch one row at a time, so a single bad row does
+        not take the others down with it. Returns the rows that committed;
+        only those get their on_commit.
+        """
+        stored = []
+        try:
+            for item in batch:
+                try:
+                    conn.execute(_INSERT_SQL, item[0])
+                    stored.append(item)
+                except sqlite3.Error as e:
+                    metrics.incr("storage_errors_total")
+                    print(f"[Storage Error] message {item[0][0]} not stored: {e}")
+            _apply_acks(conn, acks)
+            conn.commit()
+        except sqlite3.Error as e:
+            # The database itself is failing: nothing of the batch is stored
+            conn.rollback()
+            metrics.incr("storage_errors_total", len(batch))
+            print(f"[Storage Error] {e}")
+            return []
+        return stored
+
+    def _run(self):
+        # on_commit callbacks deliver messages; they must not wait on one
+        # slow client
+        mark_non_blocking()
+        conn = sqlite3.connect(self.db_path)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(f"PRAGMA synchronous={self.synchronous}")
+
+        while True:
+            taken = self._take_batch()
+            if taken is None:
+                break
+            batch, acks = taken
+
+            started = time.perf_counter()
+            stored = batch
+            try:
+                conn.executemany(_INSERT_SQL, [row for row, _, _ in batch])
+                _apply_acks(conn, acks)
+                conn.commit()
+            except sqlite3.Error as e:
+                conn.rollback()
+                print(f"[Storage Error] {e}")
+                stored = self._commit_row_by_row(conn, batch, acks)
+
+            committed = time.perf_counter()
+            _commit_seconds.observe(committed - started)
+            if profiling.tracing:
+                profiling.span("commit", started, committed, rows=len(stored))
+                for row, _, submitted in stored:
+                    profiling.async_span("persist", row[0], submitted, committed)
+            metrics.incr_many({
+                "storage_commits_total": 1,
+                "storage_rows_total": len(stored),
+                "storage_acks_total": len(acks),
+            })
+
+            # Rows that failed count as done too, or flush() would wait
+            # for them forever
+            with self._cond:
+                self._committed += len(batch)
+                self._cond.notify_all()
+
+            for row, on_commit, submitted in stored:
+                _save_seconds.observe(committed - submitted)
+                if on_commit:
+                    try:
+                        on_commit(row[0])
+                    except Exception as e:
+                        print(f"[Storage Error] commit callback: {e}")
+
+        conn.close()
+
+
+_writer = None
+
+
+def start_writer(**options):
+    """
+    Starts the shared storage writer. Until it is started, save_message()
+    writes synchronously through a short-lived connection.
+    """
+    global _writer
+    if _writer is None:
+        _writer = StorageWriter(**options)
+        _writer.start()
+    return _writer
+
+
+def stop_writer():
+    """
+    Flushes pending messages to disk and stops the shared writer.
+    """
+    global _writer
+    if _writer is not None:
+        _writer.stop()
+        _writer = None
+
+
+def save_message(ts, sender, scope, target, text, on_commit=None,
+                 msg_id=None):
+    """
+    Stores a message and returns its id. on_commit(msg_id) is called once
+    the message is durable on disk. msg_id forces the id (cluster mode).
+    """
+    if _writer is not None:
+        return _writer.submit(
+            ts, sender, scope, target, text, on_commit, msg_id=msg_id
+        )
+
     conn = sqlite3.connect(DB_PATH)
     cur = conn.cursor()
 
     cur.execute("""
-        INSERT INTO messages (ts, sender, scope, target, text)
-        VALUES (?, ?, ?, ?, ?)
-    """, (ts, sender, scope, target, text))
+        INSERT OR IGNORE INTO messages (id, ts, sender, scope, target, text)
+        VALUES (?, ?, ?, ?, ?, ?)
+    """, (msg_id, ts, sender, scope, target, text))
 
+    if msg_id is None:
+        msg_id = cur.lastrowid
     conn.commit()
     conn.close()
 
+    if on_commit:
+        on_commit(msg_id)
+    return msg_id
+
+
+
+def last_message_id():
+    """
+    Returns the highest message id stored (or queued), 0 if none.
+    """
+    if _writer is not None:
+        with _writer._cond:
+            return _writer._next_id - 1
+
+    conn = sqlite3.connect(DB_PATH)
+    (max_id,) = conn.execute("SELECT MAX(id) FROM messages").fetchone()
+    conn.close()
+    return max_id or 0
 
 
 # =========================
 # History retrieval
 # =========================
 
-def load_group_history(limit=50):
+# Cursor used when a page starts at the newest message
+_NEWEST = 2 ** 63 - 1
+
+_load_group_seconds = metrics.histogram(
+    "storage_load_group_seconds", "load_group_history query time"
+)
+_load_channel_seconds = metrics.histogram(
+    "storage_load_channel_seconds", "load_channel_history query time"
+)
+_load_private_seconds = metrics.histogram(
+    "storage_load_private_seconds", "load_private_history query time"
+)
+_load_since_seconds = metrics.histogram(
+    "storage_load_since_seconds", "load_messages_since query time"
+)
+_load_conversations_seconds = metrics.histogram(
+    "storage_load_conversations_seconds", "load_recent_conversations query time"
+)
+
+
+@metrics.timed(_load_group_seconds)
+def load_group_history(limit=50, before_id=None):
     """
-    Returns the most recent group messages as a list of dicts.
+    Returns up to `limit` group messages older than `before_id` (the most
+    recent ones when it is None) as a list of dicts, oldest first.
     """
     conn = sqlite3.connect(DB_PATH)
     cur = conn.cursor()
 
     cur.execute("""
-        SELECT ts, sender, text
+        SELECT id, ts, sender, text
         FROM messages
-        WHERE scope = 'group'
-        ORDER BY ts ASC
+        WHERE scope = 'group' AND id < ?
+        ORDER BY id DESC
         LIMIT ?
-    """, (limit,))
+    """, (before_id or _NEWEST, limit))
 
     rows = cur.fetchall()
     conn.close()
 
     return [
         {
+            "id": msg_id,
             "ts": ts,
             "sender": sender,
             "scope": "group",
             "target": None,
             "text": text
         }
-        for ts, sender, text in rows
+        for msg_id, ts, sender, text in reversed(rows)
     ]
 
 
-def load_private_history(user1, user2, limit=50):
+@metrics.timed(_load_channel_seconds)
+def load_channel_history(channel, limit=50, before_id=None):
+    """
+    Returns up to `limit` messages of one channel older than `before_id`,
+    oldest first. Channel messages are stored with scope 'channel' and the
+    channel name as target, so a page is one range of the (scope, target,
+    id) index.
+    """
     conn = sqlite3.connect(DB_PATH)
     cur = conn.cursor()
 
     cur.execute("""
-        SELECT ts, sender, target, text
+        SELECT id, ts, sender, text
         FROM messages
-        WHERE scope = 'pm'
-          AND (
-            (sender = ? AND target = ?)
-            OR
-            (sender = ? AND target = ?)
-          )
-        ORDER BY ts ASC
+        WHERE scope = 'channel' AND target = ? AND id < ?
+        ORDER BY id DESC
+        LIMIT ?
+    """, (channel, before_id or _NEWEST, limit))
+
+    rows = cur.fetchall()
+    conn.close()
+
+    return [
+        {
+            "id": msg_id,
+            "ts": ts,
+            "sender": sender,
+            "scope": "channel",
+            "target": channel,
+            "text": text
+        }
+        for msg_id, ts, sender, text in reversed(rows)
+    ]
+
+
+@metrics.timed(_load_private_seconds)
+def load_private_history(user1, user2, limit=50, before_id=None):
+    """
+    Returns up to `limit` private messages between two users older than
+    `before_id`, oldest first. Each direction of the pair is read as its own
+    index range, so the cost depends on the page size, not the table size.
+    """
+    conn = sqlite3.connect(DB_PATH)
+    cur = conn.cursor()
+    before_id = before_id or _NEWEST
+
+    cur.execute("""
+        SELECT * FROM (
+            SELECT id, ts, sender, target, text
+            FROM messages
+            WHERE scope = 'pm' AND sender = ? AND target = ? AND id < ?
+            ORDER BY id DESC
+            LIMIT ?
+        )
+        UNION ALL
+        SELECT * FROM (
+            SELECT id, ts, sender, target, text
+            FROM messages
+            WHERE scope = 'pm' AND sender = ? AND target = ? AND id < ?
+            ORDER BY id DESC
+            LIMIT ?
+        )
+        ORDER BY id DESC
         LIMIT ?
-    """, (user1, user2, user2, user1, limit))
+    """, (user1, user2, before_id, limit,
+          user2, user1, before_id, limit,
+          limit))
 
     rows = cur.fetchall()
     conn.close()
 
     return [
-        {"ts": ts, "sender": sender, "scope": "pm", "target": target, "text": text}
-        for ts, sender, target, text in rows
+        {
+            "id": msg_id,
+            "ts": ts,
+            "sender": sender,
+            "scope": "pm",
+            "target": target,
+            "text": text
+        }
+        for msg_id, ts, sender, target, text in reversed(rows)
     ]
 
-def load_pm_partners(username):
+@metrics.timed(_load_since_seconds)
+def load_messages_since(username, after_id, limit=1000, received=True):
+    """
+    Returns up to `limit` group messages and PMs of `username` with an id
+    above `after_id`, oldest first: what a reconnecting client missed.
+    Without `received`, PMs to `username` are left out (they come from
+    the pending queue instead). The scan walks the id range only, so it
+    costs as much as what was written since, whatever the size of the
+    table.
+    """
     conn = sqlite3.connect(DB_PATH)
     cur = conn.cursor()
 
     cur.execute("""
-        SELECT DISTINCT
-            CASE
-                WHEN sender = ? THEN target
-                ELSE sender
-            END AS partner
+        SELECT id, ts, sender, scope, target, text
         FROM messages
-        WHERE scope = 'pm'
-          AND (sender = ? OR target = ?)
-    """, (username, username, username))
+        WHERE id > ?
+          AND (scope = 'group' OR (scope = 'pm' AND (sender = ? OR (? AND target = ?))))
+        ORDER BY id
+        LIMIT ?
+    """, (after_id, username, bool(received), username, limit))
+
+    rows = cur.fetchall()
+    conn.close()
+
+    return [
+        {
+            "id": msg_id,
+            "ts": ts,
+            "sender": sender,
+            "scope": scope,
+            "target": target,
+            "text": text
+        }
+        for msg_id, ts, sender, scope, target, text in rows
+    ]
+
+
+@metrics.timed(_load_conversations_seconds)
+def load_recent_conversations(username, per_conversation=3):
+    """
+    Returns one summary per PM conversation of `username`, most recently
+    active first, in a single query:
+      {"with", "last_id", "last_ts", "count", "messages"}
+    where "messages" holds the newest `per_conversation` messages, oldest
+    first, and "count" the conversation's total number of messages.
+    """
+    conn = sqlite3.connect(DB_PATH)
+    cur = conn.cursor()
+
+    cur.execute("""
+        WITH mine AS (
+            SELECT id, ts, sender, target, text, target AS partner
+            FROM messages
+            WHERE scope = 'pm' AND sender = ?
+            UNION ALL
+            SELECT id, ts, sender, target, text, sender AS partner
+            FROM messages
+            WHERE scope = 'pm' AND target = ? AND sender != ?
+        ),
+        ranked AS (
+            SELECT *,
+                   ROW_NUMBER() OVER (PARTITION BY partner ORDER BY id DESC) AS rn,
+                   COUNT(*) OVER (PARTITION BY partner) AS total
+            FROM mine
+            WHERE partner IS NOT NULL
+        )
+        SELECT partner, total, id, ts, sender, target, text
+        FROM ranked
+        WHERE rn <= ?
+        ORDER BY partner, id
+    """, (username, username, username, per_conversation))
+
+    rows = cur.fetchall()
+    conn.close()
+
+    conversations = {}
+    for partner, total, msg_id, ts, sender, target, text in rows:
+        conv = conversations.setdefault(partner, {
+            "with": partner,
+            "count": total,
+            "messages": []
+        })
+        conv["messages"].append({
+            "id": msg_id,
+            "ts": ts,
+            "sender": sender,
+            "scope": "pm",
+            "target": target,
+            "text": text
+        })
+
+    for conv in conversations.values():
+        last = conv["messages"][-1]
+        conv["last_id"] = last["id"]
+        conv["last_ts"] = last["ts"]
+
+    return sorted(
+        conversations.values(), key=lambda c: c["last_id"], reverse=True
+    )
+
+
+# =========================
+# Search
+# =========================
+
+_search_seconds = metrics.histogram(
+    "storage_search_seconds", "search_messages query time"
+)
+
+
+def _match_expression(query):
+    """
+    Turns free text into an FTS5 query: every word must appear, and a word
+    ending in * matches as a prefix. Words are quoted, so FTS5 operators
+    and punctuation typed by users are searched for literally instead of
+    failing to parse.
+    """
+    terms = []
+    for word in query.split():
+        prefix = word.endswith("*")
+        word = word.rstrip("*")
+        if not word:
+            continue
+        quoted = '"' + word.replace('"', '""') + '"'
+        terms.append(quoted + "*" if prefix else quoted)
+    return " ".join(terms)
+
+
+@metrics.timed(_search_seconds)
+def search_messages(username, query, scope=None, sender=None, with_user=None,
+                    channels=(), since=None, until=None, limit=20, offset=0):
+    """
+    Returns up to `limit` messages matching `query`, best match first
+    (bm25), skipping the first `offset`. Only messages `username` may read
+    are searched: group messages, their own PMs and the messages of
+    `channels`. Optional filters: scope, sender, PM partner `with_user`
+    and a ts range [since, until].
+    """
+    match = _match_expression(query)
+    if not match:
+        return []
+
+    # Privacy: group messages, PMs sent or received, joined channels
+    visible = ["m.scope = 'group'", "(m.scope = 'pm' AND (m.sender = ? OR m.target = ?))"]
+    params = [match, username, username]
+    channels = list(channels)
+    if channels:
+        visible.append(
+            f"(m.scope = 'channel' AND m.target IN ({', '.join('?' * len(channels))}))"
+        )
+        params.extend(channels)
+    where = ["messages_fts MATCH ?", f"({' OR '.join(visible)})"]
+
+    if scope is not None:
+        where.append("m.scope = ?")
+        params.append(scope)
+    if sender is not None:
+        where.append("m.sender = ?")
+        params.append(sender)
+    if with_user is not None:
+        where.append("""m.scope = 'pm' AND (
+            (m.sender = ? AND m.target = ?) OR (m.sender = ? AND m.target = ?)
+        )""")
+        params.extend([username, with_user, with_user, username])
+    if since is not None:
+        where.append("m.ts >= ?")
+        params.append(since)
+    if until is not None:
+        where.append("m.ts <= ?")
+        params.append(until)
+
+    conn = sqlite3.connect(DB_PATH)
+    cur = conn.cursor()
+
+    cur.execute(f"""
+        SELECT m.id, m.ts, m.sender, m.scope, m.target, m.text
+        FROM messages_fts
+        JOIN messages AS m ON m.id = messages_fts.rowid
+        WHERE {' AND '.join(where)}
+        ORDER BY bm25(messages_fts), m.id DESC
+        LIMIT ? OFFSET ?
+    """, params + [limit, offset])
 
     rows = cur.fetchall()
     conn.close()
 
-    return [row[0] for row in rows if row[0]]
+    return [
+        {
+            "id": msg_id,
+            "ts": ts,
+            "sender": sender,
+            "scope": scope,
+            "target": target,
+            "text": text
+        }
+        for msg_id, ts, sender, scope, target, text in rows
+    ]
+
+
+# =========================
+# Pending deliveries
+# =========================
+
+_load_pending_seconds = metrics.histogram(
+    "storage_load_pending_seconds", "load_pending query time"
+)
+
+
+@metrics.timed(_load_pending_seconds)
+def load_pending(username, after_id=0, limit=200):
+    """
+    Returns up to `limit` PMs to `username` that were not acknowledged
+    yet, with an id above `after_id`, oldest first. Batches are read by
+    id from the (username, message_id) key, so each costs its own size.
+    """
+    conn = sqlite3.connect(DB_PATH)
+    cur = conn.cursor()
+
+    cur.execute("""
+        SELECT m.id, m.ts, m.sender, m.target, m.text
+        FROM pending AS p
+        JOIN messages AS m ON m.id = p.message_id
+        WHERE p.username = ? AND p.message_id > ?
+        ORDER BY p.message_id
+        LIMIT ?
+    """, (username, after_id, limit))
+
+    rows = cur.fetchall()
+    conn.close()
+
+    return [
+        {
+            "id": msg_id,
+            "ts": ts,
+            "sender": sender,
+            "scope": "pm",
+            "target": target,
+            "text": text
+        }
+        for msg_id, ts, sender, target, text in rows
+    ]
+
+
+def ack_messages(username, ids=None):
+    """
+    Removes delivered PMs from username's pending queue: the given ids,
+    or everything when ids is None. Goes through the shared writer's next
+    commit when it is running.
+    """
+    if _writer is not None:
+        _writer.submit_acks(username, ids)
+        return
+
+    conn = sqlite3.connect(DB_PATH)
+    _apply_acks(conn, [(username, ids)])
+    conn.commit()
+    conn.close()
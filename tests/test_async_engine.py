@@ -0,0 +1,86 @@
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import client_net
+import server
+import storage
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class AsyncEngineTest(unittest.TestCase):
+    """
+    The asyncio engine, run in-process on a background thread.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.workdir = tempfile.mkdtemp()
+        cls._saved = (storage.DB_DIR, storage.DB_PATH, dict(server.config),
+                      dict(server.ADMIN_COMMANDS))
+        storage.DB_DIR = cls.workdir
+        storage.DB_PATH = os.path.join(cls.workdir, "chat.db")
+        storage.init_db()
+        server.configure(admin_token="secret", presence_tick=0)
+
+        cls.port = _free_port()
+        threading.Thread(
+            target=server.start_server,
+            kwargs=dict(host="127.0.0.1", port=cls.port, engine="asyncio"),
+            daemon=True,
+        ).start()
+        deadline = time.monotonic() + 5
+        while time.monotonic() < deadline:
+            try:
+                socket.create_connection(("127.0.0.1", cls.port), 0.2).close()
+                return
+            except OSError:
+                time.sleep(0.05)
+        raise AssertionError("server did not start")
+
+    @classmethod
+    def tearDownClass(cls):
+        storage.DB_DIR, storage.DB_PATH, config, commands = cls._saved
+        server.config.clear()
+        server.config.update(config)
+        server.ADMIN_COMMANDS.clear()
+        server.ADMIN_COMMANDS.update(commands)
+        shutil.rmtree(cls.workdir, ignore_errors=True)
+
+    def test_slow_admin_command_does_not_stall_the_loop(self):
+        # Stands in for profile_stop writing a large trace
+        server.ADMIN_COMMANDS["slow"] = lambda: time.sleep(1.5) or "done"
+
+        admin_replies = []
+        admin = client_net.Client(on_message=admin_replies.append)
+        got = threading.Event()
+        other = client_net.Client(
+            on_message=lambda m: m.get("text") == "ping" and got.set()
+        )
+        self.assertTrue(admin.connect("127.0.0.1", self.port, "admin"))
+        self.assertTrue(other.connect("127.0.0.1", self.port, "other"))
+        self.addCleanup(admin.disconnect)
+        self.addCleanup(other.disconnect)
+
+        admin.admin_command("slow", "secret")
+        time.sleep(0.2)
+        started = time.monotonic()
+        other.send_group_message("ping")
+        self.assertTrue(got.wait(5))
+        self.assertLess(time.monotonic() - started, 1.0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,197 @@
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import client_net
+from common import BINARY_CODEC
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class _Inbox:
+    """
+    Collects what a client receives and waits for a matching message.
+    """
+
+    def __init__(self):
+        self.messages = []
+        self._cond = threading.Condition()
+
+    def __call__(self, msg):
+        with self._cond:
+            self.messages.append(msg)
+            self._cond.notify_all()
+
+    def wait_for(self, match, timeout=5.0):
+        with self._cond:
+            found = self._cond.wait_for(
+                lambda: [m for m in self.messages if match(m)], timeout
+            )
+        if not found:
+            raise AssertionError(f"no matching message in {self.messages}")
+        return found
+
+    def clear(self):
+        with self._cond:
+            self.messages.clear()
+
+
+class BinaryCodecServerTest(unittest.TestCase):
+    """
+    Runs a server in a scratch directory and talks to it with clients on
+    the binary codec.
+    """
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.port = _free_port()
+        self.server = None
+        self.start_server()
+        self.clients = []
+
+    def tearDown(self):
+        for client in self.clients:
+            client.disconnect()
+        self.stop_server()
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def start_server(self):
+        self.server = subprocess.Popen(
+            [sys.executable, os.path.join(ROOT, "run_server.py"),
+             "--port", str(self.port), "--presence-tick", "0"],
+            cwd=self.workdir,
+            stdout=subprocess.DEVNULL,
+        )
+        deadline = time.monotonic() + 10
+        while time.monotonic() < deadline:
+            try:
+                socket.create_connection(("127.0.0.1", self.port), 0.2).close()
+                return
+            except OSError:
+                time.sleep(0.05)
+        raise AssertionError("server did not start")
+
+    def stop_server(self):
+        if self.server is not None:
+            self.server.terminate()
+            self.server.wait()
+            self.server = None
+
+    def connect(self, username):
+        inbox = _Inbox()
+        client = client_net.Client(on_message=inbox)
+        self.assertTrue(client.connect(
+            "127.0.0.1", self.port, username, codec="binary"
+        ))
+        self.clients.append(client)
+        return client, inbox
+
+    def test_channel_join_and_history(self):
+        alice, alice_inbox = self.connect("alice")
+        bob, bob_inbox = self.connect("bob")
+
+        alice.join_channel("dev")
+        joined = alice_inbox.wait_for(
+            lambda m: m["type"] == "history_response"
+            and m.get("scope") == "channel"
+        )
+        self.assertEqual(joined[0].get("channel"), "dev")
+
+        bob.join_channel("dev")
+        bob_inbox.wait_for(lambda m: m.get("scope") == "channel")
+        bob.send_channel_message("dev", "hello dev")
+        live = alice_inbox.wait_for(lambda m: m["type"] == "channel")
+        self.assertEqual(live[0]["channel"], "dev")
+
+        alice_inbox.clear()
+        alice.request_history(scope="channel", channel="dev")
+        page = alice_inbox.wait_for(
+            lambda m: m["type"] in ("history_response", "error")
+        )[0]
+        self.assertEqual(page["type"], "history_response")
+        self.assertEqual(page.get("channel"), "dev")
+        self.assertEqual([r["text"] for r in page["messages"]], ["hello dev"])
+
+    def test_resume_after_reconnect(self):
+        alice, alice_inbox = self.connect("alice")
+        bob, bob_inbox = self.connect("bob")
+        alice.join_channel("dev")
+        bob.join_channel("dev")
+        bob_inbox.wait_for(lambda m: m.get("scope") == "channel")
+        bob.send_group_message("before")
+        alice_inbox.wait_for(lambda m: m.get("text") == "before")
+
+        with mock.patch.object(client_net, "reconnect_delay", lambda attempt: 0.2):
+            alice._sock.shutdown(socket.SHUT_RDWR)
+            deadline = time.monotonic() + 5
+            while alice.is_connected() and time.monotonic() < deadline:
+                time.sleep(0.01)
+            bob.send_group_message("missed")
+            bob.send_channel_message("dev", "missed in dev")
+            alice_inbox.clear()
+
+            resumed = alice_inbox.wait_for(
+                lambda m: m["type"] == "history_response"
+                and m.get("scope") == "resume"
+            )[0]
+            rejoined = alice_inbox.wait_for(
+                lambda m: m["type"] == "history_response"
+                and m.get("scope") == "channel"
+            )[0]
+
+        self.assertIsNotNone(resumed.get("after"))
+        self.assertEqual([r["text"] for r in resumed["messages"]], ["missed"])
+        self.assertIsNotNone(rejoined.get("after"))
+        self.assertEqual(rejoined.get("channel"), "dev")
+        self.assertEqual(
+            [r["text"] for r in rejoined["messages"]], ["missed in dev"]
+        )
+
+
+class ResumeDedupTest(unittest.TestCase):
+    """
+    A row that arrived live and again in a missed page (decoded from the
+    binary codec) is handed on only once.
+    """
+
+    def decoded(self, message):
+        return BINARY_CODEC.decode(BINARY_CODEC.encode(message)[4:])
+
+    def test_missed_page_drops_live_duplicates(self):
+        client = client_net.Client()
+        live = {"type": "group", "id": 7, "ts": "t", "from": "bob", "text": "x"}
+        self.assertTrue(client._track(self.decoded(live)))
+
+        page = self.decoded({
+            "type": "history_response",
+            "scope": "resume",
+            "after": 6,
+            "messages": [
+                {"id": 7, "ts": "t", "sender": "bob", "scope": "group",
+                 "target": None, "text": "x"},
+                {"id": 8, "ts": "t", "sender": "bob", "scope": "group",
+                 "target": None, "text": "y"},
+            ],
+        })
+        self.assertEqual(page.get("after"), 6)
+        client._track(page)
+        self.assertEqual([r["id"] for r in page["messages"]], [8])
+        self.assertEqual(client.last_id, 8)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,70 @@
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bus
+
+
+class BusClientTest(unittest.TestCase):
+    """
+    A worker's link to a hub served over a Unix socket.
+    """
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.workdir, ignore_errors=True)
+        self.address = os.path.join(self.workdir, "hub.sock")
+        self.hub = bus.Hub()
+        listener = bus.serve_hub(self.hub, self.address)
+        self.addCleanup(listener.close)
+
+    def test_failing_event_does_not_drop_the_link(self):
+        received = []
+        got_second = threading.Event()
+        closed = threading.Event()
+
+        def on_event(event):
+            text = event["message"]["text"]
+            if text == "bad":
+                raise TypeError("handler failed")
+            received.append(text)
+            got_second.set()
+
+        link = bus.BusClient(self.address, on_event, on_close=closed.set)
+        self.addCleanup(link.close)
+        self.assertTrue(link.request("hello")["ok"])
+
+        link.send("relay", message={"text": "bad"})
+        link.send("relay", message={"text": "good"})
+
+        self.assertTrue(got_second.wait(5))
+        self.assertEqual(received, ["good"])
+        self.assertFalse(closed.is_set())
+
+    def test_local_broker_survives_failing_event(self):
+        received = []
+        got_second = threading.Event()
+
+        def on_event(event):
+            if event["message"]["text"] == "bad":
+                raise TypeError("handler failed")
+            received.append(event["message"]["text"])
+            got_second.set()
+
+        broker = bus.LocalBroker(self.hub, on_event)
+        self.addCleanup(broker.close)
+        self.assertTrue(broker.request("hello")["ok"])
+        broker.send("relay", message={"text": "bad"})
+        broker.send("relay", message={"text": "good"})
+
+        self.assertTrue(got_second.wait(5))
+        self.assertEqual(received, ["good"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,63 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common import BINARY_CODEC, BODY_FIELDS, ROW_FIELDS, _ROW_LISTS
+
+
+def _value(msg_type, field):
+    if field == _ROW_LISTS.get(msg_type):
+        return [dict(zip(ROW_FIELDS, (1, "t", "alice", "group", None, "hi")))]
+    return f"{field}-value"
+
+
+class BinaryCodecRoundTrip(unittest.TestCase):
+    """
+    Every message type must survive encode/decode whatever mix of
+    positional fields and extra keys it carries.
+    """
+
+    def round_trip(self, message):
+        frame = BINARY_CODEC.encode(message)
+        return BINARY_CODEC.decode(frame[4:])
+
+    def test_full_fields(self):
+        for msg_type, fields in BODY_FIELDS.items():
+            message = {"type": msg_type}
+            message.update((f, _value(msg_type, f)) for f in fields)
+            with self.subTest(msg_type=msg_type):
+                self.assertEqual(self.round_trip(message), message)
+
+    def test_full_fields_with_extras(self):
+        for msg_type, fields in BODY_FIELDS.items():
+            message = {"type": msg_type, "extra": 1, "flag": None}
+            message.update((f, _value(msg_type, f)) for f in fields)
+            with self.subTest(msg_type=msg_type):
+                self.assertEqual(self.round_trip(message), message)
+
+    def test_sparse_fields_with_extras(self):
+        for msg_type, fields in BODY_FIELDS.items():
+            for field in fields:
+                message = {
+                    "type": msg_type,
+                    field: _value(msg_type, field),
+                    "extra": {"nested": [1, 2]},
+                }
+                with self.subTest(msg_type=msg_type, field=field):
+                    self.assertEqual(self.round_trip(message), message)
+
+    def test_extras_only(self):
+        for msg_type in BODY_FIELDS:
+            message = {"type": msg_type, "extra": "x"}
+            with self.subTest(msg_type=msg_type):
+                self.assertEqual(self.round_trip(message), message)
+
+    def test_unknown_type(self):
+        message = {"type": "not_a_type", "a": 1}
+        self.assertEqual(self.round_trip(message), message)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,155 @@
+import os
+import socket
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common import (
+    BINARY_CODEC, FrameCompressor, FrameReader, FrameTooLarge, encode_json,
+)
+
+
+MESSAGES = [
+    {"type": "group", "sender": "alice", "text": "héllo wörld ✓"},
+    {"type": "private", "sender": "bob", "target": "alice", "text": "日本語"},
+    {"type": "system", "text": "🙂" * 50},
+]
+
+
+def feed_in_pieces(reader, data, size):
+    frames = []
+    for i in range(0, len(data), size):
+        frames.extend(reader.feed(data[i:i + size]))
+    return reader.decode(frames)
+
+
+class JsonFramingTest(unittest.TestCase):
+
+    def stream(self):
+        return b"".join(encode_json(m) for m in MESSAGES)
+
+    def test_one_read_returns_every_frame(self):
+        reader = FrameReader(bufsize=16)
+        self.assertEqual(reader.decode(reader.feed(self.stream())), MESSAGES)
+
+    def test_split_at_every_byte(self):
+        # One byte at a time cuts every multi-byte character in two
+        reader = FrameReader(bufsize=16)
+        self.assertEqual(feed_in_pieces(reader, self.stream(), 1), MESSAGES)
+
+    def test_split_at_odd_sizes(self):
+        for size in (2, 3, 5, 7, 64):
+            with self.subTest(size=size):
+                reader = FrameReader(bufsize=8)
+                self.assertEqual(
+                    feed_in_pieces(reader, self.stream(), size), MESSAGES
+                )
+
+    def test_limit_keeps_the_rest_buffered(self):
+        reader = FrameReader()
+        frames = reader.feed(self.stream(), limit=1)
+        self.assertEqual(reader.decode(frames), MESSAGES[:1])
+        self.assertEqual(reader.decode(reader.feed()), MESSAGES[1:])
+
+    def test_blank_lines_are_skipped(self):
+        reader = FrameReader()
+        frames = reader.feed(b"\n\n" + encode_json(MESSAGES[0]) + b"\n")
+        self.assertEqual(reader.decode(frames), MESSAGES[:1])
+
+    def test_oversized_frame(self):
+        reader = FrameReader(max_frame=100, bufsize=16)
+        with self.assertRaises(FrameTooLarge):
+            for _ in range(20):
+                reader.feed(b"x" * 10)
+
+    def test_frame_at_the_limit(self):
+        frame = encode_json({"type": "system", "text": "x" * 60})
+        reader = FrameReader(max_frame=len(frame) - 1, bufsize=16)
+        self.assertEqual(len(feed_in_pieces(reader, frame, 9)), 1)
+
+
+class LengthFramingTest(unittest.TestCase):
+
+    def reader(self, **kwargs):
+        reader = FrameReader(**kwargs)
+        reader.set_codec(BINARY_CODEC)
+        return reader
+
+    def stream(self):
+        return b"".join(BINARY_CODEC.encode(m) for m in MESSAGES)
+
+    def test_split_at_every_byte(self):
+        reader = self.reader(bufsize=8)
+        self.assertEqual(feed_in_pieces(reader, self.stream(), 1), MESSAGES)
+
+    def test_oversized_header_is_rejected_early(self):
+        reader = self.reader(max_frame=100)
+        with self.assertRaises(FrameTooLarge):
+            reader.feed((101).to_bytes(4, "big") + b"[")
+
+    def test_switch_keeps_buffered_bytes(self):
+        # The binary frames arrive in the same read as the JSON handshake
+        reader = FrameReader()
+        first = reader.feed(
+            encode_json({"type": "login_ok"}) + self.stream(), limit=1
+        )
+        self.assertEqual(reader.decode(first), [{"type": "login_ok"}])
+        reader.set_codec(BINARY_CODEC)
+        self.assertEqual(reader.decode(reader.feed()), MESSAGES)
+
+    def test_compressed_frames(self):
+        compressor = FrameCompressor(threshold=0)
+        data = b"".join(
+            compressor.compress(BINARY_CODEC.encode(m)) for m in MESSAGES * 3
+        )
+        reader = self.reader(bufsize=8)
+        reader.enable_compression()
+        self.assertEqual(feed_in_pieces(reader, data, 3), MESSAGES * 3)
+
+    def test_compressed_frame_without_negotiation(self):
+        compressor = FrameCompressor(threshold=0)
+        reader = self.reader()
+        with self.assertRaises(ValueError):
+            reader.feed(compressor.compress(BINARY_CODEC.encode(MESSAGES[0])))
+
+    def test_decompression_bomb(self):
+        compressor = FrameCompressor(threshold=0)
+        big = {"type": "system", "text": "a" * 10000}
+        reader = self.reader(max_frame=1000)
+        reader.enable_compression()
+        frame = compressor.compress(BINARY_CODEC.encode(big))
+        self.assertLess(len(frame), 1000)
+        with self.assertRaises(FrameTooLarge):
+            reader.feed(frame)
+
+
+class SocketReadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.left, self.right = socket.socketpair()
+
+    def tearDown(self):
+        self.left.close()
+        self.right.close()
+
+    def test_read_messages_and_eof(self):
+        reader = FrameReader(self.right, bufsize=4)
+        self.left.sendall(b"".join(encode_json(m) for m in MESSAGES))
+        received = []
+        while len(received) < len(MESSAGES):
+            received.extend(reader.read_messages())
+        self.assertEqual(received, MESSAGES)
+        self.left.close()
+        self.assertIsNone(reader.read_messages())
+
+    def test_read_message_one_at_a_time(self):
+        reader = FrameReader(self.right)
+        self.left.sendall(b"".join(encode_json(m) for m in MESSAGES))
+        self.assertEqual(
+            [reader.read_message() for _ in MESSAGES], MESSAGES
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
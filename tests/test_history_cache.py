@@ -0,0 +1,206 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import history_cache
+from history_cache import HistoryCache
+
+
+class FakeStorage:
+    """
+    In-memory stand-in for the storage loaders the cache falls back to.
+    Pages are the newest `limit` matches below before_id, oldest first.
+    """
+
+    def __init__(self):
+        self.rows = []
+        self.loads = 0
+        self.during_load = None
+
+    def insert(self, sender, scope, target, text="hi"):
+        row = {"id": len(self.rows) + 1, "ts": "t", "sender": sender,
+               "scope": scope, "target": target, "text": text}
+        self.rows.append(row)
+        return row
+
+    def _page(self, match, limit, before_id):
+        self.loads += 1
+        if self.during_load:
+            hook, self.during_load = self.during_load, None
+            hook()
+        rows = [r for r in self.rows
+                if match(r) and (before_id is None or r["id"] < before_id)]
+        return [dict(r) for r in rows[-limit:]]
+
+    def load_group_history(self, limit=50, before_id=None):
+        return self._page(lambda r: r["scope"] == "group", limit, before_id)
+
+    def load_private_history(self, user1, user2, limit=50, before_id=None):
+        pair = {user1, user2}
+        return self._page(
+            lambda r: r["scope"] == "pm" and {r["sender"], r["target"]} == pair,
+            limit, before_id,
+        )
+
+    def load_channel_history(self, channel, limit=50, before_id=None):
+        return self._page(
+            lambda r: r["scope"] == "channel" and r["target"] == channel,
+            limit, before_id,
+        )
+
+
+def ids(messages):
+    return [m["id"] for m in messages]
+
+
+class CacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.storage = FakeStorage()
+        original = history_cache.storage
+        history_cache.storage = self.storage
+        self.addCleanup(setattr, history_cache, "storage", original)
+
+    def commit(self, cache, sender, scope, target, text="hi"):
+        row = self.storage.insert(sender, scope, target, text)
+        cache.add(dict(row))
+        return row
+
+
+class GroupWindowTest(CacheTestCase):
+
+    def test_pages_within_the_ring_are_hits(self):
+        for _ in range(10):
+            self.storage.insert("alice", "group", None)
+        cache = HistoryCache(group_size=5)
+        cache.prime()
+        self.storage.loads = 0
+
+        self.assertEqual(ids(cache.group_page(3, None)), [8, 9, 10])
+        self.assertEqual(ids(cache.group_page(2, 9)), [7, 8])
+        self.assertEqual((cache.hits, cache.misses, self.storage.loads),
+                         (2, 0, 0))
+
+    def test_pages_past_the_ring_fall_back(self):
+        for _ in range(10):
+            self.storage.insert("alice", "group", None)
+        cache = HistoryCache(group_size=5)
+        cache.prime()
+
+        self.assertEqual(ids(cache.group_page(3, 7)), [4, 5, 6])
+        self.assertEqual(cache.misses, 1)
+
+    def test_complete_ring_answers_short_pages(self):
+        for _ in range(3):
+            self.storage.insert("alice", "group", None)
+        cache = HistoryCache(group_size=5)
+        cache.prime()
+        self.storage.loads = 0
+
+        self.assertEqual(ids(cache.group_page(50, None)), [1, 2, 3])
+        self.assertEqual(ids(cache.group_page(50, 1)), [])
+        self.assertEqual(self.storage.loads, 0)
+
+    def test_ring_drops_oldest_and_becomes_incomplete(self):
+        cache = HistoryCache(group_size=3)
+        cache.prime()
+        for _ in range(5):
+            self.commit(cache, "alice", "group", None)
+        self.storage.loads = 0
+
+        self.assertEqual(ids(cache.group_page(3, None)), [3, 4, 5])
+        self.assertEqual(self.storage.loads, 0)
+        self.assertEqual(ids(cache.group_page(5, None)), [1, 2, 3, 4, 5])
+        self.assertEqual(self.storage.loads, 1)
+
+    def test_out_of_order_and_duplicate_adds(self):
+        cache = HistoryCache(group_size=5)
+        cache.prime()
+        rows = [self.storage.insert("alice", "group", None) for _ in range(3)]
+        for row in (rows[0], rows[2], rows[1], rows[2]):
+            cache.add(dict(row))
+
+        self.assertEqual(ids(cache.group_page(5, None)), [1, 2, 3])
+
+
+class ConversationWindowTest(CacheTestCase):
+
+    def test_first_read_loads_the_window(self):
+        for i in range(6):
+            sender, target = ("alice", "bob") if i % 2 else ("bob", "alice")
+            self.storage.insert(sender, "pm", target)
+        cache = HistoryCache(pm_window=4)
+
+        self.assertEqual(ids(cache.private_page("alice", "bob", 2, None)),
+                         [5, 6])
+        self.assertEqual(self.storage.loads, 1)
+        # Either order of the pair finds the same window
+        self.assertEqual(ids(cache.private_page("bob", "alice", 2, 5)),
+                         [3, 4])
+        self.assertEqual(self.storage.loads, 1)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_commits_extend_a_cached_window(self):
+        cache = HistoryCache(pm_window=3)
+        self.commit(cache, "alice", "channel", "dev")
+        cache.channel_page("dev", 10, None)
+        for _ in range(4):
+            self.commit(cache, "alice", "channel", "dev")
+        self.storage.loads = 0
+
+        self.assertEqual(ids(cache.channel_page("dev", 3, None)), [3, 4, 5])
+        self.assertEqual(self.storage.loads, 0)
+        # The oldest message was dropped, so the window is no longer complete
+        self.assertEqual(ids(cache.channel_page("dev", 10, None)),
+                         [1, 2, 3, 4, 5])
+        self.assertEqual(self.storage.loads, 1)
+
+    def test_commits_during_a_load_are_not_lost(self):
+        cache = HistoryCache(pm_window=10)
+        self.commit(cache, "alice", "channel", "dev")
+        # Committed after the load started but not in what it read
+        late = {"id": 99, "ts": "t", "sender": "bob", "scope": "channel",
+                "target": "dev", "text": "late"}
+        self.storage.during_load = lambda: cache.add(late)
+
+        cache.channel_page("dev", 10, None)
+        self.assertEqual(ids(cache.channel_page("dev", 10, None)), [1, 99])
+
+    def test_uncached_conversations_are_ignored_by_add(self):
+        cache = HistoryCache()
+        self.commit(cache, "alice", "pm", "bob")
+        self.assertEqual(len(cache._windows), 0)
+
+
+class EvictionTest(CacheTestCase):
+
+    def test_least_recently_used_conversation_goes_first(self):
+        cache = HistoryCache(max_conversations=2)
+        for channel in ("a", "b"):
+            self.commit(cache, "alice", "channel", channel)
+            cache.channel_page(channel, 10, None)
+        # Touch "a" so "b" becomes the oldest
+        cache.channel_page("a", 10, None)
+        self.commit(cache, "alice", "channel", "c")
+        cache.channel_page("c", 10, None)
+
+        self.assertEqual(list(cache._windows),
+                         [("channel", "a"), ("channel", "c")])
+
+    def test_byte_budget(self):
+        cache = HistoryCache(max_bytes=3000)
+        for channel in ("a", "b", "c"):
+            self.commit(cache, "alice", "channel", channel, "x" * 1000)
+            cache.channel_page(channel, 10, None)
+
+        self.assertEqual(list(cache._windows),
+                         [("channel", "b"), ("channel", "c")])
+        self.assertLessEqual(cache._windows_bytes, 3000)
+        self.assertEqual(cache._windows_bytes,
+                         sum(w.size for w in cache._windows.values()))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,94 @@
+import os
+import socket
+import sys
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from outbound import (
+    OutboundQueue,
+    SocketConnection,
+    POLICY_BLOCK,
+    POLICY_DISCONNECT,
+    POLICY_DROP_OLDEST,
+    mark_non_blocking,
+    is_non_blocking,
+)
+
+
+class OutboundQueueTest(unittest.TestCase):
+
+    def test_drop_oldest(self):
+        queue = OutboundQueue(maxsize=2, policy=POLICY_DROP_OLDEST)
+        for frame in (b"1", b"2", b"3"):
+            self.assertTrue(queue.put(frame))
+        self.assertEqual(queue.pop_all(), [b"2", b"3"])
+        self.assertEqual(queue.dropped, 1)
+
+    def test_disconnect(self):
+        queue = OutboundQueue(maxsize=1, policy=POLICY_DISCONNECT)
+        self.assertTrue(queue.put(b"1"))
+        self.assertFalse(queue.put(b"2"))
+        self.assertTrue(queue.overflowed and queue.closed)
+
+    def test_block_waits_then_cuts_off(self):
+        queue = OutboundQueue(maxsize=1, policy=POLICY_BLOCK, block_timeout=0.2)
+        queue.put(b"1")
+        started = time.monotonic()
+        self.assertFalse(queue.put(b"2"))
+        self.assertGreaterEqual(time.monotonic() - started, 0.15)
+        self.assertTrue(queue.overflowed)
+
+    def test_block_resumes_when_drained(self):
+        queue = OutboundQueue(maxsize=1, policy=POLICY_BLOCK, block_timeout=2)
+        queue.put(b"1")
+        threading.Timer(0.1, queue.pop_all).start()
+        self.assertTrue(queue.put(b"2"))
+        self.assertEqual(queue.pop_all(), [b"2"])
+
+
+class NonBlockingThreadTest(unittest.TestCase):
+    """
+    Threads that deliver for every client (storage writer, bus readers)
+    never wait on one slow consumer, even under POLICY_BLOCK.
+    """
+
+    def test_flag_is_per_thread(self):
+        seen = []
+        worker = threading.Thread(
+            target=lambda: (mark_non_blocking(), seen.append(is_non_blocking()))
+        )
+        worker.start()
+        worker.join()
+        self.assertEqual(seen, [True])
+        self.assertFalse(is_non_blocking())
+
+    def test_marked_thread_does_not_wait_for_a_slow_reader(self):
+        ours, theirs = socket.socketpair()
+        self.addCleanup(theirs.close)
+        conn = SocketConnection(ours, maxsize=2, policy=POLICY_BLOCK,
+                                block_timeout=5)
+        self.addCleanup(conn.close)
+        waits = []
+
+        def deliver():
+            mark_non_blocking()
+            frame = b"x" * 1024 * 1024
+            for _ in range(200):
+                started = time.monotonic()
+                conn.sendall(frame)
+                waits.append(time.monotonic() - started)
+                if conn.queue.overflowed:
+                    break
+
+        worker = threading.Thread(target=deliver)
+        worker.start()
+        worker.join(30)
+        self.assertTrue(conn.queue.overflowed)
+        self.assertLess(max(waits), 1.0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,152 @@
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import server
+import storage
+from outbound import ProtocolState
+
+
+class FakeConnection(ProtocolState):
+
+    def __init__(self):
+        super().__init__()
+        self.frames = []
+
+    def sendall(self, data):
+        self.frames.append(data)
+
+    def messages(self):
+        return [json.loads(frame) for frame in self.frames]
+
+    def take(self):
+        messages = self.messages()
+        self.frames = []
+        return messages
+
+
+class PendingTestCase(unittest.TestCase):
+    """
+    Pending PM queue against a scratch database, without a writer thread.
+    """
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        saved = (storage.DB_DIR, storage.DB_PATH)
+        storage.DB_DIR = self.workdir
+        storage.DB_PATH = os.path.join(self.workdir, "chat.db")
+        storage.init_db()
+
+        def restore():
+            storage.DB_DIR, storage.DB_PATH = saved
+            shutil.rmtree(self.workdir, ignore_errors=True)
+        self.addCleanup(restore)
+
+    def pm(self, sender, target, text="hi"):
+        return storage.save_message("ts", sender, "pm", target, text)
+
+
+class PendingStorageTest(PendingTestCase):
+
+    def test_only_pms_to_others_are_pending(self):
+        ids = [self.pm("alice", "bob") for _ in range(3)]
+        storage.save_message("ts", "alice", "group", None, "hi")
+        self.pm("bob", "bob")
+        self.pm("bob", "alice")
+
+        pending = storage.load_pending("bob")
+        self.assertEqual([m["id"] for m in pending], ids)
+        self.assertEqual(pending[0]["scope"], "pm")
+        self.assertEqual(pending[0]["sender"], "alice")
+
+    def test_keyset_pages(self):
+        ids = [self.pm("alice", "bob") for _ in range(5)]
+        first = storage.load_pending("bob", limit=2)
+        second = storage.load_pending("bob", after_id=first[-1]["id"], limit=2)
+        third = storage.load_pending("bob", after_id=second[-1]["id"], limit=2)
+        self.assertEqual([m["id"] for m in first + second + third], ids)
+
+    def test_ack_some_and_all(self):
+        ids = [self.pm("alice", "bob") for _ in range(4)]
+        storage.ack_messages("bob", ids[:2])
+        self.assertEqual([m["id"] for m in storage.load_pending("bob")],
+                         ids[2:])
+        storage.ack_messages("bob")
+        self.assertEqual(storage.load_pending("bob"), [])
+
+
+class PendingDeliveryTest(PendingTestCase):
+    """
+    drain_pending() sends one batch at a time; only the ack of the last
+    message of the batch in flight asks for the next one.
+    """
+
+    def setUp(self):
+        super().setUp()
+        saved = dict(server.config)
+        self.addCleanup(lambda: (server.config.clear(), server.config.update(saved)))
+        server.configure(pending_batch=2)
+        self.ids = [self.pm("alice", "bob", f"m{i}") for i in range(5)]
+        self.conn = FakeConnection()
+
+    def ack(self, ids):
+        server.handle_ack(self.conn, "bob", {"type": "ack", "ids": ids})
+
+    def test_batches_follow_acks(self):
+        server.drain_pending(self.conn, "bob")
+        (batch,) = self.conn.take()
+        self.assertEqual(batch["type"], "pending")
+        self.assertTrue(batch["has_more"])
+        self.assertEqual([m["id"] for m in batch["messages"]], self.ids[:2])
+
+        # Acking the first message alone does not release the next batch
+        self.ack(self.ids[:1])
+        self.assertEqual(self.conn.take(), [])
+
+        self.ack(self.ids[1:2])
+        (batch,) = self.conn.take()
+        self.assertEqual([m["id"] for m in batch["messages"]], self.ids[2:4])
+
+        self.ack(self.ids[2:4])
+        (batch,) = self.conn.take()
+        self.assertFalse(batch["has_more"])
+        self.assertEqual([m["id"] for m in batch["messages"]], self.ids[4:])
+        self.assertIsNone(self.conn.pending_cursor)
+
+        self.ack(self.ids[4:])
+        self.assertEqual(self.conn.take(), [])
+        self.assertEqual(storage.load_pending("bob"), [])
+
+    def test_unacked_batch_is_sent_again_at_next_login(self):
+        server.drain_pending(self.conn, "bob")
+        self.ack(self.ids[:1])
+
+        again = FakeConnection()
+        server.drain_pending(again, "bob")
+        (batch,) = again.messages()
+        self.assertEqual([m["id"] for m in batch["messages"]], self.ids[1:3])
+
+    def test_empty_queue_sends_nothing(self):
+        storage.ack_messages("bob")
+        server.drain_pending(self.conn, "bob")
+        self.assertEqual(self.conn.frames, [])
+        self.assertIsNone(self.conn.pending_cursor)
+
+    def test_invalid_acks(self):
+        for ids in (None, "1", [1, "2"], [True], list(range(server.ACK_MAX + 1))):
+            with self.subTest(ids=str(ids)[:20]):
+                self.ack(ids)
+                self.assertEqual(
+                    self.conn.take(),
+                    [{"type": "error", "message": "Invalid ack"}]
+                )
+        self.assertEqual(len(storage.load_pending("bob")), 5)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,167 @@
+import json
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ratelimit
+import server
+from outbound import ProtocolState
+from ratelimit import TokenBucket, parse_limit
+
+
+class FakeClock:
+    """
+    Stands in for the time module inside ratelimit.
+    """
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+class FakeConnection(ProtocolState):
+
+    def __init__(self):
+        super().__init__()
+        self.frames = []
+
+    def sendall(self, data):
+        self.frames.append(data)
+
+    def messages(self):
+        return [json.loads(frame) for frame in self.frames]
+
+
+class ClockTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        original = ratelimit.time
+        ratelimit.time = self.clock
+        self.addCleanup(setattr, ratelimit, "time", original)
+
+
+class TokenBucketTest(ClockTestCase):
+
+    def test_burst_then_empty(self):
+        bucket = TokenBucket(rate=1, burst=3)
+        self.assertEqual([bucket.take() for _ in range(4)],
+                         [0.0, 0.0, 0.0, None])
+
+    def test_refill_is_capped_at_burst(self):
+        bucket = TokenBucket(rate=2, burst=2)
+        bucket.take()
+        bucket.take()
+        self.assertEqual(bucket.take(), None)
+        self.clock.now += 0.5
+        self.assertEqual(bucket.take(), 0.0)
+        self.clock.now += 100
+        self.assertTrue(bucket.is_full())
+        self.assertEqual([bucket.take() for _ in range(3)],
+                         [0.0, 0.0, None])
+
+    def test_lends_tokens_within_max_delay(self):
+        bucket = TokenBucket(rate=2, burst=1)
+        self.assertEqual(bucket.take(max_delay=1), 0.0)
+        self.assertAlmostEqual(bucket.take(max_delay=1), 0.5)
+        self.assertAlmostEqual(bucket.take(max_delay=1), 1.0)
+        # Debt beyond max_delay is refused and takes nothing
+        self.assertIsNone(bucket.take(max_delay=1))
+        self.assertAlmostEqual(bucket.retry_after(), 1.5)
+
+    def test_steady_sender_is_slowed_to_rate(self):
+        bucket = TokenBucket(rate=10, burst=1)
+        bucket.take()
+        for _ in range(5):
+            wait = bucket.take(max_delay=1)
+            self.assertAlmostEqual(wait, 0.1)
+            self.clock.now += wait
+
+    def test_retry_after_and_is_full(self):
+        bucket = TokenBucket(rate=4, burst=2)
+        self.assertEqual(bucket.retry_after(), 0.0)
+        self.assertTrue(bucket.is_full())
+        bucket.take()
+        self.assertFalse(bucket.is_full())
+        self.clock.now += 0.25
+        self.assertTrue(bucket.is_full())
+
+
+class ParseLimitTest(unittest.TestCase):
+
+    def test_rate_and_burst(self):
+        self.assertEqual(parse_limit("5:20"), (5.0, 20.0))
+
+    def test_burst_defaults_to_rate(self):
+        self.assertEqual(parse_limit("5"), (5.0, 5.0))
+        self.assertEqual(parse_limit("0.5"), (0.5, 1.0))
+
+    def test_zero_is_unlimited(self):
+        self.assertIsNone(parse_limit("0"))
+
+    def test_invalid(self):
+        for text in ("abc", "5:0.5", ""):
+            with self.subTest(text=text):
+                with self.assertRaises(ValueError):
+                    parse_limit(text)
+
+
+class AdmitTest(ClockTestCase):
+
+    def setUp(self):
+        super().setUp()
+        saved = dict(server.config)
+        self.addCleanup(lambda: (server.config.clear(), server.config.update(saved)))
+        server.configure(group_rate=(1, 2), private_rate=None,
+                         history_rate=None, connection_rate=None,
+                         rate_max_delay=0)
+        self.conn = FakeConnection()
+        self.addCleanup(server._user_buckets.pop, "alice", None)
+        self.addCleanup(server._connection_buckets.pop, self.conn, None)
+
+    def admit(self, msg_type):
+        return server.admit(self.conn, "alice", {"type": msg_type})
+
+    def test_group_and_channel_share_one_bucket(self):
+        results = [self.admit(t)[0] for t in ("group", "channel", "channel")]
+        self.assertEqual(results, [True, True, False])
+        self.assertEqual(self.conn.messages()[-1]["type"], "error")
+
+    def test_rejection_pauses_until_the_next_token(self):
+        self.admit("group")
+        self.admit("group")
+        allowed, delay = self.admit("group")
+        self.assertFalse(allowed)
+        self.assertEqual(delay, 0)   # capped at rate_max_delay
+
+        server.configure(rate_max_delay=5)
+        self.clock.now += 0.25
+        allowed, delay = self.admit("group")
+        self.assertTrue(allowed)
+        self.assertAlmostEqual(delay, 0.75)
+
+    def test_unlimited_and_exempt_types(self):
+        for _ in range(10):
+            self.assertEqual(self.admit("private"), (True, 0.0))
+            self.assertEqual(self.admit("ack"), (True, 0.0))
+
+    def test_connection_limit_applies_to_every_type(self):
+        server.configure(connection_rate=(1, 1))
+        self.assertTrue(self.admit("private")[0])
+        self.assertFalse(self.admit("users_request")[0])
+
+    def test_buckets_in_debt_outlive_the_connection(self):
+        self.admit("group")
+        server._forget_buckets(self.conn, "alice")
+        self.assertIn("alice", server._user_buckets)
+        self.clock.now += 10
+        server._forget_buckets(self.conn, "alice")
+        self.assertNotIn("alice", server._user_buckets)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,130 @@
+import json
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import server
+from common import BINARY_CODEC, FrameReader
+from outbound import ProtocolState
+
+
+class FakeConnection(ProtocolState):
+    """
+    Records the frames the handlers send instead of writing them.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.frames = []
+
+    def sendall(self, data):
+        self.frames.append(data)
+
+    def start_compression(self, compressor):
+        pass
+
+    def close(self):
+        pass
+
+    def messages(self):
+        return [json.loads(frame) for frame in self.frames]
+
+
+class MessageValidationTest(unittest.TestCase):
+    """
+    Malformed chat messages are answered with MSG_ERROR and never reach
+    publish(), so they cannot fail a storage batch after fan-out.
+    """
+
+    def setUp(self):
+        self.published = []
+        original = server.publish
+        server.publish = lambda *args: self.published.append(args)
+        self.addCleanup(setattr, server, "publish", original)
+
+    def check_rejected(self, msg):
+        conn = FakeConnection()
+        server.handle_message(conn, "alice", msg)
+        self.assertEqual(self.published, [])
+        self.assertEqual(
+            conn.messages(), [{"type": "error", "message": "Invalid message"}]
+        )
+
+    def test_group_text_must_be_a_string(self):
+        self.check_rejected({"type": "group", "text": {"evil": 1}})
+        self.check_rejected({"type": "group"})
+
+    def test_private_target_and_text_must_be_strings(self):
+        self.check_rejected({"type": "private", "target": ["x"], "text": "hi"})
+        self.check_rejected({"type": "private", "target": "bob", "text": 5})
+
+    def test_valid_group_message_is_published(self):
+        conn = FakeConnection()
+        server.handle_message(conn, "alice", {"type": "group", "text": "hi"})
+        self.assertEqual(len(self.published), 1)
+        self.assertEqual(conn.frames, [])
+
+
+class LoginOrderTest(unittest.TestCase):
+    """
+    A broadcast racing with a login must not reach the client before its
+    login_ok, nor in the codec it used before the switch.
+    """
+
+    def test_broadcast_during_login_waits_for_login_ok(self):
+        class RacingConnection(FakeConnection):
+            def sendall(self, data):
+                # A group message fanned out while login_ok is queued
+                if not self.frames:
+                    server.broadcast({"type": "group", "text": "racing"})
+                super().sendall(data)
+
+        conn = RacingConnection()
+        username = server.login(conn, FrameReader(), {
+            "type": "login", "username": "racer", "codec": "binary"
+        })
+        self.addCleanup(server.remove_client, conn)
+        self.assertEqual(username, "racer")
+        self.assertEqual(len(conn.frames), 1)
+        self.assertEqual(json.loads(conn.frames[0])["type"], "login_ok")
+
+        server.broadcast({"type": "group", "text": "after"})
+        frame = conn.frames[-1]
+        self.assertEqual(BINARY_CODEC.decode(frame[4:])["text"], "after")
+
+    def test_name_is_taken_while_login_is_in_progress(self):
+        self.assertTrue(server.claim_username("halfway"))
+        self.addCleanup(server.claimed.discard, "halfway")
+        conn = FakeConnection()
+        self.assertIsNone(server.login(conn, FrameReader(), {
+            "type": "login", "username": "halfway"
+        }))
+        self.assertEqual(conn.messages()[0]["message"], "Username already taken")
+
+
+class ChannelRateLimitTest(unittest.TestCase):
+    """
+    Joins and leaves share the history bucket, so flooding them cannot
+    get around history_rate.
+    """
+
+    def setUp(self):
+        saved = dict(server.config)
+        self.addCleanup(lambda: (server.config.clear(), server.config.update(saved)))
+        server.configure(history_rate=(0.01, 2), connection_rate=None,
+                         rate_max_delay=0)
+
+    def test_join_leave_flood_is_limited(self):
+        conn = FakeConnection()
+        self.addCleanup(server._user_buckets.pop, "flooder", None)
+        results = [
+            server.admit(conn, "flooder", {"type": kind, "channel": "dev"})[0]
+            for kind in ("join", "leave", "join", "history_request")
+        ]
+        self.assertEqual(results, [True, True, False, False])
+
+
+if __name__ == "__main__":
+    unittest.main()
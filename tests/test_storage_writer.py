@@ -0,0 +1,101 @@
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import metrics
+import storage
+
+
+class StorageWriterTest(unittest.TestCase):
+    """
+    StorageWriter against a scratch database.
+    """
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self._saved = (storage.DB_DIR, storage.DB_PATH)
+        storage.DB_DIR = self.workdir
+        storage.DB_PATH = os.path.join(self.workdir, "chat.db")
+        storage.init_db()
+        metrics.reset()
+        self.committed = []
+        self._lock = threading.Lock()
+
+    def tearDown(self):
+        storage.DB_DIR, storage.DB_PATH = self._saved
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def writer(self, **options):
+        writer = storage.StorageWriter(db_path=storage.DB_PATH, **options)
+        writer.start()
+        self.addCleanup(writer.stop)
+        return writer
+
+    def on_commit(self, msg_id):
+        with self._lock:
+            self.committed.append(msg_id)
+
+    def stored_texts(self):
+        conn = sqlite3.connect(storage.DB_PATH)
+        rows = conn.execute("SELECT text FROM messages ORDER BY id").fetchall()
+        conn.close()
+        return [text for (text,) in rows]
+
+    def test_group_commit(self):
+        writer = self.writer(max_batch=100, max_delay=0.2)
+        ids = [
+            writer.submit("ts", "alice", "group", None, f"m{i}", self.on_commit)
+            for i in range(10)
+        ]
+        self.assertTrue(writer.flush(timeout=5))
+
+        self.assertEqual(ids, list(range(1, 11)))
+        self.assertEqual(sorted(self.committed), ids)
+        self.assertEqual(self.stored_texts(), [f"m{i}" for i in range(10)])
+        self.assertEqual(metrics.snapshot()["storage_commits_total"], 1)
+
+    def test_max_batch_splits_commits(self):
+        writer = self.writer(max_batch=4, max_delay=0.2)
+        for i in range(10):
+            writer.submit("ts", "alice", "group", None, f"m{i}")
+        self.assertTrue(writer.flush(timeout=5))
+        self.assertEqual(len(self.stored_texts()), 10)
+        self.assertEqual(metrics.snapshot()["storage_commits_total"], 3)
+
+    def test_bad_row_does_not_sink_the_batch(self):
+        writer = self.writer(max_batch=100, max_delay=0.2)
+        good = [
+            writer.submit("ts", "alice", "group", None, f"ok{i}", self.on_commit)
+            for i in range(5)
+        ]
+        bad = writer.submit("ts", "mallory", "group", None, {"evil": 1},
+                            self.on_commit)
+        self.assertTrue(writer.flush(timeout=5))
+
+        self.assertEqual(self.stored_texts(), [f"ok{i}" for i in range(5)])
+        self.assertEqual(sorted(self.committed), good)
+        self.assertNotIn(bad, self.committed)
+        self.assertEqual(metrics.snapshot()["storage_errors_total"], 1)
+
+    def test_ids_continue_after_restart(self):
+        writer = self.writer()
+        writer.submit("ts", "alice", "group", None, "first")
+        writer.stop()
+        writer = self.writer()
+        self.assertEqual(writer.submit("ts", "alice", "group", None, "x"), 2)
+
+    def test_submit_after_stop(self):
+        writer = self.writer()
+        writer.stop()
+        with self.assertRaises(RuntimeError):
+            writer.submit("ts", "alice", "group", None, "late")
+
+
+if __name__ == "__main__":
+    unittest.main()